@@ -14,12 +14,23 @@ import json
 import sys
 import csv
 import logging
+import time
+import heapq
+import sqlite3
+import tempfile
+import itertools
+import concurrent.futures
+from array import array
+from collections import Counter
 from shutil import copyfile
 from os.path import join, dirname
-from typing import Dict, List, Optional, Any
+from typing import Dict, Iterable, List, Optional, Any
 from config import Config
 import nltk
-from nltk.stem.porter import PorterStemmer
+import wer_engine
+from normalization import TextNormalizer
+from reference_index import ReferenceIndex
+from metrics import MetricsRecorder
 
 DEFAULT_CONFIG_INI='config.ini'
 DEFAULT_LOGLEVEL='DEBUG'
@@ -45,20 +56,110 @@ class AnalysisResult:
         self.data["Insertions"]            = measures['insertions']
         self.data["Differences"]           = str(differences).replace(';', ' ') #Replace commas for naive CSV readers
 
+class WordAccuracy:
+    """
+    Per-word occurrence and error counts for the `word_accuracy_file`.
+
+    Words are interned into a vocabulary of integer IDs and the counts are kept in flat integer arrays,
+    which is far smaller than a dictionary per word on large corpora.  Error rates are only computed
+    when the table is written.
+    """
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.words: List[str] = []
+        self.counts = array('q')
+        self.errors = array('q')
+
+    def __len__(self):
+        return len(self.words)
+
+    def get_id(self, word: str) -> int:
+        word_id = self.ids.get(word)
+        if word_id is None:
+            word = sys.intern(word)
+            word_id = len(self.words)
+            self.ids[word] = word_id
+            self.words.append(word)
+            self.counts.append(0)
+            self.errors.append(0)
+        return word_id
+
+    def add_counts(self, words: Iterable[str]):
+        for word, count in Counter(words).items():
+            self.counts[self.get_id(word)] += count
+
+    def add_errors(self, words: Iterable[str]):
+        for word, count in Counter(words).items():
+            self.errors[self.get_id(word)] += count
+
+    def merge(self, other: "WordAccuracy"):
+        for word_id, word in enumerate(other.words):
+            my_id = self.get_id(word)
+            self.counts[my_id] += other.counts[word_id]
+            self.errors[my_id] += other.errors[word_id]
+
+    def rows(self, min_count: int = 0, top_k: Optional[int] = None):
+        """
+        Yield a dict of word, count, errors and error_rate per word, in first-seen order.
+
+        Args:
+            min_count: Skip words seen fewer than this many times
+            top_k: If set, only the `top_k` words with the most errors, most errors first
+        """
+        word_ids = [i for i in range(len(self.words)) if self.counts[i] >= min_count]
+        if top_k is not None:
+            word_ids = heapq.nlargest(top_k, word_ids, key=lambda i: (self.errors[i], self.counts[i]))
+        for i in word_ids:
+            count, errors = self.counts[i], self.errors[i]
+            yield {'word':self.words[i], 'count':count, 'errors':errors, 'error_rate':errors / count if count > 0 else 0.0}
+
 class AnalysisResults:
-    def __init__(self, config):
+    def __init__(self, config, details_file=None):
+        """
+        Args:
+            details_file: If set, detail rows are written to this file as they are added instead of
+                being kept in `results` (streaming mode)
+        """
         self.results = []
         self.headers = []
+        self.sample_count = 0
         self.total_words  = 0
         self.total_word_errors = 0
         self.total_sent_errors = 0
         self.config = config
-        self.word_map = {}
+        self.word_accuracy = WordAccuracy()
+        #Seconds spent per analysis stage, for metrics
+        self.timings = Counter()
+        self.details_file = details_file
+        self.details_handle = None
+        self.details_writer = None
+
+    def record_details(self, result:AnalysisResult):
+        self.sample_count += 1
+        self.headers = list(result.data.keys())
+        if self.details_file is None:
+            self.results.append(result)
+            return
+
+        if self.details_writer is None:
+            self.details_handle = open(self.details_file, 'w', newline='')
+            self.details_writer = csv.writer(self.details_handle)
+            self.details_writer.writerow(self.headers)
+        self.details_writer.writerow(result.data.values())
+
+    def close(self):
+        """
+        Finish the streamed `details_file`, if any.
+        """
+        if self.details_handle is not None:
+            self.details_handle.close()
+            self.details_handle = None
+            if self.details_file != os.devnull:
+                logging.info(f"Wrote detailed results to {self.details_file}")
 
     def add(self, result:AnalysisResult):
         #Track `details_file` data
-        self.results.append(result)
-        self.headers = result.data.keys()
+        self.record_details(result)
 
         #Track `summary_file` data
         word_errors = 0
@@ -72,32 +173,38 @@ class AnalysisResults:
             self.total_sent_errors += 1
 
         #Track `word_accuracy_file` data
-        for word in result.data["Reference (clean)"].split(" "):
-            tuple = self.get_tuple(word)
-            tuple['count'] = tuple['count']+1
-            tuple['error_rate'] = tuple['errors'] / tuple['count']
-
-        for word in result.differences:
-            tuple = self.get_tuple(word)
-            tuple['errors']     = tuple['errors']+1
-            tuple['error_rate'] = tuple['errors'] / tuple['count']
-
-    def get_tuple(self, word):
-        if word not in self.word_map:
-            tuple = {'word':word, 'count':0, 'errors':0, 'error_rate':0.0}
-            self.word_map[word] = tuple
-        else:
-            tuple = self.word_map[word]
-        return tuple
+        self.word_accuracy.add_counts(result.data["Reference (clean)"].split(" "))
+        self.word_accuracy.add_errors(result.differences)
+
+    def merge(self, other: "AnalysisResults"):
+        """
+        Append the results of another (partial) analysis after the ones already collected.
+        """
+        for result in other.results:
+            self.record_details(result)
+
+        self.total_words       += other.total_words
+        self.total_word_errors += other.total_word_errors
+        self.total_sent_errors += other.total_sent_errors
+
+        self.word_accuracy.merge(other.word_accuracy)
+        self.timings.update(other.timings)
+
+    @property
+    def word_map(self):
+        """
+        Word accuracy rows keyed by word
+        """
+        return {row['word']: row for row in self.word_accuracy.rows()}
 
     def get_summary(self):
         results = {}
-        results["Number of Samples"]      = len(self.results)
+        results["Number of Samples"]      = self.sample_count
         results["Total Words"]            = self.total_words
         results["Total Word Errors"]      = self.total_word_errors
         results["Word Error Rate"]        = round(self.total_word_errors / self.total_words, 4)
         results["Total Sentence Errors"]  = self.total_sent_errors
-        results["Sentence Error Rate"]    = round(self.total_sent_errors / len(self.results), 4)
+        results["Sentence Error Rate"]    = round(self.total_sent_errors / self.sample_count, 4)
 
         #Store transcription configuration in the summary, for ease of comparing different summary files
         #Don't store/compare sensitive values
@@ -110,6 +217,11 @@ class AnalysisResults:
         return results
 
     def write_details(self, filename):
+        if self.details_file is not None:
+            #Rows were already streamed to `details_file`
+            self.close()
+            return
+
         csv_columns = self.headers
 
         with open(filename, 'w',newline='') as csvfile:
@@ -129,12 +241,13 @@ class AnalysisResults:
 
     def write_word_accuracy(self, filename):
         csv_columns = ['word','count','errors','error_rate']
+        min_count = int(self.config.getValue("Analysis", "word_accuracy_min_count", 0) or 0)
+        top_k = self.config.getValue("Analysis", "word_accuracy_top_k")
 
         with open(filename, 'w',newline='') as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=csv_columns)
             writer.writeheader()
-            for word in self.word_map:
-                writer.writerow(self.word_map[word])
+            writer.writerows(self.word_accuracy.rows(min_count, int(top_k) if top_k else None))
 
         logging.info(f"Wrote word accuracy results to {filename}")
 
@@ -142,6 +255,8 @@ class Analyzer:
     def __init__(self, config):
         self.config = config
         self.transformation = self.get_pipeline()
+        self.normalizer = TextNormalizer(config, self.transformation)
+        self.differences_mode = self.config.getValue("Analysis", "differences", "counts") or "counts"
 
     def load_csv(self, filename: str, headers: list) -> Dict[str, str]:
         result = {}
@@ -199,7 +314,11 @@ class Analyzer:
         return jiwer.Compose(pipeline)
 
 
-    def analyze(self):
+    def analyze(self, details_file=None):
+        """
+        Args:
+            details_file: With `streaming=True`, detail rows are written here as they are computed
+        """
         try:
             # Validate required configuration
             reference_file = self.config.getValue("Transcriptions", "reference_transcriptions_file")
@@ -221,9 +340,18 @@ class Analyzer:
             if not os.path.exists(hypothesis_file):
                 logging.error(f"Hypothesis file does not exist: {hypothesis_file}")
                 return AnalysisResults(self.config)
-                
-            reference_dict = self.load_csv(reference_file, ["Audio File Name", "Reference"])
+
+            if self.config.getBoolean("Analysis", "streaming"):
+                return self.analyze_streaming(reference_file, hypothesis_file, details_file)
+
+            start = time.perf_counter()
+            reference_index = ReferenceIndex.from_config(self.config, self.normalizer, lambda: self.load_csv(reference_file, ["Audio File Name", "Reference"]))
+            if reference_index is not None:
+                reference_dict = reference_index.references()
+            else:
+                reference_dict = self.load_csv(reference_file, ["Audio File Name", "Reference"])
             hypothesis_dict = self.load_csv(hypothesis_file, ["Audio File Name", "Transcription"])
+            load_seconds = time.perf_counter() - start
             
             # Validate that we have data to process
             if not reference_dict:
@@ -234,54 +362,215 @@ class Analyzer:
                 logging.error(f"No hypothesis data found in {hypothesis_file}")
                 return AnalysisResults(self.config)
 
-            results = AnalysisResults(self.config)
-            p_stemmer = PorterStemmer()
-
+            items = []
             for audio_file_name in reference_dict.keys():
-                try:
-                    reference = reference_dict.get(audio_file_name)
-                    hypothesis = hypothesis_dict.get(audio_file_name, None)
-
-                    if hypothesis is None:
-                        logging.warning(f"{audio_file_name} - No hypothesis transcription found")
-                        continue
-
-                    # Common pre-processing on ground truth and hypothesis
-                    cleaned_ref = self.transformation(reference)
-                    cleaned_hyp = self.transformation(hypothesis)
+                hypothesis = hypothesis_dict.get(audio_file_name, None)
+                if hypothesis is None:
+                    logging.warning(f"{audio_file_name} - No hypothesis transcription found")
+                    continue
+                if reference_index is not None:
+                    items.append((audio_file_name, reference_dict.get(audio_file_name), hypothesis, reference_index.cleaned(audio_file_name)))
+                else:
+                    items.append((audio_file_name, reference_dict.get(audio_file_name), hypothesis))
 
-                    if self.config.getBoolean("Transformations", "stemming"):
-                        cleaned_ref = [p_stemmer.stem(word) for word in cleaned_ref]
-                        cleaned_hyp = [p_stemmer.stem(word) for word in cleaned_hyp]
-
-                    # gather all metrics at once with `compute_measures`
-                    measures = jiwer.compute_measures(cleaned_ref, cleaned_hyp)
-                    differences = self.compute_differences(cleaned_ref, cleaned_hyp)
-
-                    result = AnalysisResult(audio_file_name, reference, hypothesis, " ".join(cleaned_ref), " ".join(cleaned_hyp), measures, differences)
-                    results.add(result)
-                except Exception as e:
-                    logging.error(f"Error analyzing file {audio_file_name}: {str(e)}")
+            results = AnalysisResults(self.config)
+            results.timings["load_seconds"] += load_seconds
+            workers = int(self.config.getValue("Analysis", "workers", 1) or 1)
+            if workers > 1 and len(items) > 1:
+                self.analyze_parallel(items, results, workers)
+            else:
+                self.analyze_items(items, results)
         except Exception as e:
             logging.error(f"Error in analysis process: {str(e)}")
             return AnalysisResults(self.config)
 
         return results
 
+    def analyze_streaming(self, reference_file, hypothesis_file, details_file=None):
+        """
+        Analyze without holding the corpus in memory: both CSVs are streamed into a temporary SQLite
+        database, the joined rows are read back in reference order in chunks of `batch_size`, and each
+        detail row is written to `details_file` as soon as it is computed.  Only the summary totals and
+        word accuracy counts are kept.
+        """
+        results = AnalysisResults(self.config, details_file or os.devnull)
+        chunk_size = int(self.config.getValue("Analysis", "batch_size", wer_engine.DEFAULT_BATCH_SIZE))
+        workers = int(self.config.getValue("Analysis", "workers", 1) or 1)
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            db = sqlite3.connect(join(tmpdir, "analysis.db"))
+            try:
+                start = time.perf_counter()
+                for table, filename, headers in [("reference", reference_file, ["Audio File Name", "Reference"]),
+                                                 ("hypothesis", hypothesis_file, ["Audio File Name", "Transcription"])]:
+                    #Like `load_csv`, a repeated file name keeps its first position and its last value
+                    db.execute(f"CREATE TABLE {table} (name TEXT PRIMARY KEY, value TEXT)")
+                    db.executemany(f"INSERT INTO {table} VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value=excluded.value",
+                                   self.iter_csv(filename, headers))
+                db.commit()
+                results.timings["load_seconds"] += time.perf_counter() - start
+
+                for table, filename in [("reference", reference_file), ("hypothesis", hypothesis_file)]:
+                    if db.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0] == 0:
+                        logging.error(f"No {table} data found in {filename}")
+                        return results
+
+                rows = db.execute("SELECT r.name, r.value, h.value FROM reference r LEFT JOIN hypothesis h ON h.name = r.name ORDER BY r.rowid")
+                items = self.iter_matched(rows)
+                chunks = iter(lambda: list(itertools.islice(items, chunk_size)), [])
+                if workers > 1:
+                    #Keep a bounded window of chunks in flight so memory stays independent of corpus size
+                    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+                        in_flight = []
+                        for chunk in chunks:
+                            in_flight.append(executor.submit(analyze_shard, self.config, chunk))
+                            if len(in_flight) >= 2 * workers:
+                                results.merge(in_flight.pop(0).result())
+                        for future in in_flight:
+                            results.merge(future.result())
+                else:
+                    for chunk in chunks:
+                        self.analyze_items(chunk, results)
+            finally:
+                db.close()
+                results.close()
+
+        return results
+
+    def iter_csv(self, filename: str, headers: list):
+        """
+        Yield (key, value) pairs from the given columns of a CSV file, one row at a time.
+        """
+        with open(filename, encoding='utf-8-sig') as file:
+            for row in csv.DictReader(file):
+                try:
+                    yield row[headers[0]], row[headers[1]]
+                except KeyError as e:
+                    logging.error(f"Missing required column in CSV: {e}")
+
+    def iter_matched(self, rows):
+        for audio_file_name, reference, hypothesis in rows:
+            if hypothesis is None:
+                logging.warning(f"{audio_file_name} - No hypothesis transcription found")
+                continue
+            yield audio_file_name, reference, hypothesis
+
+    def analyze_items(self, items, results):
+        """
+        Analyze (audio file name, reference, hypothesis) tuples, adding them to `results` in order.
+        A fourth element, if present, is the already normalized reference from the reference index.
+        """
+        engine = self.config.getValue("Analysis", "engine", "jiwer") or "jiwer"
+        pending = []
+
+        for audio_file_name, reference, hypothesis, *indexed in items:
+            try:
+                start = time.perf_counter()
+                # Common pre-processing on ground truth and hypothesis
+                cleaned_ref = indexed[0] if len(indexed) > 0 and indexed[0] is not None else self.normalizer(reference)
+                cleaned_hyp = self.normalizer(hypothesis)
+                transformed = time.perf_counter()
+                results.timings["transformation_seconds"] += transformed - start
+
+                if engine == "batch":
+                    # scored together with all other files below
+                    pending.append((audio_file_name, reference, hypothesis, cleaned_ref, cleaned_hyp))
+                    continue
+
+                # gather all metrics at once with `compute_measures`
+                measures = jiwer.compute_measures(cleaned_ref, cleaned_hyp)
+                aligned = time.perf_counter()
+                differences = self.compute_differences(cleaned_ref, cleaned_hyp)
+                compared = time.perf_counter()
+
+                result = AnalysisResult(audio_file_name, reference, hypothesis, " ".join(cleaned_ref), " ".join(cleaned_hyp), measures, differences)
+                results.add(result)
+                results.timings["alignment_seconds"] += aligned - transformed
+                results.timings["differences_seconds"] += compared - aligned
+                results.timings["aggregation_seconds"] += time.perf_counter() - compared
+            except Exception as e:
+                logging.error(f"Error analyzing file {audio_file_name}: {str(e)}")
+
+        if len(pending) > 0:
+            self.analyze_batch(pending, results)
+
+    def analyze_parallel(self, items, results, workers):
+        """
+        Split the items into one contiguous shard per worker process, analyze the shards concurrently,
+        and merge the partial results back in shard order so the details keep the reference order.
+        """
+        shard_size = -(-len(items) // workers)
+        shards = [items[i:i + shard_size] for i in range(0, len(items), shard_size)]
+        logging.debug(f"Analyzing {len(items)} files in {len(shards)} shards")
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(shards)) as executor:
+            for partial in executor.map(analyze_shard, [self.config] * len(shards), shards):
+                results.merge(partial)
+
+    def analyze_batch(self, pending, results):
+        """
+        Score all transformed reference/hypothesis pairs at once with the vectorized `wer_engine`
+        and add them to `results` in reference order.
+        """
+        batch_size = int(self.config.getValue("Analysis", "batch_size", wer_engine.DEFAULT_BATCH_SIZE))
+        scored = []
+        pairs = []
+        for item in pending:
+            ref_words = wer_engine.to_words(item[3])
+            if len(ref_words) == 0:
+                logging.error(f"Error analyzing file {item[0]}: the ground truth cannot be an empty")
+                continue
+            scored.append(item)
+            pairs.append((ref_words, wer_engine.to_words(item[4])))
+
+        logging.debug(f"Scoring {len(pairs)} files with the batch engine")
+        start = time.perf_counter()
+        batch = wer_engine.batch_measures(pairs, batch_size)
+        results.timings["alignment_seconds"] += time.perf_counter() - start
+        for (audio_file_name, reference, hypothesis, cleaned_ref, cleaned_hyp), measures in zip(scored, batch):
+            try:
+                start = time.perf_counter()
+                differences = self.compute_differences(cleaned_ref, cleaned_hyp)
+                compared = time.perf_counter()
+                result = AnalysisResult(audio_file_name, reference, hypothesis, " ".join(cleaned_ref), " ".join(cleaned_hyp), measures, differences)
+                results.add(result)
+                results.timings["differences_seconds"] += compared - start
+                results.timings["aggregation_seconds"] += time.perf_counter() - compared
+            except Exception as e:
+                logging.error(f"Error analyzing file {audio_file_name}: {str(e)}")
+
     def compute_differences(self, ref_list, hyp_list):
+        """
+        Find the reference words missing from the hypothesis.
+
+        With `differences=counts` (default) this is the multiset difference of the reference and hypothesis words.
+        With `differences=alignment` it is the reference words deleted or substituted in the edit-distance alignment,
+        in reference order.
+        """
+        if self.differences_mode == "alignment":
+            ref_words = wer_engine.to_words(ref_list)
+            hyp_words = wer_engine.to_words(hyp_list)
+            return [ref_words[ref_pos] for op, ref_pos, _ in wer_engine.align(ref_words, hyp_words) if op != 'insert']
+
         #Simple set arithmetic does not work if the same word appears multiple times in the reference transcription
         #differences = list(set(cleaned_ref) - set(cleaned_hyp))
 
         differences = list()
-        for word in set(ref_list):
-            ref_count = ref_list.count(word)
-            hyp_count = hyp_list.count(word)
-            diff = ref_count - hyp_count
+        hyp_counts = Counter(hyp_list)
+        for word, ref_count in Counter(ref_list).items():
+            diff = ref_count - hyp_counts[word]
             if diff > 0:
-                for _ in range(diff):
-                    differences.append(word)
+                differences.extend([word] * diff)
         return differences
 
+def analyze_shard(config, items) -> AnalysisResults:
+    """
+    Analyze one shard of (audio file name, reference, hypothesis) tuples in a worker process.
+    """
+    results = AnalysisResults(config)
+    Analyzer(config).analyze_items(items, results)
+    return results
+
 def run(config_file:str, logging_level:str=DEFAULT_LOGLEVEL):
     try:
         logging.basicConfig(level=logging_level, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -299,18 +588,32 @@ def run(config_file:str, logging_level:str=DEFAULT_LOGLEVEL):
                 logging.error(f"Failed to create output directory {output_dir}: {str(e)}")
                 return
 
-        results = analyzer.analyze()
-        
+        metrics = MetricsRecorder.from_config(config)
+        metrics.serve()
+
         details_file = config.getValue("ErrorRateOutput", "details_file")
+        with metrics.timer("analysis_seconds"):
+            results = analyzer.analyze(details_file)
+
         if details_file:
-            results.write_details(details_file)
+            with metrics.timer("write_details_seconds"):
+                results.write_details(details_file)
             
         if summary_file:
-            results.write_summary(summary_file)
+            with metrics.timer("write_summary_seconds"):
+                results.write_summary(summary_file)
             
         word_accuracy_file = config.getValue("ErrorRateOutput", "word_accuracy_file")
         if word_accuracy_file:
-            results.write_word_accuracy(word_accuracy_file)
+            with metrics.timer("write_word_accuracy_seconds"):
+                results.write_word_accuracy(word_accuracy_file)
+
+        #Stage totals, summed over all files (and worker processes)
+        for stage, seconds in results.timings.items():
+            metrics.observe(stage, seconds)
+        metrics.increment("files_analyzed", results.sample_count)
+        metrics.write()
+        metrics.close()
     except Exception as e:
         logging.error(f"Unhandled exception in run: {str(e)}")
 
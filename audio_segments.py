@@ -0,0 +1,287 @@
+"""
+Splitting long recordings into segments that are transcribed concurrently, and stitching the segment
+transcriptions back into one transcription per recording.
+
+WAV files are read with the standard library `wave` module; other formats (Ogg, MP3, ...) and WAV
+encodings it cannot read are first decoded to WAV with `ffmpeg`, if it is installed.  Each cut is placed
+at the quietest point in the `silence_search_seconds` before a segment boundary, and consecutive segments
+can overlap by `overlap_seconds` so a word spoken across a cut is heard whole; the words transcribed
+twice are removed again when the segments are stitched.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import wave
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+DEFAULT_SEGMENT_SECONDS = 300
+DEFAULT_SILENCE_SEARCH_SECONDS = 10
+#Loudness is compared over frames of this length when looking for silence
+SILENCE_FRAME_SECONDS = 0.02
+COPY_BLOCK_FRAMES = 1024 * 1024
+#Upper bound on speaking rate, to limit how far stitching looks for repeated words
+MAX_WORDS_PER_SECOND = 5
+SAMPLE_TYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+SEGMENTS_SUFFIX = ".segments"
+
+class AudioSegmenter:
+    """
+    Splits audio files longer than `min_seconds` into segments of about `segment_seconds` in `segment_dir`
+    (a temporary directory by default), and remembers which segments belong to which file.  Segment file
+    names only depend on the original file, so a checkpointed run can resume part way through a file.
+    Unless `keep_segments` is True (the default when a `segment_dir` is given), `close` removes the segments.
+    """
+
+    def __init__(self, segment_seconds: float = DEFAULT_SEGMENT_SECONDS, overlap_seconds: float = 0.0,
+                 silence_search_seconds: float = DEFAULT_SILENCE_SEARCH_SECONDS, min_seconds: Optional[float] = None,
+                 segment_dir: Optional[str] = None, keep_segments: Optional[bool] = None):
+        if segment_seconds <= 0 or overlap_seconds < 0 or overlap_seconds >= segment_seconds / 2:
+            raise ValueError(f"Invalid long audio segment length {segment_seconds}s with {overlap_seconds}s overlap")
+        self.segment_seconds = segment_seconds
+        self.overlap_seconds = overlap_seconds
+        self.silence_search_seconds = min(silence_search_seconds, segment_seconds / 2)
+        self.min_seconds = segment_seconds if min_seconds is None else min_seconds
+        self.keep_segments = segment_dir is not None if keep_segments is None else keep_segments
+        self.segment_dir = tempfile.mkdtemp(prefix="stt_segments_") if segment_dir is None else os.path.normpath(segment_dir)
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self.ffmpeg = shutil.which("ffmpeg")
+        self.ffprobe = shutil.which("ffprobe")
+        self.segments: Dict[str, List[str]] = {}
+        #Segment file to the file it was cut from and its start time in seconds
+        self.origins: Dict[str, Tuple[str, float]] = {}
+        if self.ffmpeg is None:
+            logging.warning("ffmpeg is not installed; only WAV files will be split into segments")
+
+    @classmethod
+    def from_config(cls, config) -> Optional["AudioSegmenter"]:
+        """
+        Create the segmenter configured by the `long_audio*` keys under [Transcriptions].  A checkpointed run
+        without a `long_audio_segment_directory` splits into `<stt_transcriptions_file>.segments`, removed afterwards.
+
+        Returns:
+            AudioSegmenter, or None if long audio mode is off
+        """
+        if not config.getBoolean("Transcriptions", "long_audio"):
+            return None
+        min_seconds = config.getValue("Transcriptions", "long_audio_min_seconds")
+        segment_dir = config.getValue("Transcriptions", "long_audio_segment_directory") or None
+        keep_segments = None
+        if segment_dir is None and config.getBoolean("Transcriptions", "checkpoint"):
+            segment_dir = config.getValue("Transcriptions", "stt_transcriptions_file") + SEGMENTS_SUFFIX
+            keep_segments = False
+        return cls(float(config.getValue("Transcriptions", "long_audio_segment_seconds", DEFAULT_SEGMENT_SECONDS)),
+                   float(config.getValue("Transcriptions", "long_audio_overlap_seconds", 0.0)),
+                   float(config.getValue("Transcriptions", "long_audio_silence_search_seconds", DEFAULT_SILENCE_SEARCH_SECONDS)),
+                   float(min_seconds) if min_seconds else None,
+                   segment_dir, keep_segments)
+
+    def segment_files(self) -> Set[str]:
+        return {segment for segments in self.segments.values() for segment in segments}
+
+    def is_segment(self, filename: str) -> bool:
+        return os.path.dirname(filename) == self.segment_dir
+
+    def split_all(self, files: List[str]) -> List[str]:
+        """
+        Replace every long audio file in `files` by its segments, in order.
+        """
+        split_files = []
+        for filename in files:
+            split_files.extend(self.split(filename))
+        if len(self.segments) > 0:
+            logging.info(f"Split {len(self.segments)} long audio files into {len(self.segment_files())} segments in {self.segment_dir}")
+        return split_files
+
+    def split(self, filename: str) -> List[str]:
+        """
+        Split `filename` if it is longer than `min_seconds`.
+
+        Returns:
+            The segment files, or just `filename` if it is not split
+        """
+        try:
+            if filename.lower().endswith(".wav"):
+                try:
+                    return self.split_wav(filename, filename)
+                except (wave.Error, EOFError) as e:
+                    logging.debug(f"{filename} - Unable to read as PCM WAV ({e}), decoding with ffmpeg")
+            return self.split_decoded(filename)
+        except (OSError, subprocess.CalledProcessError) as e:
+            logging.warning(f"{filename} - Unable to split, transcribing it whole: {e}")
+            return [filename]
+
+    def split_decoded(self, filename: str) -> List[str]:
+        if self.ffmpeg is None:
+            logging.debug(f"{filename} - ffmpeg is not installed, transcribing it whole")
+            return [filename]
+        duration = self.probe_duration(filename)
+        if duration is not None and duration <= self.min_seconds:
+            return [filename]
+        decoded = os.path.join(self.segment_dir, self.segment_prefix(filename) + ".decoded.wav")
+        subprocess.run([self.ffmpeg, "-v", "error", "-y", "-i", filename, "-f", "wav", decoded], check=True, capture_output=True)
+        try:
+            return self.split_wav(decoded, filename)
+        finally:
+            os.remove(decoded)
+
+    def probe_duration(self, filename: str) -> Optional[float]:
+        """
+        Duration in seconds according to `ffprobe`, or None if it is unknown.
+        """
+        if self.ffprobe is None:
+            return None
+        try:
+            result = subprocess.run([self.ffprobe, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", filename],
+                                    check=True, capture_output=True, text=True)
+            return float(result.stdout.strip())
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            return None
+
+    def segment_prefix(self, filename: str) -> str:
+        #The path hash keeps equally named files from different folders apart
+        digest = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()[:8]
+        return f"{os.path.splitext(os.path.basename(filename))[0]}.{digest}"
+
+    def split_wav(self, wav_file: str, filename: str) -> List[str]:
+        """
+        Split PCM WAV `wav_file`, the audio of `filename`, into segment WAV files.
+        """
+        with wave.open(wav_file, 'rb') as wav:
+            rate = wav.getframerate()
+            nframes = wav.getnframes()
+            if nframes <= self.min_seconds * rate:
+                return [filename]
+
+            cuts = self.cut_points(wav)
+            overlap = int(self.overlap_seconds * rate)
+            prefix = self.segment_prefix(filename)
+            segments = []
+            for index, (start, end) in enumerate(zip([0] + cuts, cuts + [nframes])):
+                segment = os.path.join(self.segment_dir, f"{prefix}.{index:04d}.wav")
+                self.copy_frames(wav, segment, max(0, start - overlap), end)
+                self.origins[segment] = (filename, max(0, start - overlap) / rate)
+                segments.append(segment)
+        self.segments[filename] = segments
+        return segments
+
+    def cut_points(self, wav) -> List[int]:
+        """
+        Frame positions at which to cut, each at the quietest point shortly before a segment boundary.
+        """
+        rate = wav.getframerate()
+        nframes = wav.getnframes()
+        segment = int(self.segment_seconds * rate)
+        search = int(self.silence_search_seconds * rate)
+        cuts = []
+        position = 0
+        while nframes - position > segment:
+            target = position + segment
+            cut = self.quietest_frame(wav, target - search, target) if search > 0 else target
+            cuts.append(cut)
+            position = cut
+        return cuts
+
+    def quietest_frame(self, wav, start: int, end: int) -> int:
+        sample_type = SAMPLE_TYPES.get(wav.getsampwidth())
+        if sample_type is None:
+            return end
+        channels = wav.getnchannels()
+        frame = max(1, int(SILENCE_FRAME_SECONDS * wav.getframerate()))
+        wav.setpos(start)
+        samples = np.frombuffer(wav.readframes(end - start), dtype=sample_type).astype(np.float64)
+        if sample_type is np.uint8:
+            samples -= 128
+        count = len(samples) // (frame * channels)
+        if count == 0:
+            return end
+        energy = np.square(samples[:count * frame * channels]).reshape(count, frame * channels).mean(axis=1)
+        #Cut in the middle of the quiet stretch around the quietest frame
+        best = int(np.argmin(energy))
+        quiet = energy <= 2 * energy[best] + 1
+        first, last = best, best
+        while first > 0 and quiet[first - 1]:
+            first -= 1
+        while last < count - 1 and quiet[last + 1]:
+            last += 1
+        return start + (first + last + 1) * frame // 2
+
+    def copy_frames(self, wav, segment: str, start: int, end: int) -> None:
+        with wave.open(segment, 'wb') as out:
+            out.setnchannels(wav.getnchannels())
+            out.setsampwidth(wav.getsampwidth())
+            out.setframerate(wav.getframerate())
+            wav.setpos(start)
+            while start < end:
+                frames = min(COPY_BLOCK_FRAMES, end - start)
+                out.writeframes(wav.readframes(frames))
+                start += frames
+
+    def stitch(self, transcriptions, failures: Dict[str, tuple]) -> int:
+        """
+        Add the stitched transcription of every split file whose segments were all transcribed to
+        `transcriptions`, and report split files with failed segments in `failures` instead of the segments.
+
+        Returns:
+            Number of files stitched
+        """
+        data = transcriptions.getData()
+        max_overlap_words = int(self.overlap_seconds * MAX_WORDS_PER_SECOND) + 1 if self.overlap_seconds > 0 else 0
+        stitched = 0
+        for filename, segments in self.segments.items():
+            segment_failures = [failures.pop(segment) for segment in segments if segment in failures]
+            if all(segment in data for segment in segments):
+                transcriptions.add(filename, stitch_transcripts([data[segment] for segment in segments], max_overlap_words))
+                stitched += 1
+            elif len(segment_failures) > 0:
+                failures[filename] = max(segment_failures, key=lambda failure: failure[0])
+        return stitched
+
+    def close(self) -> None:
+        if not self.keep_segments:
+            shutil.rmtree(self.segment_dir, ignore_errors=True)
+
+def normalize_word(word: str) -> str:
+    return re.sub(r"[^\w']", "", word.lower())
+
+def find_overlap(tail: List[str], head: List[str]) -> Optional[Tuple[int, int, int]]:
+    """
+    Find the longest suffix of `tail` (ignoring up to one last word) that is a prefix of `head` (ignoring
+    up to one first word), at least two words long.
+
+    Returns:
+        (overlap length, ignored words at the end of tail, ignored words at the start of head), or None
+    """
+    for length in range(min(len(tail), len(head)), 1, -1):
+        for cut_tail, cut_head in ((0, 0), (1, 0), (0, 1), (1, 1)):
+            if length + cut_tail > len(tail) or length + cut_head > len(head):
+                continue
+            if tail[len(tail) - length - cut_tail:len(tail) - cut_tail] == head[cut_head:cut_head + length]:
+                return length, cut_tail, cut_head
+    return None
+
+def stitch_transcripts(transcripts: List[str], max_overlap_words: int = 0) -> str:
+    """
+    Join consecutive segment transcriptions.  When segments overlap, the longest run of (at least two)
+    words that ends one transcription and starts the next, within `max_overlap_words` words of the cut,
+    is kept only once.  The run may be followed by one more word at the end of the first transcription and
+    preceded by one at the start of the next, for words cut in two at either end of the overlap.
+    """
+    words: List[str] = []
+    for transcript in transcripts:
+        next_words = transcript.split()
+        if max_overlap_words > 0 and len(words) > 0 and len(next_words) > 0:
+            overlap = find_overlap([normalize_word(word) for word in words[-max_overlap_words:]],
+                                   [normalize_word(word) for word in next_words[:max_overlap_words]])
+            if overlap is not None:
+                length, cut_tail, cut_head = overlap
+                del words[len(words) - length - cut_tail:]
+                next_words = next_words[cut_head:]
+        words.extend(next_words)
+    return " ".join(words) + " " if len(words) > 0 else ""
@@ -0,0 +1,266 @@
+"""
+Batch transcription engine using the Speech to Text asynchronous recognition (jobs) interface.
+
+Instead of holding a recognize session open for every file, each file is uploaded with `create_job`
+and the service transcribes it in the background.  Outstanding jobs are polled with one `check_jobs`
+request per round, backing off while nothing finishes, and finished jobs are collected into the same
+`Transcriptions` object as the other engines.  Job IDs are appended to a state file
+(`stt_transcriptions_file` plus `.jobs.csv`) and results to the checkpoint journal, so the client can
+stop at any point and a later run collects the outstanding jobs instead of submitting their files again.
+"""
+
+import concurrent.futures
+import csv
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from transcribe import WEBSOCKET_ONLY_PARAMS
+from scheduler import TranscriptionScheduler
+
+JOBS_SUFFIX = ".jobs.csv"
+JOBS_COLUMNS = ['Audio File Name', 'Job ID', 'Status']
+SUBMITTED = "submitted"
+COLLECTED = "collected"
+FAILED = "failed"
+
+#check_jobs lists the 100 most recent jobs; jobs beyond those are checked one by one
+DEFAULT_MAX_OUTSTANDING_JOBS = 100
+DEFAULT_POLL_INTERVAL = 5.0
+DEFAULT_MAX_POLL_INTERVAL = 60.0
+
+class JobState:
+    """
+    Append-only record of the job submitted for each audio file and what became of it.
+    The last row for a file wins, so the file can be replayed after a restart.
+    """
+
+    def __init__(self, state_file: str):
+        self.state_file = state_file
+        self.jobs: Dict[str, Tuple[str, str]] = {}
+        self.lock = threading.Lock()
+        self.file = None
+        if os.path.exists(state_file):
+            with open(state_file, newline='', encoding='utf-8') as f:
+                reader = csv.reader(f)
+                next(reader, None)
+                for row in reader:
+                    if len(row) == 3:
+                        self.jobs[row[0]] = (row[1], row[2])
+
+    def record(self, filename: str, job_id: str, status: str) -> None:
+        with self.lock:
+            if self.file is None:
+                write_header = not os.path.exists(self.state_file) or os.path.getsize(self.state_file) == 0
+                self.file = open(self.state_file, 'a', newline='', encoding='utf-8')
+                if write_header:
+                    csv.writer(self.file).writerow(JOBS_COLUMNS)
+            csv.writer(self.file).writerow([filename, job_id, status])
+            self.file.flush()
+            self.jobs[filename] = (job_id, status)
+
+    def outstanding(self) -> Dict[str, str]:
+        """
+        Map the ID of each submitted but not yet collected job to its audio file.
+        """
+        with self.lock:
+            return {job_id: filename for filename, (job_id, status) in self.jobs.items() if status == SUBMITTED}
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+class BatchTranscriber:
+    """
+    Submits audio files as recognition jobs, keeping at most `max_outstanding` jobs at the service, and
+    collects their results.  Polling starts every `poll_interval` seconds and doubles, up to
+    `max_poll_interval`, while no job finishes.  Unless `wait` is set, `transcribe_all` returns after
+    one round of submitting and polling.
+    """
+
+    def __init__(self, transcriber, state: JobState, max_threads: int, sessions: Optional[threading.Semaphore] = None,
+                 max_outstanding: int = DEFAULT_MAX_OUTSTANDING_JOBS, poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 max_poll_interval: float = DEFAULT_MAX_POLL_INTERVAL, wait: bool = True):
+        self.transcriber = transcriber
+        self.STT = transcriber.STT
+        #Submissions run under the configured rate limit, retry policy and shared session limit
+        self.scheduler = TranscriptionScheduler.from_config(transcriber.config, self.submit, max_threads, sessions, transcriber.metrics)
+        self.state = state
+        self.max_threads = max_threads
+        self.max_outstanding = max_outstanding
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.wait = wait
+        recognize_params = transcriber.get_recognize_params()
+        self.recognize_params = recognize_params
+        self.job_params = {k: v for k, v in recognize_params.items() if k not in WEBSOCKET_ONLY_PARAMS}
+        self.cached = 0
+        self.lock = threading.Lock()
+
+    def submit(self, filename: str) -> Optional[Any]:
+        """
+        Create a recognition job for `filename`, unless its transcription is cached.
+
+        Returns:
+            None on success, otherwise the error that occurred
+        """
+        _, cached = self.transcriber.get_cached(filename, self.recognize_params)
+        if cached is not None:
+            self.transcriber.metrics.increment("cache_hits")
+            with self.lock:
+                self.cached += 1
+            return None
+        try:
+            with open(filename, "rb") as audio_file:
+                job = self.STT.create_job(audio=audio_file, content_type=self.transcriber.getAudioType(filename),
+                                          headers=self.transcriber.request_headers(filename), **self.job_params).get_result()
+        except Exception as e:
+            logging.debug(f"{filename} - Unable to create recognition job: {str(e)}")
+            return e
+        self.state.record(filename, job['id'], SUBMITTED)
+        logging.debug(f"{filename} - Submitted recognition job {job['id']}")
+        return None
+
+    def collect(self, job_id: str, filename: str, status: Optional[str] = None) -> bool:
+        """
+        Fetch a job and, if it has finished, store its transcription or failure and delete it at the service.
+        `status` is the job's status if already known from `check_jobs`.
+
+        Returns:
+            True if the job has finished
+        """
+        try:
+            if status is not None and status not in ("completed", "failed"):
+                return False
+            job = self.STT.check_job(job_id).get_result()
+        except Exception as e:
+            if getattr(e, "code", None) == 404:
+                self.fail(job_id, filename, "Recognition job no longer exists")
+                return True
+            logging.warning(f"{filename} - Unable to check recognition job {job_id}: {str(e)}")
+            return False
+
+        if job['status'] == "completed":
+            callback = self.transcriber.make_callback(filename)
+            callback.on_data({'results': [result for chunk in job.get('results', []) for result in chunk.get('results', [])]})
+            if self.transcriber.get_outcome(callback) is not None:
+                self.fail(job_id, filename, "Recognition job completed without results")
+                return True
+            self.transcriber.store_cached(self.cache_key(filename), callback)
+            self.state.record(filename, job_id, COLLECTED)
+        elif job['status'] == "failed":
+            self.fail(job_id, filename, job.get('warnings') or "Recognition job failed")
+        else:
+            return False
+
+        try:
+            self.STT.delete_job(job_id)
+        except Exception as e:
+            logging.debug(f"{filename} - Unable to delete recognition job {job_id}: {str(e)}")
+        return True
+
+    def cache_key(self, filename: str) -> Optional[str]:
+        if self.transcriber.cache is None:
+            return None
+        try:
+            return self.transcriber.cache.make_key(filename, dict(self.recognize_params, content_type=self.transcriber.getAudioType(filename)))
+        except OSError:
+            return None
+
+    def fail(self, job_id: str, filename: str, error: Any) -> None:
+        logging.error(f"{filename} - Recognition job {job_id} failed: {error}")
+        self.transcriber.failures[filename] = (1, error)
+        self.transcriber.metrics.increment("failures")
+        self.state.record(filename, job_id, FAILED)
+
+    def poll(self, outstanding: Dict[str, str]) -> int:
+        """
+        Check the outstanding jobs, with a single `check_jobs` request when they fit in its listing,
+        and collect the finished ones.
+
+        Returns:
+            Number of jobs that finished
+        """
+        statuses: Dict[str, Optional[str]] = {job_id: None for job_id in outstanding}
+        try:
+            listed = self.STT.check_jobs().get_result().get('recognitions', [])
+            for job in listed:
+                if job['id'] in statuses:
+                    statuses[job['id']] = job['status']
+        except Exception as e:
+            logging.warning(f"Unable to list recognition jobs: {str(e)}")
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            futures = [executor.submit(self.collect, job_id, outstanding[job_id], status) for job_id, status in statuses.items()]
+            return sum(1 for future in futures if future.result())
+
+    def transcribe_all(self, files: List[str]) -> int:
+        """
+        Submit the files without an outstanding job and collect all outstanding jobs for `files`.
+
+        Returns:
+            Number of files finished (collected or failed) in this run
+        """
+        wanted = set(files)
+        outstanding = {job_id: filename for job_id, filename in self.state.outstanding().items() if filename in wanted}
+        submitted = set(outstanding.values())
+        pending = [file for file in files if file not in submitted]
+        if len(outstanding) > 0:
+            logging.info(f"Resuming collection of {len(outstanding)} outstanding recognition jobs from {self.state.state_file}")
+
+        finished = 0
+        interval = self.poll_interval
+        while True:
+            room = self.max_outstanding - len(outstanding)
+            if room > 0 and len(pending) > 0:
+                batch, pending = pending[:room], pending[room:]
+                self.scheduler.run(batch)
+                finished += len(self.scheduler.failures)
+                self.transcriber.failures.update(self.scheduler.failures)
+                self.scheduler.failures.clear()
+                logging.info(f"Submitted {len(batch)} recognition jobs, {len(pending)} files left to submit")
+
+            outstanding = {job_id: filename for job_id, filename in self.state.outstanding().items() if filename in wanted}
+            if len(outstanding) == 0 and len(pending) == 0:
+                break
+            if self.wait:
+                time.sleep(interval)
+            done = self.poll(outstanding) if len(outstanding) > 0 else 0
+            finished += done
+            interval = self.poll_interval if done > 0 else min(2 * interval, self.max_poll_interval)
+            outstanding = {job_id: filename for job_id, filename in self.state.outstanding().items() if filename in wanted}
+            logging.info(f"{done} recognition jobs finished, {len(outstanding)} outstanding")
+            if not self.wait:
+                if len(outstanding) > 0 or len(pending) > 0:
+                    logging.info(f"Exiting with {len(outstanding)} outstanding jobs and {len(pending)} files not submitted; run again to continue")
+                break
+
+        self.state.close()
+        return finished + self.cached
+
+def transcribe_files(transcriber, files: List[str], max_threads: int, sessions: Optional[threading.Semaphore] = None) -> int:
+    """
+    Transcribe `files` as recognition jobs, storing results in `transcriber.transcriptions`.
+
+    Args:
+        transcriber: Configured `transcribe.Transcriber`
+        files: Audio file paths
+        max_threads: Number of threads uploading audio and collecting results
+        sessions: Optional semaphore limiting concurrent uploads across concurrent runs
+
+    Returns:
+        Number of files finished
+    """
+    config = transcriber.config
+    state = JobState(config.getValue("Transcriptions", "stt_transcriptions_file") + JOBS_SUFFIX)
+    batch = BatchTranscriber(transcriber, state, max_threads, sessions,
+                             int(config.getValue("SpeechToText", "batch_max_outstanding_jobs", DEFAULT_MAX_OUTSTANDING_JOBS)),
+                             float(config.getValue("SpeechToText", "batch_poll_interval", DEFAULT_POLL_INTERVAL)),
+                             float(config.getValue("SpeechToText", "batch_max_poll_interval", DEFAULT_MAX_POLL_INTERVAL)),
+                             config.getValue("SpeechToText", "batch_wait", "True") == "True")
+    logging.info(f"Transcribing {len(files)} files as recognition jobs, up to {batch.max_outstanding} at a time")
+    return batch.transcribe_all(files)
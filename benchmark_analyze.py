@@ -0,0 +1,209 @@
+"""
+Benchmark analysis throughput across corpus sizes.
+
+Generates synthetic reference and hypothesis CSVs with a controllable word error rate and utterance
+length, then for each size runs, in fresh processes:
+* a staged run timing `load_csv`, the transformation pipeline, the measures, `compute_differences`,
+  `AnalysisResults.add`, `write_details`, `write_summary` and `write_word_accuracy` separately
+* an end-to-end `Analyzer.analyze` run with the configured `[Analysis]` options
+
+Elapsed seconds and peak RSS of each run are written to a JSON file, with the git revision, so results
+can be compared between versions.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from typing import Dict, List
+
+import jiwer
+import numpy as np
+
+from config import Config
+from analyze import Analyzer, AnalysisResult, AnalysisResults
+import wer_engine
+
+DEFAULT_CONFIG_INI='config.ini.sample'
+DEFAULT_LOGLEVEL='INFO'
+DEFAULT_OUTPUT_FILE='benchmark_analyze.json'
+DEFAULT_ROWS="1000,10000,100000"
+
+def make_vocabulary(size: int, rng: np.random.Generator) -> List[str]:
+    letters = np.array(list("abcdefghijklmnopqrstuvwxyz"))
+    return ["".join(rng.choice(letters, rng.integers(2, 11))) for _ in range(size)]
+
+def write_corpus(reference_file: str, hypothesis_file: str, rows: int, words_per_utterance: int,
+                 error_rate: float, vocabulary_size: int, seed: int) -> None:
+    """
+    Write `rows` synthetic utterances with Zipf-distributed words.  Each reference word is substituted,
+    deleted or followed by an inserted word with probability `error_rate` / 3 each.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = make_vocabulary(vocabulary_size, rng)
+    with open(reference_file, 'w', newline='') as ref_csv, open(hypothesis_file, 'w', newline='') as hyp_csv:
+        ref_writer, hyp_writer = csv.writer(ref_csv), csv.writer(hyp_csv)
+        ref_writer.writerow(['Audio File Name', 'Reference'])
+        hyp_writer.writerow(['Audio File Name', 'Transcription'])
+        for row in range(rows):
+            length = int(rng.integers(1, 2 * words_per_utterance))
+            word_ids = (rng.zipf(1.3, length) - 1) % vocabulary_size
+            edits = rng.random(length)
+            replacements = rng.integers(0, vocabulary_size, length)
+            ref_words, hyp_words = [], []
+            for word_id, edit, replacement in zip(word_ids, edits, replacements):
+                word = vocabulary[word_id]
+                ref_words.append(word)
+                if edit < error_rate / 3:
+                    hyp_words.append(vocabulary[replacement])
+                elif edit < 2 * error_rate / 3:
+                    continue
+                else:
+                    hyp_words.append(word)
+                    if edit < error_rate:
+                        hyp_words.append(vocabulary[replacement])
+            name = f"./audio_{row:07d}.wav"
+            ref_writer.writerow([name, " ".join(ref_words).capitalize() + "."])
+            hyp_writer.writerow([name, " ".join(hyp_words) + " "])
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def run_stages(config_file: str, output_dir: str) -> Dict[str, float]:
+    """
+    Run the analysis one stage at a time over the whole corpus, timing each stage.
+    """
+    config = Config(config_file)
+    analyzer = Analyzer(config)
+    timings = {}
+
+    start = time.perf_counter()
+    references = analyzer.load_csv(config.getValue("Transcriptions", "reference_transcriptions_file"), ["Audio File Name", "Reference"])
+    hypotheses = analyzer.load_csv(config.getValue("Transcriptions", "stt_transcriptions_file"), ["Audio File Name", "Transcription"])
+    timings["load_csv"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cleaned = []
+    for name, reference in references.items():
+        cleaned.append((name, analyzer.normalizer(reference), analyzer.normalizer(hypotheses[name])))
+    timings["transform"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    if (config.getValue("Analysis", "engine", "jiwer") or "jiwer") == "batch":
+        batch_size = int(config.getValue("Analysis", "batch_size", wer_engine.DEFAULT_BATCH_SIZE))
+        measures = wer_engine.batch_measures([(wer_engine.to_words(ref), wer_engine.to_words(hyp)) for _, ref, hyp in cleaned], batch_size)
+    else:
+        measures = [jiwer.compute_measures(ref, hyp) for _, ref, hyp in cleaned]
+    timings["measures"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    differences = [analyzer.compute_differences(ref, hyp) for _, ref, hyp in cleaned]
+    timings["compute_differences"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = AnalysisResults(config)
+    for (name, ref, hyp), measure, difference in zip(cleaned, measures, differences):
+        results.add(AnalysisResult(name, references[name], hypotheses[name], " ".join(ref), " ".join(hyp), measure, difference))
+    timings["add"] = time.perf_counter() - start
+
+    for stage, write in [("write_details", results.write_details), ("write_summary", results.write_summary),
+                         ("write_word_accuracy", results.write_word_accuracy)]:
+        start = time.perf_counter()
+        write(os.path.join(output_dir, stage))
+        timings[stage] = time.perf_counter() - start
+
+    timings["total"] = sum(timings.values())
+    timings["peak_rss_mb"] = peak_rss_mb()
+    return timings
+
+def run_end_to_end(config_file: str, output_dir: str) -> Dict[str, float]:
+    """
+    Run `Analyzer.analyze` and write all outputs, as `analyze.run` does.
+    """
+    config = Config(config_file)
+    details_file = os.path.join(output_dir, "details.csv")
+    start = time.perf_counter()
+    results = Analyzer(config).analyze(details_file)
+    results.write_details(details_file)
+    results.write_summary(os.path.join(output_dir, "summary.json"))
+    results.write_word_accuracy(os.path.join(output_dir, "word_accuracy.csv"))
+    return {"total": time.perf_counter() - start, "peak_rss_mb": peak_rss_mb(), "samples": results.sample_count}
+
+def in_fresh_process(function, *args):
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(function, *args).result()
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run(args):
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    config = Config(args.config_file)
+    for option in args.analysis or []:
+        key, value = option.split("=", 1)
+        config.setValue("Analysis", key, value)
+
+    report = {"revision": git_revision(), "python": platform.python_version(), "platform": platform.platform(),
+              "words_per_utterance": args.words_per_utterance, "error_rate": args.error_rate,
+              "vocabulary_size": args.vocabulary_size, "seed": args.seed,
+              "analysis": dict(config.config["Analysis"]) if "Analysis" in config.config else {},
+              "results": []}
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        work_dir = args.work_dir or tmpdir
+        for rows in [int(r) for r in args.rows.split(",")]:
+            size_dir = os.path.join(work_dir, str(rows))
+            os.makedirs(size_dir, exist_ok=True)
+            reference_file = os.path.join(size_dir, "reference_transcriptions.csv")
+            hypothesis_file = os.path.join(size_dir, "stt_transcriptions.csv")
+            logging.info(f"Generating {rows} rows")
+            write_corpus(reference_file, hypothesis_file, rows, args.words_per_utterance, args.error_rate, args.vocabulary_size, args.seed)
+
+            config.setValue("Transcriptions", "reference_transcriptions_file", reference_file)
+            config.setValue("Transcriptions", "stt_transcriptions_file", hypothesis_file)
+            size_config_file = os.path.join(size_dir, "config.ini")
+            config.writeFile(size_config_file)
+
+            result = {"rows": rows}
+            if not args.skip_stages:
+                result["stages"] = in_fresh_process(run_stages, size_config_file, size_dir)
+                logging.info(f"{rows} rows, stages: " + ", ".join(f"{k} {v:.2f}" for k, v in result["stages"].items()))
+            result["end_to_end"] = in_fresh_process(run_end_to_end, size_config_file, size_dir)
+            result["end_to_end"]["rows_per_second"] = rows / result["end_to_end"]["total"]
+            logging.info(f"{rows} rows, end to end: {result['end_to_end']['total']:.2f}s, "
+                         f"{result['end_to_end']['rows_per_second']:.0f} rows/sec, peak RSS {result['end_to_end']['peak_rss_mb']:.1f} MB")
+            report["results"].append(result)
+
+    with open(args.output_file, 'w') as jsonfile:
+        json.dump(report, jsonfile, indent=2)
+    logging.info(f"Wrote benchmark results to {args.output_file}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-c', '--config_file', type=str, default=DEFAULT_CONFIG_INI, help='base config file for the [Transformations] and [Analysis] settings')
+    parser.add_argument('--rows', type=str, default=DEFAULT_ROWS, help='comma-separated corpus sizes')
+    parser.add_argument('--words_per_utterance', type=int, default=12, help='mean reference utterance length in words')
+    parser.add_argument('--error_rate', type=float, default=0.15, help='probability of an error per reference word')
+    parser.add_argument('--vocabulary_size', type=int, default=20000, help='number of distinct words')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for the corpus')
+    parser.add_argument('--analysis', type=str, nargs='*', help='[Analysis] overrides, e.g. engine=batch workers=4')
+    parser.add_argument('--skip_stages', action='store_true', help='only run the end-to-end analysis')
+    parser.add_argument('--work_dir', type=str, help='keep the generated corpora and outputs in this directory')
+    parser.add_argument('-o', '--output_file', type=str, default=DEFAULT_OUTPUT_FILE, help='JSON results file')
+    parser.add_argument(
+        '-ll', '--log_level', type=str, default=DEFAULT_LOGLEVEL, help='the log level to use')
+
+    run(parser.parse_args())
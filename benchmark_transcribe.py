@@ -0,0 +1,165 @@
+"""
+Benchmark `transcribe.run` against the local mock Speech to Text server.
+
+Generates synthetic WAV files and a matching reference file, starts `mock_stt_server.MockSTTServer`,
+and transcribes all files once per `max_threads` value, each run in a fresh process.  Reports files per
+second, p50/p99 session latency as seen by the server, peak memory of the transcribing process and
+how many transcripts came back correct.  No Speech to Text quota is used.
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import logging
+import os
+import random
+import resource
+import struct
+import tempfile
+import time
+import wave
+from typing import Dict, List
+
+import numpy as np
+
+from config import Config
+from mock_stt_server import MockSTTServer, load_transcripts
+import transcribe
+
+DEFAULT_CONFIG_INI='config.ini.sample'
+DEFAULT_LOGLEVEL='INFO'
+DEFAULT_OUTPUT_FILE='benchmark_transcribe.json'
+SAMPLE_RATE=16000
+
+def write_audio_files(audio_dir: str, reference_file: str, num_files: int, audio_seconds: float) -> None:
+    """
+    Write `num_files` mono 16 kHz WAV files of low-level noise, all different, and their reference file.
+    """
+    os.makedirs(audio_dir, exist_ok=True)
+    frames = int(audio_seconds * SAMPLE_RATE)
+    with open(reference_file, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow(['Audio File Name', 'Reference'])
+        for i in range(num_files):
+            filename = os.path.join(audio_dir, f"benchmark_{i:06d}.wav")
+            rng = random.Random(i)
+            with wave.open(filename, 'wb') as wav:
+                wav.setnchannels(1)
+                wav.setsampwidth(2)
+                wav.setframerate(SAMPLE_RATE)
+                wav.writeframes(struct.pack(f"<{frames}h", *(rng.randint(-64, 64) for _ in range(frames))))
+            writer.writerow([filename, f"benchmark file number {i}"])
+
+def run_trial(config_file: str, logging_level: str) -> Dict[str, float]:
+    """
+    Transcribe in this (fresh) process and report elapsed time and peak memory.
+    """
+    logging.getLogger().setLevel(logging_level)
+    start = time.monotonic()
+    transcribe.run(config_file, logging_level)
+    return {"seconds": time.monotonic() - start,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+def count_correct(stt_transcriptions_file: str, reference_file: str) -> int:
+    with open(reference_file, encoding='utf-8-sig') as f:
+        references = {row["Audio File Name"]: row["Reference"] for row in csv.DictReader(f)}
+    with open(stt_transcriptions_file, encoding='utf-8-sig') as f:
+        return sum(1 for row in csv.DictReader(f) if references.get(row["Audio File Name"]) == row["Transcription"].strip())
+
+def benchmark(config_file: str, thread_counts: List[int], num_files: int, audio_seconds: float, transcription_mode: str,
+              server: MockSTTServer, work_dir: str, logging_level: str, transport: str = "websocket") -> List[Dict[str, float]]:
+    audio_dir = os.path.join(work_dir, "audio")
+    reference_file = os.path.join(work_dir, "reference_transcriptions.csv")
+    write_audio_files(audio_dir, reference_file, num_files, audio_seconds)
+    server.transcripts = load_transcripts(reference_file, audio_dir)
+
+    results = []
+    for max_threads in thread_counts:
+        trial_dir = os.path.join(work_dir, f"{transcription_mode}_{transport}_{max_threads}")
+        os.makedirs(trial_dir, exist_ok=True)
+        stt_transcriptions_file = os.path.join(trial_dir, "stt_transcriptions.csv")
+
+        config = Config(config_file)
+        config.setValue("SpeechToText", "service_url", server.http_url if transport == "http" else server.url)
+        config.setValue("SpeechToText", "transport", transport)
+        config.setValue("SpeechToText", "bearer_token", "benchmark")
+        config.setValue("SpeechToText", "max_threads", str(max_threads))
+        config.setValue("SpeechToText", "max_concurrent_sessions", str(max_threads))
+        config.setValue("SpeechToText", "transcription_mode", transcription_mode)
+        config.setValue("Transcriptions", "audio_file_folder", audio_dir)
+        config.setValue("Transcriptions", "reference_transcriptions_file", reference_file)
+        config.setValue("Transcriptions", "stt_transcriptions_file", stt_transcriptions_file)
+        config.setValue("Transcriptions", "cache_directory", "")
+        config.setValue("Transcriptions", "checkpoint", "False")
+        config.setValue("ErrorRateOutput", "summary_file", os.path.join(trial_dir, "wer_summary.json"))
+        trial_config_file = os.path.join(trial_dir, "config.ini")
+        config.writeFile(trial_config_file)
+
+        server.reset_stats()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as executor:
+            trial = executor.submit(run_trial, trial_config_file, logging_level).result()
+
+        session_times = np.array(server.session_times) if len(server.session_times) > 0 else np.zeros(1)
+        result = {"transcription_mode": transcription_mode,
+                  "transport": transport,
+                  "max_threads": max_threads,
+                  "files": num_files,
+                  "seconds": round(trial["seconds"], 3),
+                  "files_per_second": round(num_files / trial["seconds"], 2),
+                  "p50_latency_seconds": round(float(np.percentile(session_times, 50)), 4),
+                  "p99_latency_seconds": round(float(np.percentile(session_times, 99)), 4),
+                  "peak_rss_mb": round(trial["peak_rss_mb"], 1),
+                  "correct_transcripts": count_correct(stt_transcriptions_file, reference_file),
+                  "rejected_connections": server.rejected,
+                  "injected_errors": server.errors}
+        if transport == "http":
+            result["http_connections"] = server.http_connections
+        logging.info(f"max_threads={max_threads}: {result['files_per_second']} files/sec, p50 {result['p50_latency_seconds']}s, "
+                     f"p99 {result['p99_latency_seconds']}s, peak RSS {result['peak_rss_mb']} MB, {result['correct_transcripts']}/{num_files} correct")
+        results.append(result)
+    return results
+
+def run(args):
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+
+    server = MockSTTServer(args.host, args.port, latency=args.latency, latency_jitter=args.latency_jitter,
+                           real_time_factor=args.real_time_factor, error_rate=args.error_rate,
+                           throttle_rate=args.throttle_rate, max_sessions=args.max_sessions, seed=0,
+                           http_port=0 if args.transport == "http" else None).start()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            thread_counts = [int(t) for t in args.max_threads.split(",")]
+            results = benchmark(args.config_file, thread_counts, args.num_files, args.audio_seconds, args.transcription_mode,
+                                server, args.work_dir or work_dir, "WARNING", args.transport)
+    finally:
+        server.stop()
+
+    with open(args.output_file, 'w') as jsonfile:
+        json.dump(results, jsonfile, indent=2)
+    logging.info(f"Wrote benchmark results to {args.output_file}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument(
+        '-c', '--config_file', type=str, default=DEFAULT_CONFIG_INI, help='base config file for the recognize parameters')
+    parser.add_argument('--max_threads', type=str, default="1,4,16", help='comma-separated max_threads values to benchmark')
+    parser.add_argument('--transcription_mode', type=str, default="threads", help='threads or asyncio')
+    parser.add_argument('--transport', type=str, default="websocket", help='websocket or http')
+    parser.add_argument('--num_files', type=int, default=200, help='number of synthetic audio files')
+    parser.add_argument('--audio_seconds', type=float, default=1.0, help='length of each synthetic audio file')
+    parser.add_argument('--latency', type=float, default=0.2, help='mock server latency per request in seconds')
+    parser.add_argument('--latency_jitter', type=float, default=0.05, help='up to this many extra random seconds of latency')
+    parser.add_argument('--real_time_factor', type=float, default=0.0, help='extra mock latency per second of audio')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='probability the mock server answers with an error')
+    parser.add_argument('--throttle_rate', type=float, default=0.0, help='probability the mock server rejects a connection with HTTP 429')
+    parser.add_argument('--max_sessions', type=int, help='mock server concurrent session limit')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='mock server interface')
+    parser.add_argument('--port', type=int, default=0, help='mock server port, 0 for any free port')
+    parser.add_argument('--work_dir', type=str, help='keep the generated audio and outputs in this directory')
+    parser.add_argument('-o', '--output_file', type=str, default=DEFAULT_OUTPUT_FILE, help='JSON results file')
+    parser.add_argument(
+        '-ll', '--log_level', type=str, default=DEFAULT_LOGLEVEL, help='the log level to use')
+
+    run(parser.parse_args())
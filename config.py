@@ -7,6 +7,7 @@ STT_SECTION_KEY="SpeechToText"
 TRANSCRIPTIONS_SECTION_KEY="Transcriptions"
 OUTPUT_SECTION_KEY="ErrorRateOutput"
 TRANSFORMATIONS_SECTION_KEY="Transformations"
+ANALYSIS_SECTION_KEY="Analysis"
 
 class Config:
     def __init__(self, config_file: str):
@@ -3,10 +3,18 @@ import os
 import sys
 import re
 import csv
+import io
+import itertools
 import json
 import logging
+import math
+import random
+import threading
+import time
+import concurrent.futures
 from shutil import copyfile
 from config import Config
+from metrics import MetricsRecorder
 import subprocess
 import os.path
 from os import path
@@ -25,85 +33,192 @@ class Experiments:
     def __init__(self, config, output_dir):
         self.config = config
         self.output_dir = output_dir
+        self.metrics = MetricsRecorder.from_config(config)
 
     def run_all_experiments(self, bias_range, weight_range, sds_range, bas_range, end_of_phrase_silence_time_range, max_threads, logging_level):
         weight_values = list(weight_range)
         sds_values = list(sds_range)
         bas_values = list(bas_range)
+        end_of_phrase_silence_time_values = list(end_of_phrase_silence_time_range)
+        exp_config_paths = []
         for bias in bias_range:
             for weight in weight_values:
                 for sds in sds_values:
                     for bas in bas_values:
-                        for end_of_phrase_silence_time in end_of_phrase_silence_time_range:
-                            
-                            end_of_phrase_silence_time = round(end_of_phrase_silence_time, 2)
-                            bias = round(bias, 2)
-                            weight = round(weight, 2)
-                            sds = round(sds, 2)
-                            bas = round(bas,2)
+                        for end_of_phrase_silence_time in end_of_phrase_silence_time_values:
+                            exp_config_paths.append(self.prepare_experiment(bias, weight, sds, bas, end_of_phrase_silence_time, max_threads))
 
-                            logging.info(f"Running Experiment -- Character Insertion Bias: {bias}, Customization Weight: {weight}, Speech Detector Sensitivity: {sds}, Background Audio Suppression: {bas}, End of Phrase Silence Time: {end_of_phrase_silence_time}")
-
-                            experiment_output_dir = self.output_dir + "/bias_" + str(bias) + "_weight_" + str(weight) + "_sds_" + str(sds) + "_bas_" + str(bas) + "_eofst_" + str(end_of_phrase_silence_time)
-                            os.makedirs(experiment_output_dir, exist_ok=True)
-
-                            exp_config_path = experiment_output_dir + "/" + self.config.config_file
-                            copyfile(self.config.config_file, exp_config_path)
-
-                            #Update config settings for the experiment
-                            exp_config = Config(exp_config_path)
-
-                            file_info = os.path.split(exp_config.getValue('ErrorRateOutput', 'details_file'))
-                            details_file = os.path.join(experiment_output_dir, file_info[1])
-                            exp_config.setValue('ErrorRateOutput', 'details_file', details_file)
-
-                            file_info = os.path.split(exp_config.getValue('ErrorRateOutput', 'summary_file'))
-                            summary_file = os.path.join(experiment_output_dir, file_info[1])
-                            exp_config.setValue('ErrorRateOutput', 'summary_file', summary_file)
-
-                            file_info = os.path.split(exp_config.getValue('ErrorRateOutput', 'word_accuracy_file'))
-                            word_accuracy_file = os.path.join(experiment_output_dir, file_info[1])
-                            exp_config.setValue('ErrorRateOutput', 'word_accuracy_file', word_accuracy_file)
-
-                            file_info = os.path.split(exp_config.getValue('Transcriptions', 'stt_transcriptions_file'))
-                            stt_transcriptions_file = os.path.join(experiment_output_dir, file_info[1])
-                            exp_config.setValue('Transcriptions', 'stt_transcriptions_file', stt_transcriptions_file)
-
-                            file_info = os.path.split(exp_config.getValue('ErrorRateOutput', 'stt_transcriptions_file'))
-                            stt_transcriptions_file = os.path.join(experiment_output_dir, file_info[1])
-                            exp_config.setValue('ErrorRateOutput', 'stt_transcriptions_file', stt_transcriptions_file)
-                                                    
-                            exp_config.setValue('SpeechToText', "max_threads", str(max_threads))
-
-                            exp_config.setValue('SpeechToText', "speech_detector_sensitivity", str(sds))
-                            exp_config.setValue('SpeechToText', "background_audio_suppression", str(bas))
-                            exp_config.setValue('SpeechToText', "character_insertion_bias", str(bias))
-                            exp_config.setValue('SpeechToText', "customization_weight", str(weight))
-                            exp_config.setValue('SpeechToText', "end_of_phrase_silence_time", str(end_of_phrase_silence_time))
-
-                            exp_config.writeFile(exp_config_path)
-
-                            #Get Transcriptions 
-                            transcribe.run(exp_config_path, logging_level)
-
-                            #Get Analysis
-                            if exp_config.getValue('ErrorRateOutput', 'sclite_directory') is None:
-                                analyze.run(exp_config_path, logging_level)
-                            else:
-                                optional_analyze_with_sclite.run(exp_config_path, logging_level)
-
-                            logging.info(f"Experiment Complete \n")
+        if (self.config.getValue("Experiments", "search", "grid") or "grid") == "halving":
+            self.run_halving(exp_config_paths, max_threads, logging_level)
+        else:
+            self.run_experiments(exp_config_paths, max_threads, logging_level)
+
+    def run_experiments(self, exp_config_paths, max_threads, logging_level, files=None, analysis=None):
+        """
+        Transcribe and analyze each experiment, several at a time if `parallel_experiments` is set.  With
+        `analysis_workers` set, finished experiments are analyzed at the same time as each other and as the
+        transcription of the next ones.
+
+        Args:
+            files: Audio files to transcribe instead of the whole `audio_file_folder`
+            analysis: Function analyzing an experiment's config file, `analyze_experiment` by default
+        """
+        analysis = analysis or analyze_experiment
+        parallel_experiments = int(self.config.getValue("Experiments", "parallel_experiments", 1) or 1)
+        analysis_workers = int(self.config.getValue("Experiments", "analysis_workers", 1) or 1)
+        if (parallel_experiments > 1 or analysis_workers > 1) and len(exp_config_paths) > 1:
+            max_sessions = int(self.config.getValue("Experiments", "max_concurrent_sessions", max_threads) or max_threads)
+            self.run_parallel(exp_config_paths, parallel_experiments, max_sessions, analysis_workers, logging_level, files, analysis)
+            return
+
+        for exp_config_path in exp_config_paths:
+            experiment_name = os.path.relpath(os.path.dirname(exp_config_path), self.output_dir)
+            logging.info(f"Running Experiment -- {experiment_name}")
+
+            #Get Transcriptions 
+            with self.metrics.timer("experiment_transcription_seconds", experiment_name):
+                transcribe.run(exp_config_path, logging_level, files=files)
+
+            #Get Analysis
+            with self.metrics.timer("experiment_analysis_seconds", experiment_name):
+                analysis(exp_config_path, logging_level)
+
+            logging.info(f"Experiment Complete \n")
+
+    def run_halving(self, exp_config_paths, max_threads, logging_level):
+        """
+        Successive halving: score every candidate on a small random subset of the audio files, keep the
+        best 1/`halving_eta` of them, and repeat on a subset `halving_eta` times larger until the subset
+        is the whole corpus.  Only the surviving candidates are transcribed on every file, in their usual
+        experiment directories, so `run_report` summarizes just those.  Each rung's subset contains the
+        previous one, so with a `cache_directory` earlier rungs' transcriptions are reused.
+        """
+        eta = int(self.config.getValue("Experiments", "halving_eta", 3) or 3)
+        fraction = float(self.config.getValue("Experiments", "halving_initial_fraction", 0.1) or 0.1)
+        finalists = int(self.config.getValue("Experiments", "halving_finalists", 1) or 1)
+        seed = int(self.config.getValue("Experiments", "halving_seed", 0) or 0)
+
+        audio_file_dir = self.config.getValue("Transcriptions", "audio_file_folder") or ""
+        files = sorted(transcribe.list_audio_files(audio_file_dir))
+        random.Random(seed).shuffle(files)
+
+        candidates = list(exp_config_paths)
+        rung = 0
+        rows = []
+        while len(candidates) > finalists and fraction < 1.0:
+            subset = files[:max(1, math.ceil(fraction * len(files)))]
+            rung_dir = os.path.join(self.output_dir, "rungs", f"rung_{rung}")
+            logging.info(f"Successive halving rung {rung}: {len(candidates)} candidates on {len(subset)} of {len(files)} files")
+
+            reference_file = write_reference_subset(self.config.getValue("Transcriptions", "reference_transcriptions_file"),
+                                                    subset, os.path.join(rung_dir, "reference_transcriptions.csv"))
+            rung_config_paths = [prepare_rung(path, rung, reference_file) for path in candidates]
+            #Rungs are scored like the final runs, with sclite if the experiments use it
+            self.run_experiments(rung_config_paths, max_threads, logging_level, subset, analyze_experiment)
+
+            scores = [(read_word_error_rate(rung_config_path), path) for rung_config_path, path in zip(rung_config_paths, candidates)]
+            scores.sort(key=lambda score: score[0])
+            keep = max(finalists, math.ceil(len(candidates) / eta))
+            for position, (wer, path) in enumerate(scores):
+                rows.append({"Rung": rung, "Files": len(subset), "Experiment": os.path.basename(os.path.dirname(path)),
+                             "Word Error Rate": wer, "Promoted": position < keep})
+            candidates = [path for _, path in scores[:keep]]
+
+            rung += 1
+            fraction *= eta
+
+        if len(rows) > 0:
+            rungs_file = os.path.join(self.output_dir, "halving_rungs.csv")
+            with open(rungs_file, 'w', newline='') as csvfile:
+                writer = csv.DictWriter(csvfile, fieldnames=list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
+            logging.info(f"Wrote successive halving results to {rungs_file}")
+
+        logging.info(f"Running {len(candidates)} of {len(exp_config_paths)} experiments on all files")
+        self.run_experiments(candidates, max_threads, logging_level)
+
+    def prepare_experiment(self, bias, weight, sds, bas, end_of_phrase_silence_time, max_threads):
+        """
+        Create the output directory and config file for one grid point.
+
+        Returns:
+            Path of the experiment's config file
+        """
+        end_of_phrase_silence_time = round(end_of_phrase_silence_time, 2)
+        bias = round(bias, 2)
+        weight = round(weight, 2)
+        sds = round(sds, 2)
+        bas = round(bas,2)
+
+        logging.info(f"Preparing Experiment -- Character Insertion Bias: {bias}, Customization Weight: {weight}, Speech Detector Sensitivity: {sds}, Background Audio Suppression: {bas}, End of Phrase Silence Time: {end_of_phrase_silence_time}")
+
+        experiment_output_dir = self.output_dir + "/bias_" + str(bias) + "_weight_" + str(weight) + "_sds_" + str(sds) + "_bas_" + str(bas) + "_eofst_" + str(end_of_phrase_silence_time)
+        os.makedirs(experiment_output_dir, exist_ok=True)
+
+        exp_config_path = experiment_output_dir + "/" + self.config.config_file
+        copyfile(self.config.config_file, exp_config_path)
+
+        #Update config settings for the experiment
+        exp_config = Config(exp_config_path)
+
+        redirect_outputs(exp_config, experiment_output_dir)
+        redirect_metrics(exp_config, experiment_output_dir)
+        share_reference_index(exp_config, self.output_dir)
+
+        exp_config.setValue('SpeechToText', "max_threads", str(max_threads))
+
+        exp_config.setValue('SpeechToText', "speech_detector_sensitivity", str(sds))
+        exp_config.setValue('SpeechToText', "background_audio_suppression", str(bas))
+        exp_config.setValue('SpeechToText', "character_insertion_bias", str(bias))
+        exp_config.setValue('SpeechToText', "customization_weight", str(weight))
+        exp_config.setValue('SpeechToText', "end_of_phrase_silence_time", str(end_of_phrase_silence_time))
+
+        exp_config.writeFile(exp_config_path)
+        return exp_config_path
+
+    def run_parallel(self, exp_config_paths, parallel_experiments, max_sessions, analysis_workers, logging_level, files=None, analysis=None):
+        """
+        Transcribe up to `parallel_experiments` grid points at once, sharing a budget of `max_sessions`
+        concurrent recognize sessions between them, and analyze each grid point in a separate process
+        pool as soon as its transcription finishes.
+        """
+        logging.info(f"Running {len(exp_config_paths)} experiments, {parallel_experiments} at a time with up to {max_sessions} concurrent recognize sessions")
+        sessions = threading.BoundedSemaphore(max_sessions)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_experiments) as transcribers, \
+             concurrent.futures.ProcessPoolExecutor(max_workers=analysis_workers) as analyzers:
+            transcriptions = {transcribers.submit(timed_call, transcribe.run, path, logging_level, sessions, files): path for path in exp_config_paths}
+            analyses = {}
+            for future in concurrent.futures.as_completed(transcriptions):
+                exp_config_path = transcriptions[future]
+                experiment_name = os.path.relpath(os.path.dirname(exp_config_path), self.output_dir)
+                try:
+                    self.metrics.observe("experiment_transcription_seconds", future.result(), experiment_name)
+                except (Exception, SystemExit) as e:
+                    #transcribe.run exits when an experiment has no audio files, which must not stop the others
+                    logging.error(f"Experiment {experiment_name} failed to transcribe: {describe_failure(e)}")
+                    continue
+                logging.info(f"Transcription complete for experiment {experiment_name}, starting analysis")
+                analyses[analyzers.submit(timed_call, analysis or analyze_experiment, exp_config_path, logging_level)] = experiment_name
+
+            for future in concurrent.futures.as_completed(analyses):
+                try:
+                    self.metrics.observe("experiment_analysis_seconds", future.result(), analyses[future])
+                    logging.info(f"Experiment Complete -- {analyses[future]}")
+                except (Exception, SystemExit) as e:
+                    logging.error(f"Experiment {analyses[future]} failed to analyze: {describe_failure(e)}")
 
     def run_report(self, output_dir, config):
         logging.debug(f"Generating summary report in {output_dir}")
 
         # Extract all summaries
-        if config.getValue('ErrorRateOutput', 'sclite_directory') is None:
+        if not optional_analyze_with_sclite.uses_sclite(config):
             lines = True 
             wer_summary_filename = os.path.split(config.getValue("ErrorRateOutput", "summary_file"))[1]
         else:
             lines = False
-            wer_summary_filename = 'sclite_wer_summary.json'
+            wer_summary_filename = optional_analyze_with_sclite.summary_filename(config)
             
         summary_files = glob.glob(f"{output_dir}/**/*{wer_summary_filename}")
 
@@ -111,17 +226,188 @@ class Experiments:
 
         f = open(summary_files[0])
         data = json.load(f)
-        df_all = pd.read_json(json.dumps(data), orient='records', lines=lines)
+        df_all = pd.read_json(io.StringIO(json.dumps(data)), orient='records', lines=lines)
 
         for file in summary_files[1:]:
             f = open(file)
             data = json.load(f)
-            df = pd.read_json(json.dumps(data), orient='records', lines=lines)
+            df = pd.read_json(io.StringIO(json.dumps(data)), orient='records', lines=lines)
             df_all = pd.concat([df_all, df], ignore_index=True)
         
         logging.info("\n"+df_all.to_markdown())
         df_all.to_csv(output_filename, index=False)
 
+    def run_transformation_experiments(self, logging_level):
+        """
+        Sweep the `[Transformations]` settings listed in `[TransformationExperiments]`: transcribe the audio
+        once with the base configuration, analyze that transcription once per combination of settings in
+        `transformations_<n>` directories, and write all variants' summaries to `transformation_summaries.csv`.
+        """
+        variants = transformation_variants(self.config)
+
+        logging.info(f"Transcribing once for {len(variants)} transformation experiments")
+        #The shared transcription keeps its own metrics, so it neither overwrites the experiment's nor competes for its port
+        transcription_dir = os.path.join(self.output_dir, "transcription")
+        os.makedirs(transcription_dir, exist_ok=True)
+        transcription_config = Config(self.config.config_file)
+        redirect_metrics(transcription_config, transcription_dir)
+        transcription_config_path = os.path.join(transcription_dir, os.path.basename(self.config.config_file))
+        transcription_config.writeFile(transcription_config_path)
+        with self.metrics.timer("experiment_transcription_seconds"):
+            transcribe.run(transcription_config_path, logging_level)
+        stt_transcriptions_file = self.config.getValue('Transcriptions', 'stt_transcriptions_file')
+
+        exp_config_paths = []
+        for number, variant in enumerate(variants):
+            experiment_output_dir = os.path.join(self.output_dir, f"transformations_{number}")
+            os.makedirs(experiment_output_dir, exist_ok=True)
+            logging.info(f"Preparing Transformation Experiment {number} -- {variant}")
+
+            exp_config = Config(self.config.config_file)
+            redirect_outputs(exp_config, experiment_output_dir)
+            redirect_metrics(exp_config, experiment_output_dir)
+            share_reference_index(exp_config, self.output_dir)
+            #All variants analyze the shared transcription
+            exp_config.setValue('Transcriptions', 'stt_transcriptions_file', stt_transcriptions_file)
+            for key, value in variant.items():
+                exp_config.setValue('Transformations', key, value)
+
+            exp_config_path = os.path.join(experiment_output_dir, os.path.basename(self.config.config_file))
+            exp_config.writeFile(exp_config_path)
+            exp_config_paths.append(exp_config_path)
+
+        analysis_workers = int(self.config.getValue("Experiments", "analysis_workers", 1) or 1)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=analysis_workers) as analyzers:
+            for exp_config_path, future in [(path, analyzers.submit(timed_call, analyze.run, path, logging_level)) for path in exp_config_paths]:
+                try:
+                    self.metrics.observe("experiment_analysis_seconds", future.result(), os.path.relpath(os.path.dirname(exp_config_path), self.output_dir))
+                except Exception as e:
+                    logging.error(f"Transformation experiment {exp_config_path} failed to analyze: {str(e)}")
+
+        rows = []
+        for number, (variant, exp_config_path) in enumerate(zip(variants, exp_config_paths)):
+            summary_file = Config(exp_config_path).getValue('ErrorRateOutput', 'summary_file')
+            try:
+                with open(summary_file) as f:
+                    summary = json.load(f)
+            except (OSError, ValueError) as e:
+                logging.error(f"No summary for transformation experiment {number} in {summary_file}: {str(e)}")
+                continue
+            rows.append({"Experiment": f"transformations_{number}", **variant, **summary})
+
+        if len(rows) == 0:
+            logging.error("No transformation experiments completed")
+            return
+
+        output_filename = os.path.join(self.output_dir, 'transformation_summaries.csv')
+        df_all = pd.DataFrame(rows)
+        logging.info("\n"+df_all.to_markdown())
+        df_all.to_csv(output_filename, index=False)
+
+def transformation_variants(config):
+    """
+    Every combination of the `|`-separated `[TransformationExperiments]` values, as dicts of `[Transformations]` settings.
+    """
+    keys = config.getKeys("TransformationExperiments") or []
+    values = [config.getValue("TransformationExperiments", key).split("|") for key in keys]
+    return [dict(zip(keys, combination)) for combination in itertools.product(*values)]
+
+def redirect_outputs(exp_config, output_dir):
+    """
+    Point every output file of `exp_config` into `output_dir`, keeping the file names.
+    """
+    for section, key in [('ErrorRateOutput', 'details_file'), ('ErrorRateOutput', 'summary_file'),
+                         ('ErrorRateOutput', 'word_accuracy_file'), ('Transcriptions', 'stt_transcriptions_file'),
+                         ('ErrorRateOutput', 'stt_transcriptions_file')]:
+        file_info = os.path.split(exp_config.getValue(section, key))
+        exp_config.setValue(section, key, os.path.join(output_dir, file_info[1]))
+
+def redirect_metrics(exp_config, output_dir):
+    """
+    Point the `[Metrics]` files of `exp_config` into `output_dir`; only the experiment itself serves `prometheus_port`.
+    """
+    for key in ['metrics_file', 'prometheus_file']:
+        value = exp_config.getValue('Metrics', key)
+        if value:
+            exp_config.setValue('Metrics', key, os.path.join(output_dir, os.path.basename(value)))
+    if exp_config.getValue('Metrics', 'prometheus_port'):
+        exp_config.setValue('Metrics', 'prometheus_port', '')
+
+def share_reference_index(exp_config, output_dir):
+    """
+    Let all experiments reuse one reference index in `output_dir`, unless the config sets its own.
+    """
+    if not exp_config.getValue('Analysis', 'reference_index_directory'):
+        exp_config.setValue('Analysis', 'reference_index_directory', os.path.join(output_dir, 'reference_index'))
+
+def describe_failure(e: BaseException) -> str:
+    return f"exited with status {e.code}" if isinstance(e, SystemExit) else str(e)
+
+def timed_call(function, *args):
+    """
+    Call `function` and return the seconds it took.
+    """
+    start = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - start
+
+def prepare_rung(exp_config_path, rung, reference_file):
+    """
+    Create the config for evaluating an experiment on a rung's subset of files, writing its outputs
+    two levels below the experiment directory so `run_report` does not pick them up.
+    """
+    rung_dir = os.path.join(os.path.dirname(exp_config_path), "rungs", f"rung_{rung}")
+    os.makedirs(rung_dir, exist_ok=True)
+
+    rung_config = Config(exp_config_path)
+    redirect_outputs(rung_config, rung_dir)
+    redirect_metrics(rung_config, rung_dir)
+    rung_config.setValue('Transcriptions', 'reference_transcriptions_file', reference_file)
+    rung_config_path = os.path.join(rung_dir, os.path.basename(exp_config_path))
+    rung_config.writeFile(rung_config_path)
+    return rung_config_path
+
+def write_reference_subset(reference_file, files, filename):
+    """
+    Copy the reference rows for `files` into `filename`.  Rows are matched on the file name alone,
+    since the audio files all come from the single `audio_file_folder`.
+    """
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    subset = set(os.path.basename(file) for file in files)
+    with open(reference_file, encoding='utf-8-sig') as infile, open(filename, 'w', newline='') as outfile:
+        reader = csv.DictReader(infile)
+        writer = csv.DictWriter(outfile, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        writer.writerows(row for row in reader if os.path.basename(row.get("Audio File Name") or "") in subset)
+    return filename
+
+def read_word_error_rate(exp_config_path):
+    """
+    The word error rate in the summary `analyze_experiment` wrote for an experiment: the analysis summary
+    file, or the sclite engine's summary next to the transcriptions when the experiment is scored with sclite.
+    """
+    exp_config = Config(exp_config_path)
+    if optional_analyze_with_sclite.uses_sclite(exp_config):
+        transcriptions_file = os.path.abspath(exp_config.getValue('Transcriptions', 'stt_transcriptions_file'))
+        summary_file = os.path.join(os.path.dirname(transcriptions_file), optional_analyze_with_sclite.summary_filename(exp_config))
+    else:
+        summary_file = exp_config.getValue('ErrorRateOutput', 'summary_file')
+    try:
+        with open(summary_file) as f:
+            summary = json.load(f)
+        #sclite's summary is a list of records
+        return (summary[0] if isinstance(summary, list) else summary)["Word Error Rate"]
+    except (OSError, ValueError, KeyError, IndexError) as e:
+        logging.error(f"No word error rate in {summary_file}: {str(e)}")
+        return math.inf
+
+def analyze_experiment(exp_config_path, logging_level):
+    exp_config = Config(exp_config_path)
+    if not optional_analyze_with_sclite.uses_sclite(exp_config):
+        analyze.run(exp_config_path, logging_level)
+    else:
+        optional_analyze_with_sclite.run(exp_config_path, logging_level)
+
 def drange(start, stop, step):
     r = start
     while r < stop:
@@ -139,8 +425,20 @@ def run(config_file:str, logging_level:str=DEFAULT_LOGLEVEL):
     if output_dir is None or len(output_dir) == 0:
         output_dir = "."
 
-    # build generators
     experiments = Experiments(config, output_dir)
+    experiments.metrics.serve()
+    try:
+        if config.getKeys("TransformationExperiments"):
+            experiments.run_transformation_experiments(logging_level)
+        else:
+            run_grid(config, experiments, output_dir, logging_level)
+    finally:
+        experiments.metrics.write()
+        experiments.metrics.close()
+
+def run_grid(config, experiments, output_dir, logging_level):
+
+    # build generators
     max_threads = int(config.getValue("SpeechToText","max_threads", 1))
     sds_min  = float(config.getValue("Experiments", "sds_min"))
     sds_max  = float(config.getValue("Experiments", "sds_max"))
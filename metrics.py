@@ -0,0 +1,169 @@
+"""
+Timing and throughput metrics for transcription, analysis and experiments.
+
+A `MetricsRecorder` collects observations (a metric name, a value and optionally the audio file or
+experiment it belongs to) and event counters.  Configured under [Metrics], it writes them to a JSON or
+CSV `metrics_file`, a Prometheus text-format `prometheus_file` (e.g. for the node exporter textfile
+collector), and can serve the Prometheus text format on `prometheus_port`.
+"""
+
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from array import array
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+METRIC_PREFIX = "stt_wer_"
+QUANTILES = (0.5, 0.9, 0.99)
+
+class MetricsRecorder:
+    """
+    Thread-safe collection of metric observations and counters.
+    """
+
+    def __init__(self, metrics_file: Optional[str] = None, prometheus_file: Optional[str] = None,
+                 prometheus_port: Optional[int] = None):
+        self.metrics_file = metrics_file
+        self.prometheus_file = prometheus_file
+        self.prometheus_port = prometheus_port
+        self.values: Dict[str, array] = {}
+        self.observations: List[Tuple[str, str, float]] = []
+        self.counters: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    @classmethod
+    def from_config(cls, config) -> "MetricsRecorder":
+        """
+        Create a recorder writing to the [Metrics] `metrics_file` and `prometheus_file`, and serving on `prometheus_port`.
+        """
+        port = config.getValue("Metrics", "prometheus_port")
+        return cls(config.getValue("Metrics", "metrics_file") or None,
+                   config.getValue("Metrics", "prometheus_file") or None,
+                   int(port) if port else None)
+
+    def observe(self, name: str, value: float, item: Optional[str] = None) -> None:
+        """
+        Record one value of metric `name`, for audio file or experiment `item` if given.
+        """
+        with self.lock:
+            self.values.setdefault(name, array('d')).append(value)
+            if item is not None and self.metrics_file is not None:
+                self.observations.append((item, name, value))
+
+    def increment(self, name: str, count: int = 1) -> None:
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + count
+
+    @contextmanager
+    def timer(self, name: str, item: Optional[str] = None):
+        """
+        Observe the seconds spent in the `with` block as metric `name`.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, item)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """
+        Count, sum, mean, max and quantiles of every metric.
+        """
+        with self.lock:
+            values = {name: np.frombuffer(v, dtype=np.float64).copy() for name, v in self.values.items()}
+        summary = {}
+        for name, v in values.items():
+            stats = {"count": len(v), "sum": float(v.sum()), "mean": float(v.mean()), "max": float(v.max())}
+            for q, value in zip(QUANTILES, np.quantile(v, QUANTILES)):
+                stats[f"p{int(q * 100)}"] = float(value)
+            summary[name] = stats
+        return summary
+
+    def prometheus_text(self) -> str:
+        lines = []
+        for name, stats in self.summary().items():
+            metric = METRIC_PREFIX + name
+            lines.append(f"# TYPE {metric} summary")
+            for q in QUANTILES:
+                lines.append(f'{metric}{{quantile="{q}"}} {stats[f"p{int(q * 100)}"]}')
+            lines.append(f"{metric}_sum {stats['sum']}")
+            lines.append(f"{metric}_count {stats['count']}")
+        with self.lock:
+            counters = dict(self.counters)
+        for name, count in counters.items():
+            metric = METRIC_PREFIX + name + "_total"
+            lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric} {count}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_file(self) -> None:
+        if self.prometheus_file is None:
+            return
+        #Write then rename, so a collector never reads a partial file
+        tmp_file = self.prometheus_file + ".tmp"
+        with open(tmp_file, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_file, self.prometheus_file)
+
+    def write_metrics_file(self) -> None:
+        if self.metrics_file is None:
+            return
+        if self.metrics_file.endswith(".csv"):
+            with open(self.metrics_file, 'w', newline='') as csvfile:
+                writer = csv.writer(csvfile)
+                writer.writerow(["Item", "Metric", "Value"])
+                with self.lock:
+                    writer.writerows(self.observations)
+                    writer.writerows(("", name + "_total", count) for name, count in self.counters.items())
+        else:
+            with self.lock:
+                observations = [{"item": item, "metric": name, "value": value} for item, name, value in self.observations]
+                counters = dict(self.counters)
+            with open(self.metrics_file, 'w') as jsonfile:
+                json.dump({"summary": self.summary(), "counters": counters, "observations": observations}, jsonfile, indent=2)
+        logging.info(f"Wrote metrics to {self.metrics_file}")
+
+    def write(self) -> None:
+        """
+        Write the configured metrics and Prometheus files.
+        """
+        self.write_metrics_file()
+        self.write_prometheus_file()
+
+    def serve(self) -> None:
+        """
+        Serve the Prometheus text format on `prometheus_port` from a background thread, if configured.
+        """
+        if self.prometheus_port is None or self.server is not None:
+            return
+        recorder = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = recorder.prometheus_text().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("", self.prometheus_port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logging.info(f"Serving Prometheus metrics on port {self.prometheus_port}")
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,395 @@
+"""
+Local stand-in for the Speech to Text recognize websocket interface.
+
+Speaks enough of the `/v1/recognize` websocket protocol for `transcribe.py` (both transcription modes)
+to run against it offline: a `start` message, binary audio, a `stop` message, then one final result.
+Optionally it also answers HTTP `POST /v1/recognize` requests (keep-alive) on a second port, for
+`transport=http`, and the asynchronous `/v1/recognitions` job interface, for `transcription_mode=batch`.  Transcripts are looked up by a hash of the audio so they can match a reference file, with a canned
+fallback.  Latency, injected errors, throttling and a session limit are configurable, and the time
+each session took is recorded for benchmarking.
+
+Point `service_url` at the server with any `bearer_token`, e.g. `service_url=ws://127.0.0.1:8765`, or
+`service_url=http://127.0.0.1:8766` for the HTTP interface.
+"""
+
+import argparse
+import asyncio
+import csv
+import hashlib
+import http
+import io
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+import wave
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+from typing import Dict, List, Optional
+
+from websockets.asyncio.server import serve
+
+DEFAULT_LOGLEVEL='INFO'
+DEFAULT_HOST='127.0.0.1'
+DEFAULT_PORT=8765
+DEFAULT_TRANSCRIPT="mock transcription"
+
+def audio_hash(audio: bytes) -> str:
+    return hashlib.sha256(audio).hexdigest()
+
+def load_transcripts(reference_file: str, audio_file_folder: str) -> Dict[str, str]:
+    """
+    Map the hash of each audio file in `audio_file_folder` to its reference transcription, matching
+    the reference file's `Audio File Name` column on the file name.
+    """
+    references = {}
+    with open(reference_file, encoding='utf-8-sig') as file:
+        for row in csv.DictReader(file):
+            references[os.path.basename(row["Audio File Name"])] = row["Reference"]
+
+    transcripts = {}
+    for name in os.listdir(audio_file_folder):
+        if name in references:
+            with open(os.path.join(audio_file_folder, name), 'rb') as audio_file:
+                transcripts[audio_hash(audio_file.read())] = references[name]
+    logging.info(f"Loaded {len(transcripts)} transcripts from {reference_file}")
+    return transcripts
+
+def audio_duration(audio: bytes) -> float:
+    """
+    Duration in seconds of WAV audio, or 0 if it cannot be determined.
+    """
+    try:
+        with wave.open(io.BytesIO(audio)) as wav:
+            return wav.getnframes() / wav.getframerate()
+    except (wave.Error, EOFError):
+        return 0.0
+
+class MockSTTServer:
+    """
+    Mock recognize websocket server.
+
+    Args:
+        transcripts: Transcript to return for each audio hash
+        default_transcript: Transcript for unknown audio
+        latency: Seconds between the `stop` message and the result
+        latency_jitter: Up to this many extra seconds, chosen at random
+        real_time_factor: Extra seconds of latency per second of (WAV) audio
+        error_rate: Probability of answering a session with an error message instead of a result
+        throttle_rate: Probability of rejecting a connection with HTTP 429
+        max_sessions: Reject connections with HTTP 429 while this many sessions are active
+        http_port: Also serve HTTP recognize requests on this port (0 for any free port)
+    """
+
+    def __init__(self, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, transcripts: Optional[Dict[str, str]] = None,
+                 default_transcript: str = DEFAULT_TRANSCRIPT, latency: float = 0.0, latency_jitter: float = 0.0,
+                 real_time_factor: float = 0.0, error_rate: float = 0.0, throttle_rate: float = 0.0,
+                 max_sessions: Optional[int] = None, seed: Optional[int] = None, http_port: Optional[int] = None):
+        self.host = host
+        self.port = port
+        self.transcripts = transcripts or {}
+        self.default_transcript = default_transcript
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.real_time_factor = real_time_factor
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.max_sessions = max_sessions
+        self.random = random.Random(seed)
+        self.http_port = http_port
+
+        self.active_sessions = 0
+        self.session_times: List[float] = []
+        self.rejected = 0
+        self.errors = 0
+        self.http_connections = 0
+        self.job_checks = 0
+        #Audio hash to the X-Global-Transaction-Id header of the last request for it
+        self.transaction_ids: Dict[str, str] = {}
+        #Job ID to [created, ready time, result or None for a failed job]
+        self.jobs: Dict[str, list] = {}
+        self.lock = threading.Lock()
+        self.loop = None
+        self.stopped = None
+        self.thread = None
+        self.http_server = None
+
+    @property
+    def url(self) -> str:
+        return f"ws://{self.host}:{self.port}"
+
+    @property
+    def http_url(self) -> str:
+        return f"http://{self.host}:{self.http_port}"
+
+    def reset_stats(self) -> None:
+        self.session_times = []
+        self.rejected = 0
+        self.errors = 0
+        self.http_connections = 0
+        self.job_checks = 0
+        self.transaction_ids = {}
+
+    def record_transaction_id(self, audio: bytes, headers) -> None:
+        transaction_id = headers.get("X-Global-Transaction-Id")
+        if transaction_id is not None:
+            with self.lock:
+                self.transaction_ids[audio_hash(audio)] = transaction_id
+
+    def job_status(self, job_id: str) -> Dict:
+        created, ready, result = self.jobs[job_id]
+        status = "processing" if time.time() < ready else "completed" if result is not None else "failed"
+        return {"id": job_id, "status": status, "created": created}
+
+    def reject(self) -> bool:
+        """
+        Decide whether to throttle a new session.
+        """
+        if (self.max_sessions is not None and self.active_sessions >= self.max_sessions) or self.random.random() < self.throttle_rate:
+            self.rejected += 1
+            return True
+        return False
+
+    def latency_for(self, audio: bytes) -> float:
+        return self.latency + self.random.uniform(0, self.latency_jitter) + self.real_time_factor * audio_duration(audio)
+
+    def result_for(self, audio: bytes, options: Optional[Dict] = None) -> Optional[Dict]:
+        """
+        The recognize result for `audio`, or None to inject an error.  With the `timestamps` or
+        `word_confidence` recognize options, words are spread evenly over the audio with confidence 1.
+        """
+        if self.random.random() < self.error_rate:
+            self.errors += 1
+            return None
+        transcript = self.transcripts.get(audio_hash(audio), self.default_transcript)
+        alternative = {"transcript": transcript + " ", "confidence": 1.0}
+        options = options or {}
+        words = transcript.split()
+        if str(options.get("timestamps")).lower() == "true" and len(words) > 0:
+            step = (audio_duration(audio) or len(words)) / len(words)
+            alternative["timestamps"] = [[word, round(i * step, 2), round((i + 1) * step, 2)] for i, word in enumerate(words)]
+        if str(options.get("word_confidence")).lower() == "true":
+            alternative["word_confidence"] = [[word, 1.0] for word in words]
+        return {"result_index": 0, "results": [{"final": True, "alternatives": [alternative]}]}
+
+    def process_request(self, connection, request):
+        with self.lock:
+            rejected = self.reject()
+        if rejected:
+            return connection.respond(http.HTTPStatus.TOO_MANY_REQUESTS, "Too many requests\n")
+        return None
+
+    async def handler(self, ws):
+        with self.lock:
+            self.active_sessions += 1
+        start = time.monotonic()
+        try:
+            start_message = json.loads(await ws.recv())
+            if start_message.get("action") != "start":
+                await ws.send(json.dumps({"error": "The first message must be a start action"}))
+                return
+            await ws.send(json.dumps({"state": "listening"}))
+
+            audio = bytearray()
+            async for message in ws:
+                if isinstance(message, bytes):
+                    audio.extend(message)
+                elif json.loads(message).get("action") == "stop":
+                    break
+
+            audio = bytes(audio)
+            self.record_transaction_id(audio, ws.request.headers)
+            await asyncio.sleep(self.latency_for(audio))
+
+            result = self.result_for(audio, start_message)
+            if result is None:
+                await ws.send(json.dumps({"error": "Injected mock server error"}))
+                return
+
+            await ws.send(json.dumps(result))
+            await ws.send(json.dumps({"state": "listening"}))
+            self.session_times.append(time.monotonic() - start)
+            await ws.wait_closed()
+        finally:
+            with self.lock:
+                self.active_sessions -= 1
+
+    async def serve_forever(self, ready: Optional[threading.Event] = None) -> None:
+        self.stopped = asyncio.Event()
+        async with serve(self.handler, self.host, self.port, process_request=self.process_request, max_size=None) as server:
+            self.port = server.sockets[0].getsockname()[1]
+            logging.info(f"Mock Speech to Text server listening on {self.url}")
+            if ready is not None:
+                ready.set()
+            await self.stopped.wait()
+
+    def http_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def setup(self):
+                super().setup()
+                with server.lock:
+                    server.http_connections += 1
+
+            def read_body(self) -> bytes:
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    body = bytearray()
+                    while True:
+                        size = int(self.rfile.readline().split(b";")[0], 16)
+                        chunk = self.rfile.read(size + 2)
+                        if size == 0:
+                            return bytes(body)
+                        body.extend(chunk[:-2])
+                return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+            def reply(self, status: int, body: Dict) -> None:
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def query(self) -> Dict[str, str]:
+                return dict(parse_qsl(urlsplit(self.path).query))
+
+            def do_POST(self):
+                audio = self.read_body()
+                server.record_transaction_id(audio, self.headers)
+                if self.path.startswith("/v1/recognitions"):
+                    self.create_job(audio)
+                    return
+                if not self.path.startswith("/v1/recognize"):
+                    self.reply(404, {"error": "Not Found", "code": 404})
+                    return
+                with server.lock:
+                    rejected = server.reject()
+                    if not rejected:
+                        server.active_sessions += 1
+                if rejected:
+                    self.reply(429, {"error": "Too many requests", "code": 429})
+                    return
+                start = time.monotonic()
+                try:
+                    time.sleep(server.latency_for(audio))
+                    result = server.result_for(audio, self.query())
+                    if result is None:
+                        self.reply(500, {"error": "Injected mock server error", "code": 500})
+                        return
+                    self.reply(200, result)
+                    server.session_times.append(time.monotonic() - start)
+                finally:
+                    with server.lock:
+                        server.active_sessions -= 1
+
+            def create_job(self, audio: bytes) -> None:
+                with server.lock:
+                    rejected = server.reject()
+                if rejected:
+                    self.reply(429, {"error": "Too many requests", "code": 429})
+                    return
+                job_id = uuid.uuid4().hex
+                created = datetime.now(timezone.utc).isoformat()
+                with server.lock:
+                    server.jobs[job_id] = [created, time.time() + server.latency_for(audio), server.result_for(audio, self.query())]
+                self.reply(201, {"id": job_id, "status": "waiting", "created": created})
+
+            def do_GET(self):
+                request = self.path.split("?")[0].rstrip("/")
+                job_id = request.rsplit("/", 1)[-1]
+                with server.lock:
+                    server.job_checks += 1
+                    if request == "/v1/recognitions":
+                        latest = sorted(server.jobs, key=lambda job_id: server.jobs[job_id][0], reverse=True)[:100]
+                        status, body = 200, {"recognitions": [server.job_status(job_id) for job_id in latest]}
+                    elif request.startswith("/v1/recognitions/") and job_id in server.jobs:
+                        status, body = 200, server.job_status(job_id)
+                        if body["status"] == "completed":
+                            body["results"] = [server.jobs[job_id][2]]
+                    else:
+                        status, body = 404, {"error": "Not Found", "code": 404}
+                self.reply(status, body)
+
+            def do_DELETE(self):
+                job_id = self.path.split("?")[0].rsplit("/", 1)[-1]
+                with server.lock:
+                    found = server.jobs.pop(job_id, None) is not None
+                if found:
+                    self.send_response(204)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                else:
+                    self.reply(404, {"error": "Not Found", "code": 404})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "MockSTTServer":
+        """
+        Run the server on a background thread.  With `port=0` a free port is chosen.
+        """
+        if self.http_port is not None:
+            self.http_server = ThreadingHTTPServer((self.host, self.http_port), self.http_handler())
+            self.http_server.daemon_threads = True
+            self.http_port = self.http_server.server_address[1]
+            threading.Thread(target=self.http_server.serve_forever, daemon=True).start()
+            logging.info(f"Mock Speech to Text HTTP server listening on {self.http_url}")
+        ready = threading.Event()
+
+        def run_loop():
+            self.loop = asyncio.new_event_loop()
+            self.loop.run_until_complete(self.serve_forever(ready))
+            self.loop.close()
+
+        self.thread = threading.Thread(target=run_loop, daemon=True)
+        self.thread.start()
+        ready.wait()
+        return self
+
+    def stop(self) -> None:
+        if self.http_server is not None:
+            self.http_server.shutdown()
+            self.http_server.server_close()
+            self.http_server = None
+        if self.loop is not None and self.stopped is not None:
+            self.loop.call_soon_threadsafe(self.stopped.set)
+            self.thread.join()
+
+def run(args):
+    logging.basicConfig(level=args.log_level, format='%(asctime)s - %(levelname)s - %(message)s')
+    transcripts = load_transcripts(args.reference_file, args.audio_file_folder) if args.reference_file else {}
+    server = MockSTTServer(args.host, args.port, transcripts, args.default_transcript, args.latency, args.latency_jitter,
+                           args.real_time_factor, args.error_rate, args.throttle_rate, args.max_sessions, args.seed, args.http_port)
+    if server.http_port is not None:
+        server.start()
+        server.thread.join()
+    else:
+        asyncio.run(server.serve_forever())
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--host', type=str, default=DEFAULT_HOST, help='interface to listen on')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help='port to listen on')
+    parser.add_argument('--http_port', type=int, help='also serve HTTP recognize requests on this port')
+    parser.add_argument('--reference_file', type=str, help='reference CSV whose transcriptions are returned for matching audio')
+    parser.add_argument('--audio_file_folder', type=str, default='.', help='folder with the audio files named in the reference CSV')
+    parser.add_argument('--default_transcript', type=str, default=DEFAULT_TRANSCRIPT, help='transcript returned for unknown audio')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before each result is returned')
+    parser.add_argument('--latency_jitter', type=float, default=0.0, help='up to this many extra random seconds of latency')
+    parser.add_argument('--real_time_factor', type=float, default=0.0, help='extra seconds of latency per second of WAV audio')
+    parser.add_argument('--error_rate', type=float, default=0.0, help='probability of answering with an error')
+    parser.add_argument('--throttle_rate', type=float, default=0.0, help='probability of rejecting a connection with HTTP 429')
+    parser.add_argument('--max_sessions', type=int, help='reject connections with HTTP 429 beyond this many concurrent sessions')
+    parser.add_argument('--seed', type=int, help='random seed for latency, errors and throttling')
+    parser.add_argument('-ll', '--log_level', type=str, default=DEFAULT_LOGLEVEL, help='the log level to use')
+
+    run(parser.parse_args())
@@ -2,47 +2,141 @@
 # sclite is an open source tool for analyzing STT results that uses a reference file to calculate substitutions,
 # deletions, insertions, Word Error Rate (WER), and Sentence Error Rate (SER) in a file (.sys). It also outputs a detailed
 # report (.dtl) and a string alignment file (.prf)
+#
+# Without `sclite_directory`, approximate scores are computed in-process (`sclite_engine=approximate`), without the
+# sclite executable: words are compared case-insensitively and aligned with sclite's default costs (substitution 4,
+# deletion 3, insertion 3), and a .sys summary and optional .prf alignments are written in sclite's layout.  These are
+# not sclite's numbers, so every output of this engine is named `approximate`.
 
 import argparse
+import concurrent.futures
+import contextlib
 import copy
+import csv
+import heapq
+import itertools
 import os
 import subprocess
-import json
 import sys
 import logging
+import tempfile
 from shutil import copyfile
 from os.path import join, dirname
+from typing import Dict, Iterator, List, Optional, Tuple
 from config import Config
+import wer_engine
 
 import pandas as pd
 
 DEFAULT_CONFIG_INI='config.ini'
 DEFAULT_LOGLEVEL='DEBUG'
 
+#Rows sorted in memory at a time when writing the CTM and STM files
+DEFAULT_SORT_CHUNK_ROWS = 100000
+
+#sclite's default alignment costs of a substitution, deletion and insertion
+SCLITE_WEIGHTS = (4, 3, 3)
+
+#Speaker of every segment in the STM file
+STM_SPEAKER = "0"
+
+#Summary of each engine, next to the transcriptions file
+SCLITE_SUMMARY_FILE = "sclite_wer_summary.json"
+APPROXIMATE_SUMMARY_FILE = "approximate_wer_summary.json"
+
+ENGINES = ("sclite", "approximate")
+
+def uses_sclite(config) -> bool:
+    """
+    True if analysis should produce sclite output, with the sclite executable or the approximate engine.
+    """
+    return config.getValue("ErrorRateOutput", "sclite_directory") is not None or config.getValue("ErrorRateOutput", "sclite_engine") is not None
+
+def engine_from_config(config) -> str:
+    """
+    The configured `sclite_engine`, by default `sclite` if `sclite_directory` is set and `approximate` otherwise.
+    """
+    engine = config.getValue("ErrorRateOutput", "sclite_engine")
+    if engine:
+        return engine
+    return "sclite" if config.getValue("ErrorRateOutput", "sclite_directory") else "approximate"
+
+def summary_filename(config) -> str:
+    """
+    Name of the summary file the configured engine writes next to the transcriptions file.
+    """
+    return SCLITE_SUMMARY_FILE if engine_from_config(config) == "sclite" else APPROXIMATE_SUMMARY_FILE
+
+def percent(count, total) -> float:
+    #sclite reports percentages with one decimal
+    return float(f"{100 * count / total:.1f}") if total > 0 else 0.0
+
+def summary_results(task, sentences, words, subs, dels, ins, sentence_errors) -> Dict[str, list]:
+    """
+    The summary of one scored corpus from its counts, as `write_summary` expects it.
+    """
+    return {'task':[task], 'sub':[percent(subs, words)], 'del':[percent(dels, words)], 'ins':[percent(ins, words)],
+            'wer':[percent(subs + dels + ins, words)], 'ser':[percent(sentence_errors, sentences)],
+            'words':[float(words)], 'sentences':[float(sentences)]}
+
+def iter_sorted(filename: str, columns: List[str], chunk_rows: int = DEFAULT_SORT_CHUNK_ROWS) -> Iterator[Tuple[str, ...]]:
+    """
+    Yield the `columns` of each row of a CSV file, sorted by the first column (ties keep file order).
+
+    Rows are sorted `chunk_rows` at a time.  A file with more rows is sorted externally: each sorted chunk
+    is written to a temporary file and the chunks are merged, so memory use does not grow with the file.
+    """
+    with open(filename, encoding='utf-8-sig', newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader, [])
+        missing = [column for column in columns if column not in header]
+        if len(missing) > 0:
+            raise KeyError(f"Missing required columns in {filename}: {missing}")
+        positions = [header.index(column) for column in columns]
+        rows = (tuple(row[i] if i < len(row) else "" for i in positions) for row in reader)
+        first = list(itertools.islice(rows, chunk_rows))
+        following = next(rows, None)
+        if following is None:
+            yield from sorted(first, key=lambda row: row[0])
+            return
+        first.append(following)
+        first.sort(key=lambda row: row[0])
+
+        with tempfile.TemporaryDirectory(prefix="sclite_sort_") as tmpdir:
+            chunk_files = []
+            chunk = first
+            while len(chunk) > 0:
+                chunk_file = join(tmpdir, f"chunk_{len(chunk_files)}.csv")
+                with open(chunk_file, 'w', newline='', encoding='utf-8') as out:
+                    csv.writer(out).writerows(chunk)
+                chunk_files.append(chunk_file)
+                chunk = sorted(itertools.islice(rows, chunk_rows), key=lambda row: row[0])
+            logging.debug(f"Merging {len(chunk_files)} sorted chunks of {filename}")
+
+            with contextlib.ExitStack() as stack:
+                readers = [map(tuple, csv.reader(stack.enter_context(open(chunk_file, newline='', encoding='utf-8')))) for chunk_file in chunk_files]
+                yield from heapq.merge(*readers, key=lambda row: row[0])
+
 class Analyzer:
     def __init__(self, config):
         self.config = config
+        self.sort_chunk_rows = int(config.getValue("ErrorRateOutput", "sclite_sort_chunk_rows") or DEFAULT_SORT_CHUNK_ROWS)
 
     def create_ctm(self, transcriptions_filename):
         ctm_file = os.path.splitext(transcriptions_filename)[0]+".ctm"
-        ctm_entries=[]
-        #data = self.transcriptions.getData()
         if transcriptions_filename is not None:
             try:
                 if os.path.exists(transcriptions_filename):
                     logging.debug(f"Attempting to create ctm file from transcriptions file - {transcriptions_filename}")
-                    transcriptions_df = pd.read_csv(transcriptions_filename)
-                    transcriptions_df.sort_values(by="Audio File Name", inplace=True)
-
-                    for audio_file in json.loads(transcriptions_df.to_json(orient='records')):
-                        words = str(audio_file["Transcription"]).split()
-                        for word in words:
-                            ctm_entries.append(audio_file["Audio File Name"].replace(" ", "_") + " 1 0 -1 " + word)
-                    
-                    self.write_to_file(ctm_entries,ctm_file)
+                    with open(ctm_file, "wt", encoding="utf-8") as f:
+                        for audio_file_name, transcription in iter_sorted(transcriptions_filename, ["Audio File Name", "Transcription"], self.sort_chunk_rows):
+                            words = transcription.split()
+                            if len(words) > 0:
+                                prefix = audio_file_name.replace(" ", "_") + " 1 0 -1 "
+                                f.write(prefix + ("\n" + prefix).join(words) + "\n")
                     logging.info(f"Created ctm file - {ctm_file}")
             except Exception as e:
-                logging.exception(f"Failed to create ctm file {ctm_file}:",e)
+                logging.exception(f"Failed to create ctm file {ctm_file}: {str(e)}")
 
     def create_stm(self, transcriptions_filename, reference_file_name):
         stm_file = os.path.splitext(transcriptions_filename)[0]+".stm"
@@ -50,29 +144,132 @@ class Analyzer:
             try:
                 if os.path.exists(reference_file_name):
                     logging.debug(f"Found reference transcriptions file - {reference_file_name} - attempting to create stm file")
-                    ref_df = pd.read_csv(reference_file_name, usecols = ['Audio File Name','Reference'])
-                    ref_df = ref_df.sort_values(by = 'Audio File Name')
-                    ref_df.insert(1,"num1",pd.Series([1 for x in range(len(ref_df.index))]))
-                    ref_df.insert(2,"num2",pd.Series([0 for x in range(len(ref_df.index))]))
-                    ref_df.insert(3,"num3",pd.Series([0 for x in range(len(ref_df.index))]))
-                    ref_df.insert(4,"num4",pd.Series([1000 for x in range(len(ref_df.index))]))
-                    #write out to file
-                    ref_df = ref_df.to_string(header=False,index=False)
-                    lines = ref_df.split("\n")
-                    new_lines = []
-                    for line in lines:
-                        new_lines.append(line.lstrip())
-                    self.write_to_file(new_lines, stm_file)
+                    with open(stm_file, "wt", encoding="utf-8") as f:
+                        for audio_file_name, reference in iter_sorted(reference_file_name, ["Audio File Name", "Reference"], self.sort_chunk_rows):
+                            #One segment per file: channel 1, speaker 0, from 0 to 1000 seconds
+                            f.write(audio_file_name.replace(" ", "_") + f" 1 {STM_SPEAKER} 0 1000 " + " ".join(reference.split()) + "\n")
                     logging.info(f"Created stm file - {stm_file}")
             except Exception as e:
-                logging.exception(f"Failed to create stm file {stm_file}:",e)
+                logging.exception(f"Failed to create stm file {stm_file}: {str(e)}")
 
     def write_to_file(self, entries, filename):
         with open(filename, "wt", encoding="utf-8") as f:
             for entry in entries:
                 f.write(entry + "\n")
     
+    def load_words(self, filename: str, column: str) -> Dict[str, List[str]]:
+        """
+        Words of each audio file in `column` of a CSV file, lower cased as sclite compares them.
+        """
+        words = {}
+        with open(filename, encoding='utf-8-sig') as file:
+            for row in csv.DictReader(file):
+                words[row["Audio File Name"]] = (row.get(column) or "").lower().split()
+        return words
+
+    def score(self, transcriptions_filename, reference_file_name, alignments=False):
+        """
+        Score the transcriptions against the references in-process with sclite's alignment costs, and write
+        an approximate .sys summary (and .prf alignments if `alignments` is True) next to the transcriptions
+        file.  Reference markup is not interpreted and ties between alignments of the same cost can be broken
+        differently than by sclite, so the counts are not guaranteed to match sclite's.
+
+        Returns:
+            The summary results, or None if the files cannot be read
+        """
+        base = os.path.splitext(os.path.abspath(transcriptions_filename))[0]+".approximate"
+        try:
+            references = self.load_words(reference_file_name, "Reference")
+            hypotheses = self.load_words(transcriptions_filename, "Transcription")
+        except (OSError, KeyError) as e:
+            logging.error(f"Unable to read transcriptions for scoring: {str(e)}")
+            return None
+
+        names = sorted(references)
+        for name in hypotheses.keys() - references.keys():
+            logging.warning(f"{name} - No reference transcription found, not scored")
+        vocabulary = wer_engine.Vocabulary()
+        refs = [vocabulary.encode(references[name]) for name in names]
+        hyps = [vocabulary.encode(hypotheses.get(name, [])) for name in names]
+        batch_size = int(self.config.getValue("Analysis", "batch_size") or wer_engine.DEFAULT_BATCH_SIZE)
+        counts = wer_engine.batch_edit_counts(refs, hyps, batch_size, SCLITE_WEIGHTS)
+
+        self.write_sys(base + '.sys', os.path.basename(base), counts)
+        if alignments:
+            self.write_prf(base + '.prf', names, references, hypotheses)
+
+        hits, subs, dels, ins = (int(total) for total in counts.sum(axis=0))
+        words = hits + subs + dels
+        sentence_errors = int((counts[:, 1:].sum(axis=1) > 0).sum())
+        return summary_results(os.path.basename(os.path.dirname(base)), len(names), words, subs, dels, ins, sentence_errors)
+
+    def write_sys(self, filename, title, counts):
+        """
+        Write sclite's summary table.  `create_stm` gives every file the same speaker, so as in sclite's
+        own .sys file there is one speaker row, then the Sum/Avg row `get_wer` reads and the Mean, S.D. and
+        Median over speakers.
+        """
+        hits, subs, dels, ins = (int(total) for total in counts.sum(axis=0))
+        words, sentences = hits + subs + dels, len(counts)
+        sentence_errors = int((counts[:, 1:].sum(axis=1) > 0).sum())
+        scores = [percent(count, words) for count in (hits, subs, dels, ins, subs + dels + ins)] + [percent(sentence_errors, sentences)]
+
+        width = len("Sum/Avg")
+        sentences_width = max(5, len(str(sentences)) + 2)
+        words_width = max(6, len(str(words)) + 2)
+        def row(label, sentence_count, word_count, values):
+            return f"| {label:<{width}} | {sentence_count:>{sentences_width}} {word_count:>{words_width}} | " + " ".join(f"{value:6.1f}" for value in values) + " |"
+
+        speaker = row(STM_SPEAKER, sentences, words, scores)
+        total = row("Sum/Avg", sentences, words, scores)
+        #Statistics over the single speaker
+        mean = row(" Mean", f"{sentences:.1f}", f"{words:.1f}", scores)
+        deviation = row(" S.D.", "0.0", "0.0", [0.0] * len(scores))
+        median = row("Median", f"{sentences:.1f}", f"{words:.1f}", scores)
+        header = f"| {'SPKR':<{width}} | {'# Snt':>{sentences_width}} {'# Wrd':>{words_width}} | " + " ".join(f"{h:>6}" for h in ("Corr", "Sub", "Del", "Ins", "Err", "S.Err")) + " |"
+        inner = len(total) - 2
+        separator = "|" + "-" * (width + 2) + "+" + "-" * (sentences_width + words_width + 3) + "+" + "-" * (inner - width - sentences_width - words_width - 7) + "|"
+        lines = ["SYSTEM SUMMARY PERCENTAGES by SPEAKER".center(inner + 2), "",
+                 "," + "-" * inner + ".", "|" + title.center(inner) + "|", "|" + "-" * inner + "|",
+                 header, separator, speaker, "|" + "=" * inner + "|", total, "|" + "=" * inner + "|",
+                 mean, deviation, median, "`" + "-" * inner + "'"]
+        self.write_to_file(lines, filename)
+        logging.info(f"Created summary file - {filename}")
+
+    def write_prf(self, filename, names, references, hypotheses):
+        """
+        Write sclite's text alignment of each audio file: correct words in lower case, errors in upper case,
+        and `***` where a word was deleted or inserted.
+        """
+        lines = []
+        for name in names:
+            ref_words, hyp_words = references[name], hypotheses.get(name, [])
+            alignment = wer_engine.weighted_align(ref_words, hyp_words, SCLITE_WEIGHTS)
+            ref_line, hyp_line, eval_line = [], [], []
+            for op, ref_pos, hyp_pos in alignment:
+                ref_word = ref_words[ref_pos] if ref_pos >= 0 else "*" * 3
+                hyp_word = hyp_words[hyp_pos] if hyp_pos >= 0 else "*" * 3
+                if op != "C":
+                    ref_word, hyp_word = ref_word.upper(), hyp_word.upper()
+                width = max(len(ref_word), len(hyp_word))
+                ref_line.append(ref_word.ljust(width))
+                hyp_line.append(hyp_word.ljust(width))
+                eval_line.append(("" if op == "C" else op).ljust(width))
+            ops = [op for op, _, _ in alignment]
+            lines.extend([f"id: ({name.replace(' ', '_')})",
+                          f"Scores: (#C #S #D #I) {ops.count('C')} {ops.count('S')} {ops.count('D')} {ops.count('I')}",
+                          "REF:  " + " ".join(ref_line).rstrip(), "HYP:  " + " ".join(hyp_line).rstrip(),
+                          "Eval: " + " ".join(eval_line).rstrip(), ""])
+        self.write_to_file(lines, filename)
+        logging.info(f"Created alignment file - {filename}")
+
     def analyze(self, transcriptions_filename, sclite_path):
+        """
+        Run the sclite executable in `sclite_path` on the CTM and STM files and read its summary.
+
+        Returns:
+            The summary results, or None if sclite did not produce a readable summary
+        """
         results = {'task':[], 'sub':[], 'del':[], 'ins':[], 'wer':[], 'ser':[], 'words':[], 'sentences':[]}
 
         stm_file = os.path.splitext(os.path.abspath(transcriptions_filename))[0]+".stm"
@@ -92,14 +289,110 @@ class Analyzer:
                                 results['task'].append(os.path.basename(os.path.dirname(ctm_file)))                          
                                 for cat in ('sub', 'del', 'ins', 'wer', 'words', 'ser', 'sentences'):
                                     results[cat].append(float(align[cat]))   
-        except Exception as e:
-            logging.exception(f"Could not open {sclite_summary_file}: ", exc_info=e)
-            exit() 
-        
+        except (OSError, ValueError) as e:
+            logging.exception(f"Could not read {sclite_summary_file}: ", exc_info=e)
+            return None
+        return results
+
+    def write_shards(self, ctm_file, stm_file, shards) -> List[Tuple[str, str]]:
+        """
+        Split the CTM and STM files by audio file into up to `shards` CTM and STM files in a `sclite_shards`
+        directory, with about the same number of reference words in each.  Every shard stays sorted.
+
+        Returns:
+            The (CTM, STM) file of each shard that has audio files
+        """
+        with open(stm_file, encoding='utf-8') as f:
+            total_words = sum(len(line.split()) - 5 for line in f)
+        shard_dir = join(dirname(ctm_file), "sclite_shards")
+        os.makedirs(shard_dir, exist_ok=True)
+        base = os.path.splitext(os.path.basename(ctm_file))[0]
+        paths = [(join(shard_dir, f"{base}_{i}.ctm"), join(shard_dir, f"{base}_{i}.stm")) for i in range(shards)]
+
+        shard_of = {}
+        used = set()
+        unscored = set()
+        with contextlib.ExitStack() as stack:
+            ctm_out = [stack.enter_context(open(ctm, 'wt', encoding='utf-8')) for ctm, _ in paths]
+            stm_out = [stack.enter_context(open(stm, 'wt', encoding='utf-8')) for _, stm in paths]
+            words = 0
+            with open(stm_file, encoding='utf-8') as f:
+                for line in f:
+                    #Contiguous runs of files, so each shard keeps the sorted order sclite expects
+                    shard = shard_of.setdefault(line.split(" ", 1)[0], min(words * shards // max(total_words, 1), shards - 1))
+                    stm_out[shard].write(line)
+                    used.add(shard)
+                    words += len(line.split()) - 5
+            with open(ctm_file, encoding='utf-8') as f:
+                for line in f:
+                    name = line.split(" ", 1)[0]
+                    if name not in shard_of:
+                        #One CTM line per word, warn once per audio file
+                        if name not in unscored:
+                            logging.warning(f"{name} - No reference transcription found, not scored")
+                            unscored.add(name)
+                        continue
+                    ctm_out[shard_of[name]].write(line)
+
+        for shard in set(range(shards)) - used:
+            for filename in paths[shard]:
+                os.remove(filename)
+        return [paths[shard] for shard in sorted(used)]
+
+    def read_counts(self, raw_file) -> Tuple[int, ...]:
+        """
+        The sentences, words, correct words, substitutions, deletions, insertions and sentence errors on the
+        Sum/Avg line of sclite's raw count summary (`-o rsum`).
+        """
+        with open(raw_file, 'rt') as f:
+            for line in f:
+                if line.find("Sum") != -1:
+                    align = self.get_wer(line)
+                    return tuple(int(align[cat]) for cat in ('sentences', 'words', 'accuracy', 'sub', 'del', 'ins', 'ser'))
+        raise ValueError(f"No Sum/Avg line in {raw_file}")
+
+    def analyze_sharded(self, transcriptions_filename, sclite_path, shards):
+        """
+        Split the CTM and STM files into `shards` parts by audio file, run one sclite process per part at
+        the same time, and add up the raw counts of their summaries into the summary of the whole corpus.
+        The counts add up exactly, so the result matches a single sclite run.  Each shard's sclite outputs
+        are kept in the `sclite_shards` directory.
+
+        Returns:
+            The summary results, or None if a shard did not produce a readable summary
+        """
+        stm_file = os.path.splitext(os.path.abspath(transcriptions_filename))[0]+".stm"
+        ctm_file = os.path.splitext(os.path.abspath(transcriptions_filename))[0]+".ctm"
+        try:
+            paths = self.write_shards(ctm_file, stm_file, shards)
+        except OSError as e:
+            logging.error(f"Unable to split {ctm_file} into shards: {str(e)}")
+            return None
+        if len(paths) == 0:
+            logging.error(f"No reference transcriptions in {stm_file}")
+            return None
+        logging.info(f"Running sclite on {len(paths)} shards")
+
+        def run_shard(shard_ctm, shard_stm):
+            result = subprocess.run([sclite_path+'/sclite', '-h', shard_ctm, 'ctm', '-r', shard_stm, 'stm', '-o', 'rsum', 'prf', 'dtl', 'sum'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            logging.debug(result.stdout.decode('ascii', errors='replace'))
+            return self.read_counts(shard_ctm + '.raw')
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(paths)) as pool:
+                counts = list(pool.map(lambda shard: run_shard(*shard), paths))
+        except (OSError, ValueError) as e:
+            logging.exception("Could not read the sclite summary of a shard: ", exc_info=e)
+            return None
+
+        sentences, words, hits, subs, dels, ins, sentence_errors = (sum(column) for column in zip(*counts))
+        return summary_results(os.path.basename(os.path.dirname(ctm_file)), sentences, words, subs, dels, ins, sentence_errors)
+
+    def write_summary(self, results, output_dir, filename=SCLITE_SUMMARY_FILE):
         columns = {'sub':'Substitutions', 'del':'Deletions', 'ins':'Insertions', 'wer':'Word Error Rate', 'words':'Total Words', 'ser':'Sentence Error Rate', 'sentences':'Total Sentences'}
         df = pd.DataFrame.from_dict(results).rename(columns=columns)
 
-        wer_summary_file=str(os.path.dirname(stm_file)+"/sclite_wer_summary.json")
+        wer_summary_file=str(output_dir+"/"+filename)
         df.to_json(wer_summary_file, orient="records")
         logging.info(f"Created summary file - {wer_summary_file}")
 
@@ -109,7 +402,7 @@ class Analyzer:
         #  "| Sum/Avg|  187    764 | 84.9   11.0    4.1    8.4   23.4   49.2 |"
         elements = sclite_str.replace('|', ' ').split()
         if len(elements) != 9:
-            sys.exit("unable to parse: ", sclite_str)
+            raise ValueError(f"unable to parse: {sclite_str}")
         return {'sentences':elements[1], 'words':elements[2], 'accuracy':elements[3], 'sub':elements[4],
                 'del':elements[5], 'ins':elements[6], 'wer':elements[7], 'ser':elements[8]}   
 
@@ -125,13 +418,33 @@ def run(config_file:str, logging_level:str=DEFAULT_LOGLEVEL):
     transcriptions_filename = config.getValue("Transcriptions", "stt_transcriptions_file")
     reference_file_name = config.getValue("Transcriptions", "reference_transcriptions_file")
     sclite_directory = config.getValue("ErrorRateOutput", "sclite_directory")
+    engine = engine_from_config(config)
+    shards = int(config.getValue("ErrorRateOutput", "sclite_shards", 1) or 1)
 
     if output_dir is not None and len(output_dir) > 0:
         os.makedirs(output_dir, exist_ok=True)
 
-    analyzer.create_ctm(transcriptions_filename)
-    analyzer.create_stm(transcriptions_filename, reference_file_name)
-    analyzer.analyze(transcriptions_filename, sclite_directory)
+    if engine not in ENGINES:
+        logging.error(f"Unknown sclite_engine {engine}, expected one of: {', '.join(ENGINES)}")
+        return
+    if engine == "sclite" and not sclite_directory:
+        logging.error("sclite_engine=sclite needs the sclite_directory of the sclite executable in [ErrorRateOutput]")
+        return
+
+    if engine == "sclite":
+        analyzer.create_ctm(transcriptions_filename)
+        analyzer.create_stm(transcriptions_filename, reference_file_name)
+        if shards > 1:
+            results = analyzer.analyze_sharded(transcriptions_filename, sclite_directory, shards)
+        else:
+            results = analyzer.analyze(transcriptions_filename, sclite_directory)
+    else:
+        results = analyzer.score(transcriptions_filename, reference_file_name, config.getBoolean("ErrorRateOutput", "sclite_alignments"))
+
+    if results is None:
+        logging.error("No sclite summary was produced")
+        return
+    analyzer.write_summary(results, os.path.dirname(os.path.abspath(transcriptions_filename)), summary_filename(config))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
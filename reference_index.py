@@ -0,0 +1,151 @@
+"""
+Persistent index of normalized reference transcriptions, shared by analysis runs.
+
+Normalizing the references is the same work for every analysis of one reference file with one set of
+[Transformations], e.g. for every point of an experiment grid.  With `reference_index_directory` set under
+[Analysis], the first analysis stores the normalized reference words in a subdirectory named after a hash
+of the reference file contents and the [Transformations] section, and later analyses load it instead of
+normalizing again.  Words are stored as integer IDs in a NumPy array that is memory-mapped on load, with
+the vocabulary, file names and raw references in a JSON file.  A changed reference file or changed
+[Transformations] hash to a different subdirectory, so a stale index is never used.
+"""
+
+import hashlib
+import importlib.metadata
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from typing import Callable, Dict, List, Optional
+
+import numpy as np
+
+INDEX_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+INDEX_FILE = "index.json"
+TOKENS_FILE = "tokens.npy"
+OFFSETS_FILE = "offsets.npy"
+
+class ReferenceIndex:
+    """
+    Normalized reference words by audio file name, as produced by `normalization.TextNormalizer`.
+    """
+
+    def __init__(self, directory: str, names: List[str], references: List[str], vocabulary: List[str], tokens, offsets):
+        self.directory = directory
+        self.names = names
+        self.positions = {name: position for position, name in enumerate(names)}
+        self.raw_references = references
+        self.vocabulary = [sys.intern(word) for word in vocabulary]
+        self.tokens = tokens
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_config(cls, config, normalizer, load_references: Callable[[], Dict[str, str]]) -> Optional["ReferenceIndex"]:
+        """
+        Load the index for the configured reference file and [Transformations], building it with
+        `load_references` and `normalizer` if it does not exist yet.
+
+        Returns:
+            ReferenceIndex, or None if `reference_index_directory` is not set or the references cannot be indexed
+        """
+        index_dir = config.getValue("Analysis", "reference_index_directory")
+        if not index_dir:
+            return None
+        if not normalizer.compiled:
+            logging.debug("Normalized references are not word lists with these transformations, not using the reference index")
+            return None
+        reference_file = config.getValue("Transcriptions", "reference_transcriptions_file")
+        try:
+            directory = os.path.join(index_dir, index_key(reference_file, config))
+            if os.path.exists(os.path.join(directory, INDEX_FILE)):
+                index = cls.load(directory)
+                logging.info(f"Loaded {len(index)} normalized references from {directory}")
+                return index
+            references = load_references()
+            if len(references) == 0:
+                return None
+            index = cls.build(directory, references, normalizer)
+            logging.info(f"Indexed {len(index)} normalized references in {directory}")
+            return index
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Unable to use the reference index in {index_dir}, normalizing references: {str(e)}")
+            return None
+
+    @classmethod
+    def load(cls, directory: str) -> "ReferenceIndex":
+        with open(os.path.join(directory, INDEX_FILE), encoding='utf-8') as f:
+            index = json.load(f)
+        tokens = np.load(os.path.join(directory, TOKENS_FILE), mmap_mode='r')
+        offsets = np.load(os.path.join(directory, OFFSETS_FILE))
+        return cls(directory, index["names"], index["references"], index["vocabulary"], tokens, offsets)
+
+    @classmethod
+    def build(cls, directory: str, references: Dict[str, str], normalizer) -> "ReferenceIndex":
+        """
+        Normalize `references` and write the index to `directory`.  The index is written to a temporary
+        directory first, so concurrent analyses never see a partial index.
+        """
+        ids: Dict[str, int] = {}
+        tokens: List[int] = []
+        offsets = [0]
+        for reference in references.values():
+            tokens.extend(ids.setdefault(word, len(ids)) for word in normalizer(reference))
+            offsets.append(len(tokens))
+
+        parent = os.path.dirname(directory)
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".building_", dir=parent)
+        try:
+            np.save(os.path.join(tmp_dir, TOKENS_FILE), np.array(tokens, dtype=np.int32))
+            np.save(os.path.join(tmp_dir, OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+            with open(os.path.join(tmp_dir, INDEX_FILE), 'w', encoding='utf-8') as f:
+                json.dump({"version": INDEX_VERSION, "names": list(references.keys()),
+                           "references": list(references.values()), "vocabulary": list(ids.keys())}, f)
+            try:
+                os.rename(tmp_dir, directory)
+            except OSError:
+                #Another analysis built the same index first
+                logging.debug(f"Reference index {directory} already exists")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        return cls.load(directory)
+
+    def references(self) -> Dict[str, str]:
+        """
+        The raw references by audio file name, in reference file order.
+        """
+        return dict(zip(self.names, self.raw_references))
+
+    def cleaned(self, name: str) -> Optional[List[str]]:
+        """
+        The normalized words of the reference for `name`, or None if it is not in the index.
+        """
+        position = self.positions.get(name)
+        if position is None:
+            return None
+        vocabulary = self.vocabulary
+        return [vocabulary[i] for i in self.tokens[self.offsets[position]:self.offsets[position + 1]].tolist()]
+
+def index_key(reference_file: str, config) -> str:
+    """
+    Hash of the reference file contents and the [Transformations] settings that produced the index.
+    """
+    digest = hashlib.sha256()
+    with open(reference_file, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    transformations = dict(config.config["Transformations"]) if config.config.has_section("Transformations") else {}
+    #Stems can change between NLTK releases
+    try:
+        nltk_version = importlib.metadata.version("nltk")
+    except importlib.metadata.PackageNotFoundError:
+        nltk_version = None
+    digest.update(json.dumps({"version": INDEX_VERSION, "nltk": nltk_version, "transformations": transformations},
+                             sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()[:32]
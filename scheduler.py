@@ -0,0 +1,245 @@
+"""
+Request scheduling for Speech to Text recognize calls.
+
+Provides a token-bucket rate limit, an AIMD (additive increase / multiplicative decrease) concurrency
+limit that backs off when the service throttles, and bounded retries with jittered exponential backoff.
+"""
+
+import concurrent.futures
+import logging
+import random
+import re
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+THROTTLE_STATUS_CODES = (429, 503)
+RETRYABLE_STATUS_CODES = (429, 500, 502, 503, 504)
+RETRYABLE_ERROR_NAMES = ("Connection", "Timeout", "Closed")
+
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BASE_DELAY = 1.0
+DEFAULT_RETRY_MAX_DELAY = 60.0
+
+def classify_error(error: Any) -> Tuple[bool, bool]:
+    """
+    Decide whether a recognize error is worth retrying.
+
+    Args:
+        error: Exception or error message reported for a recognize request
+
+    Returns:
+        Tuple of (retryable, throttled); throttled errors (429/503) are also retryable
+    """
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if not isinstance(status, int):
+        match = re.search(r"\b(429|500|502|503|504)\b", str(error))
+        status = int(match.group(1)) if match else None
+
+    if status is not None:
+        return status in RETRYABLE_STATUS_CODES, status in THROTTLE_STATUS_CODES
+
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True, False
+    name = type(error).__name__
+    return any(part in name for part in RETRYABLE_ERROR_NAMES), False
+
+class TokenBucket:
+    """
+    Thread-safe token bucket allowing `rate` requests per second with bursts of up to `burst` requests.
+    """
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take one token, possibly borrowing against the future.
+
+        Returns:
+            Seconds the caller must wait before sending its request
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self) -> None:
+        wait = self.reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit adjusted with AIMD: grows by roughly one slot per round of successful requests,
+    and is cut by `decrease_factor` (at most once per `cooldown` seconds) when the service throttles
+    or latency exceeds `latency_target`.
+    """
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: Optional[int] = None,
+                 decrease_factor: float = 0.5, latency_target: Optional[float] = None, cooldown: float = 1.0):
+        self.maximum = maximum if maximum is not None else initial
+        self.minimum = max(1, min(minimum, self.maximum))
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.decrease_factor = decrease_factor
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self) -> None:
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, success: bool, latency: float, throttled: bool = False) -> None:
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            slow = self.latency_target is not None and latency > self.latency_target
+            if throttled or (success and slow):
+                if now - self.last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+                    logging.info(f"Reducing concurrency limit to {int(self.limit)}")
+            elif success:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+class RetryPolicy:
+    """
+    Bounded retries with "full jitter" exponential backoff.
+    """
+
+    def __init__(self, max_retries: int = DEFAULT_MAX_RETRIES, base_delay: float = DEFAULT_RETRY_BASE_DELAY,
+                 max_delay: float = DEFAULT_RETRY_MAX_DELAY):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt: int) -> float:
+        """
+        Seconds to wait before retry number `attempt` (0-based).
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+class TranscriptionScheduler:
+    """
+    Runs a task per audio file on a thread pool under the rate limit, concurrency limit and retry policy.
+
+    The task is called with the file name and returns None on success, or the error that occurred.
+    `sessions` is an optional semaphore shared with other schedulers, held while a request is in flight,
+    to cap the number of recognize sessions across several concurrent runs.  If `metrics` (a
+    `metrics.MetricsRecorder`) is given, queue wait, retries and failures are recorded in it.
+    """
+
+    def __init__(self, task: Callable[[str], Any], max_threads: int, retry_policy: RetryPolicy,
+                 rate_limiter: Optional[TokenBucket] = None, concurrency: Optional[AdaptiveLimiter] = None,
+                 sessions: Optional[threading.Semaphore] = None, metrics=None):
+        self.task = task
+        self.max_threads = max_threads
+        self.retry_policy = retry_policy
+        self.rate_limiter = rate_limiter
+        self.concurrency = concurrency
+        self.sessions = sessions
+        self.metrics = metrics
+        self.failures: Dict[str, Tuple[int, Any]] = {}
+
+    @classmethod
+    def from_config(cls, config, task: Callable[[str], Any], max_threads: int,
+                    sessions: Optional[threading.Semaphore] = None, metrics=None) -> "TranscriptionScheduler":
+        """
+        Build a scheduler from the [SpeechToText] settings `requests_per_second`, `adaptive_concurrency`,
+        `latency_target`, `max_retries`, `retry_base_delay` and `retry_max_delay`.
+        """
+        return cls(task, max_threads, retry_policy_from_config(config),
+                   rate_limiter=rate_limiter_from_config(config),
+                   concurrency=AdaptiveLimiter(max_threads, latency_target=optional_float(config, "latency_target"))
+                               if config.getBoolean("SpeechToText", "adaptive_concurrency") else None,
+                   sessions=sessions, metrics=metrics)
+
+    def run_one(self, filename: str, submitted: Optional[float] = None) -> bool:
+        attempt = 0
+        while True:
+            if self.concurrency is not None:
+                self.concurrency.acquire()
+            if self.sessions is not None:
+                self.sessions.acquire()
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            start = time.monotonic()
+            if self.metrics is not None and submitted is not None and attempt == 0:
+                self.metrics.observe("queue_wait_seconds", start - submitted, filename)
+            try:
+                error = self.task(filename)
+            except Exception as e:
+                #A task that raises fails like one that returns its error, so its slots are released
+                logging.exception(f"{filename} - Error: {str(e)}")
+                error = e
+            finally:
+                if self.sessions is not None:
+                    self.sessions.release()
+            retryable, throttled = classify_error(error) if error is not None else (False, False)
+            if self.concurrency is not None:
+                self.concurrency.release(error is None, time.monotonic() - start, throttled)
+            if self.metrics is not None:
+                self.metrics.observe("recognize_seconds", time.monotonic() - start, filename)
+
+            if error is None:
+                return True
+            if not retryable or attempt >= self.retry_policy.max_retries:
+                self.failures[filename] = (attempt + 1, error)
+                if self.metrics is not None:
+                    self.metrics.increment("failures")
+                logging.error(f"{filename} - Failed after {attempt + 1} attempt(s): {error}")
+                return False
+
+            delay = self.retry_policy.delay(attempt)
+            attempt += 1
+            if self.metrics is not None:
+                self.metrics.increment("throttled_retries" if throttled else "retries")
+            logging.warning(f"{filename} - Retrying in {delay:.1f}s (attempt {attempt} of {self.retry_policy.max_retries}) after error: {error}")
+            time.sleep(delay)
+
+    def run(self, files: List[str]) -> int:
+        """
+        Process all files.
+
+        Returns:
+            Number of files processed, whether or not they succeeded
+        """
+        complete_files = 0
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_threads) as executor:
+            futures = [executor.submit(self.run_one, file, time.monotonic()) for file in files]
+            for future in concurrent.futures.as_completed(futures):
+                complete_files += 1
+                if complete_files % 100 == 0:
+                    logging.info(f"Completed transcribing {complete_files} files out of {len(files)}")
+                    if self.metrics is not None:
+                        self.metrics.write_prometheus_file()
+        return complete_files
+
+def optional_float(config, key: str) -> Optional[float]:
+    value = config.getValue("SpeechToText", key)
+    return float(value) if value else None
+
+def rate_limiter_from_config(config) -> Optional[TokenBucket]:
+    rate = optional_float(config, "requests_per_second")
+    if rate is None or rate <= 0:
+        return None
+    return TokenBucket(rate, optional_float(config, "requests_burst"))
+
+def retry_policy_from_config(config) -> RetryPolicy:
+    return RetryPolicy(int(config.getValue("SpeechToText", "max_retries", DEFAULT_MAX_RETRIES)),
+                       float(config.getValue("SpeechToText", "retry_base_delay", DEFAULT_RETRY_BASE_DELAY)),
+                       float(config.getValue("SpeechToText", "retry_max_delay", DEFAULT_RETRY_MAX_DELAY)))
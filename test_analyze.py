@@ -0,0 +1,90 @@
+import unittest, os, csv, tempfile
+import jiwer
+from collections import Counter
+from config import Config
+from analyze import Analyzer, AnalysisResult, AnalysisResults, WordAccuracy
+
+
+def getInstance(**analysis):
+    c = Config('config.ini.sample')
+    for key, value in analysis.items():
+        c.setValue('Analysis', key, value)
+    return Analyzer(c)
+
+class MyTest(unittest.TestCase):
+    def test_differences_counts(self):
+        a = getInstance()
+        ref = ['the', 'cat', 'saw', 'the', 'dog']
+        hyp = ['a', 'cat', 'saw', 'the', 'frog']
+        self.assertEqual(Counter(a.compute_differences(ref, hyp)), Counter(['the', 'dog']))
+
+    def test_differences_counts_ignores_position(self):
+        a = getInstance()
+        self.assertEqual(a.compute_differences(['a', 'b'], ['b', 'a']), [])
+
+    def test_differences_alignment(self):
+        a = getInstance(differences='alignment')
+        ref = ['the', 'cat', 'saw', 'the', 'dog']
+        hyp = ['a', 'cat', 'saw', 'the', 'frog']
+        self.assertEqual(a.compute_differences(ref, hyp), ['the', 'dog'])
+
+    def test_differences_alignment_uses_position(self):
+        a = getInstance(differences='alignment')
+        self.assertEqual(len(a.compute_differences(['a', 'b'], ['b', 'a'])), 1)
+
+    def test_merge(self):
+        a = getInstance()
+        def result(name, ref, hyp):
+            ref_list, hyp_list = ref.split(' '), hyp.split(' ')
+            return AnalysisResult(name, ref, hyp, ref, hyp, jiwer.compute_measures(ref_list, hyp_list), a.compute_differences(ref_list, hyp_list))
+        items = [result('1.wav', 'a b c', 'a b c'), result('2.wav', 'a b', 'a x'), result('3.wav', 'c d', 'c')]
+        whole = AnalysisResults(a.config)
+        for item in items:
+            whole.add(item)
+        first, second = AnalysisResults(a.config), AnalysisResults(a.config)
+        first.add(items[0])
+        second.add(items[1])
+        second.add(items[2])
+        first.merge(second)
+        self.assertEqual([r.audio_file_name for r in first.results], ['1.wav', '2.wav', '3.wav'])
+        self.assertEqual(first.get_summary(), whole.get_summary())
+        self.assertEqual(first.word_map, whole.word_map)
+
+    def test_word_accuracy_rows(self):
+        w = WordAccuracy()
+        w.add_counts(['a', 'b', 'a', 'c', 'a', 'b'])
+        w.add_errors(['a', 'b', 'b'])
+        self.assertEqual([r['word'] for r in w.rows()], ['a', 'b', 'c'])
+        self.assertEqual(list(w.rows(top_k=1)), [{'word':'b', 'count':2, 'errors':2, 'error_rate':1.0}])
+        self.assertEqual([r['word'] for r in w.rows(min_count=2)], ['a', 'b'])
+        self.assertAlmostEqual(next(w.rows())['error_rate'], 1 / 3)
+
+    def test_streaming_matches_in_memory(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reference_file, hypothesis_file = os.path.join(tmpdir, 'ref.csv'), os.path.join(tmpdir, 'hyp.csv')
+            with open(reference_file, 'w', newline='') as f:
+                csv.writer(f).writerows([['Audio File Name', 'Reference'], ['1.wav', 'a b c'], ['2.wav', 'a b'], ['3.wav', 'c d'], ['4.wav', 'e']])
+            with open(hypothesis_file, 'w', newline='') as f:
+                csv.writer(f).writerows([['Audio File Name', 'Transcription'], ['3.wav', 'c'], ['1.wav', 'a b c'], ['2.wav', 'a x']])
+
+            in_memory = getInstance()
+            streaming = getInstance(streaming='True', batch_size='2')
+            for a in (in_memory, streaming):
+                a.config.setValue('Transcriptions', 'reference_transcriptions_file', reference_file)
+                a.config.setValue('Transcriptions', 'stt_transcriptions_file', hypothesis_file)
+
+            details_file = os.path.join(tmpdir, 'details.csv')
+            expected = in_memory.analyze()
+            expected.write_details(os.path.join(tmpdir, 'expected.csv'))
+            actual = streaming.analyze(details_file)
+            actual.write_details(details_file)
+
+            self.assertEqual(actual.results, [])
+            self.assertEqual(actual.get_summary(), expected.get_summary())
+            self.assertEqual(actual.word_map, expected.word_map)
+            with open(details_file) as f, open(os.path.join(tmpdir, 'expected.csv')) as g:
+                self.assertEqual(f.read(), g.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
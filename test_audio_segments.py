@@ -0,0 +1,81 @@
+import unittest, os, tempfile, wave
+import numpy as np
+from audio_segments import AudioSegmenter, stitch_transcripts
+from transcribe import Transcriptions
+
+RATE = 8000
+
+def write_wav(filename, samples):
+    with wave.open(filename, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(RATE)
+        wav.writeframes(samples.astype(np.int16).tobytes())
+
+def read_wav(filename):
+    with wave.open(filename, 'rb') as wav:
+        return np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+
+
+class MyTest(unittest.TestCase):
+    def test_split_at_silence(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            #Loud noise with 0.2s of silence starting at 8.5s and 17.5s
+            samples = np.random.default_rng(0).integers(-10000, 10000, 25 * RATE)
+            for silence in (8.5, 17.5):
+                samples[int(silence * RATE):int((silence + 0.2) * RATE)] = 0
+            filename = os.path.join(tmpdir, 'long.wav')
+            write_wav(filename, samples)
+
+            segmenter = AudioSegmenter(segment_seconds=10, silence_search_seconds=3, segment_dir=os.path.join(tmpdir, 'segments'))
+            segments = segmenter.split_all([filename])
+            self.assertEqual(len(segments), 3)
+            self.assertEqual(segmenter.segments, {filename: segments})
+            lengths = [len(read_wav(segment)) / RATE for segment in segments]
+            self.assertAlmostEqual(lengths[0], 8.6, delta=0.02)
+            self.assertAlmostEqual(lengths[1], 9.0, delta=0.02)
+            np.testing.assert_array_equal(np.concatenate([read_wav(segment) for segment in segments]), samples)
+
+    def test_overlap_and_short_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            samples = np.arange(12 * RATE) % 1000
+            long_file, short_file = os.path.join(tmpdir, 'long.wav'), os.path.join(tmpdir, 'short.wav')
+            write_wav(long_file, samples)
+            write_wav(short_file, samples[:RATE])
+
+            segmenter = AudioSegmenter(segment_seconds=5, overlap_seconds=1, silence_search_seconds=0, segment_dir=tmpdir)
+            segments = segmenter.split_all([short_file, long_file])
+            self.assertEqual(segments[0], short_file)
+            self.assertEqual([len(read_wav(segment)) for segment in segments[1:]], [5 * RATE, 6 * RATE, 3 * RATE])
+            np.testing.assert_array_equal(read_wav(segments[2])[:RATE], samples[4 * RATE:5 * RATE])
+
+    def test_stitch_transcripts(self):
+        self.assertEqual(stitch_transcripts(["the quick brown ", "fox jumped "]), "the quick brown fox jumped ")
+        self.assertEqual(stitch_transcripts(["the quick brown fox jum ", "brown fox jumped over the ", "over the lazy dog "], 5),
+                         "the quick brown fox jumped over the lazy dog ")
+        #A single repeated word is not taken as overlap
+        self.assertEqual(stitch_transcripts(["a dog ", "dog barked "], 5), "a dog dog barked ")
+        #A common phrase elsewhere in both windows is not the overlap
+        self.assertEqual(stitch_transcripts(["results of the study were clear ", "were clear and the rest of the study follows "], 10),
+                         "results of the study were clear and the rest of the study follows ")
+        self.assertEqual(stitch_transcripts(["said that of the ", "ing of the year "], 10), "said that of the year ")
+        self.assertEqual(stitch_transcripts(["", ""]), "")
+
+    def test_stitch(self):
+        segmenter = AudioSegmenter(segment_seconds=5)
+        segmenter.segments = {'a.wav': ['a.0.wav', 'a.1.wav'], 'b.wav': ['b.0.wav', 'b.1.wav']}
+        transcriptions = Transcriptions()
+        for key, value in [('a.0.wav', 'hello '), ('a.1.wav', 'world '), ('b.0.wav', 'lost ')]:
+            transcriptions.add(key, value)
+
+        failures = {'b.1.wav': (4, 'error')}
+        self.assertEqual(segmenter.stitch(transcriptions, failures), 1)
+        self.assertEqual(transcriptions.getData()['a.wav'], 'hello world ')
+        self.assertNotIn('b.wav', transcriptions.getData())
+        self.assertEqual(failures, {'b.wav': (4, 'error')})
+        segmenter.close()
+        self.assertFalse(os.path.exists(segmenter.segment_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest, os, csv, json, tempfile
+from unittest import mock
+from config import Config
+from experiment import Experiments, transformation_variants, write_reference_subset, read_word_error_rate, analyze_experiment
+
+
+def fake_transcribe(exp_config_path, logging_level, sessions=None, files=None):
+    if 'bad' in exp_config_path:
+        raise SystemExit(1)
+
+
+def mark_analyzed(exp_config_path, logging_level):
+    open(os.path.join(os.path.dirname(exp_config_path), 'analyzed'), 'w').close()
+
+
+class FakeExperiments(Experiments):
+    """
+    Records which experiments run on how many files, and scores each one by a fixed word error rate
+    """
+    def __init__(self, config, output_dir, rates):
+        super().__init__(config, output_dir)
+        self.rates = rates
+        self.runs = []
+        self.analyses = set()
+
+    def run_experiments(self, exp_config_paths, max_threads, logging_level, files=None, analysis=None):
+        self.analyses.add(analysis)
+        for path in exp_config_paths:
+            name = os.path.relpath(os.path.dirname(path), self.output_dir).split(os.sep)[0]
+            self.runs.append((name, None if files is None else len(files)))
+            summary_file = Config(path).getValue('ErrorRateOutput', 'summary_file')
+            with open(summary_file, 'w') as f:
+                json.dump({"Word Error Rate": self.rates[name]}, f)
+
+class MyTest(unittest.TestCase):
+    def test_write_reference_subset(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reference_file = os.path.join(tmpdir, 'ref.csv')
+            with open(reference_file, 'w', newline='') as f:
+                csv.writer(f).writerows([['Audio File Name', 'Reference'], ['./a.wav', 'a'], ['./b.wav', 'b'], ['./c.wav', 'c']])
+            subset_file = write_reference_subset(reference_file, ['audio/c.wav', 'audio/a.wav'], os.path.join(tmpdir, 'sub', 'ref.csv'))
+            with open(subset_file) as f:
+                self.assertEqual([row['Audio File Name'] for row in csv.DictReader(f)], ['./a.wav', './c.wav'])
+
+    def test_transformation_variants(self):
+        config = Config('config.ini.sample')
+        config.setValue('TransformationExperiments', 'stemming', 'True|False')
+        config.setValue('TransformationExperiments', 'remove_word_list', 'uh,um|')
+        self.assertEqual(transformation_variants(config), [{'stemming':'True', 'remove_word_list':'uh,um'}, {'stemming':'True', 'remove_word_list':''},
+                                                           {'stemming':'False', 'remove_word_list':'uh,um'}, {'stemming':'False', 'remove_word_list':''}])
+
+    def test_successive_halving(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            audio_dir = os.path.join(tmpdir, 'audio')
+            os.makedirs(audio_dir)
+            with open(os.path.join(tmpdir, 'ref.csv'), 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['Audio File Name', 'Reference'])
+                for i in range(9):
+                    open(os.path.join(audio_dir, f'{i}.wav'), 'w').close()
+                    writer.writerow([f'{i}.wav', 'words'])
+
+            config = Config('config.ini.sample')
+            config.setValue('Transcriptions', 'audio_file_folder', audio_dir)
+            config.setValue('Transcriptions', 'reference_transcriptions_file', os.path.join(tmpdir, 'ref.csv'))
+            config.setValue('Experiments', 'halving_initial_fraction', '0.2')
+            config.setValue('Experiments', 'halving_eta', '3')
+
+            rates = {f'exp{i}': i / 10 for i in range(9)}
+            paths = []
+            for name in rates:
+                os.makedirs(os.path.join(tmpdir, name))
+                exp_config = Config('config.ini.sample')
+                exp_config.setValue('ErrorRateOutput', 'summary_file', os.path.join(tmpdir, name, 'summary.json'))
+                paths.append(os.path.join(tmpdir, name, 'config.ini'))
+                exp_config.writeFile(paths[-1])
+
+            experiments = FakeExperiments(config, tmpdir, rates)
+            experiments.run_halving(paths, 1, 'ERROR')
+
+            self.assertEqual(len([run for run in experiments.runs if run[1] == 2]), 9)
+            self.assertEqual(sorted(run[0] for run in experiments.runs if run[1] == 6), ['exp0', 'exp1', 'exp2'])
+            self.assertEqual(experiments.runs[-1], ('exp0', None))
+            #Rungs are analyzed like the final runs
+            self.assertEqual(experiments.analyses, {analyze_experiment, None})
+            with open(os.path.join(tmpdir, 'halving_rungs.csv')) as f:
+                self.assertEqual(len(list(csv.DictReader(f))), 12)
+
+    def test_read_word_error_rate(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = Config('config.ini.sample')
+            config.setValue('Transcriptions', 'stt_transcriptions_file', os.path.join(tmpdir, 'stt.csv'))
+            config.setValue('ErrorRateOutput', 'summary_file', os.path.join(tmpdir, 'summary.json'))
+            with open(os.path.join(tmpdir, 'summary.json'), 'w') as f:
+                json.dump({"Word Error Rate": 0.25}, f)
+            with open(os.path.join(tmpdir, 'approximate_wer_summary.json'), 'w') as f:
+                json.dump([{"Word Error Rate": 30.0}], f)
+            config.writeFile(os.path.join(tmpdir, 'config.ini'))
+            self.assertEqual(read_word_error_rate(os.path.join(tmpdir, 'config.ini')), 0.25)
+            #Experiments scored with the sclite script are ranked by its engine's word error rate
+            config.setValue('ErrorRateOutput', 'sclite_engine', 'approximate')
+            config.writeFile(os.path.join(tmpdir, 'config.ini'))
+            self.assertEqual(read_word_error_rate(os.path.join(tmpdir, 'config.ini')), 30.0)
+
+    def test_parallel_experiment_failure_is_reported(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for name in ['good1', 'bad', 'good2']:
+                os.makedirs(os.path.join(tmpdir, name))
+                paths.append(os.path.join(tmpdir, name, 'config.ini'))
+            experiments = Experiments(Config('config.ini.sample'), tmpdir)
+            with mock.patch('experiment.transcribe.run', fake_transcribe), self.assertLogs(level='ERROR') as logs:
+                experiments.run_parallel(paths, 2, 2, 1, 'ERROR', analysis=mark_analyzed)
+            analyzed = sorted(name for name in ['good1', 'bad', 'good2'] if os.path.exists(os.path.join(tmpdir, name, 'analyzed')))
+        self.assertEqual(analyzed, ['good1', 'good2'])
+        self.assertEqual(logs.output, ['ERROR:root:Experiment bad failed to transcribe: exited with status 1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest, os, csv, json, tempfile, urllib.request
+from config import Config
+from metrics import MetricsRecorder
+
+
+class MyTest(unittest.TestCase):
+    def test_summary(self):
+        metrics = MetricsRecorder()
+        for value in range(1, 101):
+            metrics.observe("recognize_seconds", value)
+        summary = metrics.summary()["recognize_seconds"]
+        self.assertEqual(summary["count"], 100)
+        self.assertEqual(summary["sum"], 5050)
+        self.assertEqual(summary["max"], 100)
+        self.assertAlmostEqual(summary["p50"], 50.5)
+        self.assertAlmostEqual(summary["p99"], 99.01)
+
+    def test_prometheus_text(self):
+        metrics = MetricsRecorder()
+        metrics.observe("connect_seconds", 0.5)
+        metrics.increment("retries")
+        metrics.increment("retries", 2)
+        text = metrics.prometheus_text()
+        self.assertIn('# TYPE stt_wer_connect_seconds summary', text)
+        self.assertIn('stt_wer_connect_seconds{quantile="0.5"} 0.5', text)
+        self.assertIn('stt_wer_connect_seconds_count 1', text)
+        self.assertIn('stt_wer_retries_total 3', text)
+
+    def test_write_files(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = Config('config.ini.sample')
+            config.setValue('Metrics', 'metrics_file', os.path.join(tmpdir, 'metrics.csv'))
+            config.setValue('Metrics', 'prometheus_file', os.path.join(tmpdir, 'metrics.prom'))
+            metrics = MetricsRecorder.from_config(config)
+            self.assertIsNone(metrics.prometheus_port)
+            metrics.observe("recognize_seconds", 1.5, "a.wav")
+            metrics.observe("recognize_seconds", 2.5, "b.wav")
+            metrics.increment("cache_hits")
+            metrics.write()
+
+            with open(os.path.join(tmpdir, 'metrics.csv')) as f:
+                rows = list(csv.reader(f))
+            self.assertEqual(rows, [['Item', 'Metric', 'Value'], ['a.wav', 'recognize_seconds', '1.5'],
+                                    ['b.wav', 'recognize_seconds', '2.5'], ['', 'cache_hits_total', '1']])
+            with open(os.path.join(tmpdir, 'metrics.prom')) as f:
+                self.assertIn('stt_wer_recognize_seconds_sum 4.0', f.read())
+
+            metrics.metrics_file = os.path.join(tmpdir, 'metrics.json')
+            metrics.write_metrics_file()
+            with open(metrics.metrics_file) as f:
+                report = json.load(f)
+            self.assertEqual(report["summary"]["recognize_seconds"]["mean"], 2.0)
+            self.assertEqual(report["counters"], {"cache_hits": 1})
+            self.assertEqual(len(report["observations"]), 2)
+
+    def test_serve(self):
+        metrics = MetricsRecorder(prometheus_port=0)
+        metrics.observe("analysis_seconds", 3.0)
+        metrics.serve()
+        try:
+            port = metrics.server.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+                self.assertIn('stt_wer_analysis_seconds_count 1', response.read().decode('utf-8'))
+        finally:
+            metrics.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
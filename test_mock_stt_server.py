@@ -0,0 +1,139 @@
+import unittest, os, csv, tempfile, threading
+from config import Config
+from mock_stt_server import MockSTTServer, load_transcripts
+from benchmark_transcribe import write_audio_files
+import transcribe
+import batch_jobs
+
+
+class MyTest(unittest.TestCase):
+    def transcribe_with(self, server, tmpdir, transcription_mode, transport='websocket', num_files=3, settings=None, sessions=None):
+        audio_dir, reference_file = os.path.join(tmpdir, 'audio'), os.path.join(tmpdir, 'ref.csv')
+        write_audio_files(audio_dir, reference_file, num_files, 0.1)
+        server.transcripts = load_transcripts(reference_file, audio_dir)
+
+        config = Config('config.ini.sample')
+        config.setValue('SpeechToText', 'service_url', server.http_url if transport == 'http' else server.url)
+        config.setValue('SpeechToText', 'transport', transport)
+        config.setValue('SpeechToText', 'max_threads', '2')
+        config.setValue('SpeechToText', 'bearer_token', 'test')
+        config.setValue('SpeechToText', 'transcription_mode', transcription_mode)
+        config.setValue('SpeechToText', 'max_retries', '0')
+        config.setValue('Transcriptions', 'audio_file_folder', audio_dir)
+        config.setValue('Transcriptions', 'reference_transcriptions_file', reference_file)
+        config.setValue('Transcriptions', 'stt_transcriptions_file', os.path.join(tmpdir, 'stt.csv'))
+        config.setValue('ErrorRateOutput', 'summary_file', os.path.join(tmpdir, 'summary.json'))
+        for key, value in (settings or {}).items():
+            config.setValue('SpeechToText', key, value)
+        config.writeFile(os.path.join(tmpdir, 'config.ini'))
+        transcribe.run(os.path.join(tmpdir, 'config.ini'), 'ERROR', sessions)
+
+        with open(os.path.join(tmpdir, 'stt.csv'), encoding='utf-8-sig') as f:
+            return {os.path.basename(row['Audio File Name']): row['Transcription'].strip() for row in csv.DictReader(f)}
+
+    def test_transcripts_match_references(self):
+        for transcription_mode in ['threads', 'asyncio']:
+            server = MockSTTServer(port=0).start()
+            try:
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    transcriptions = self.transcribe_with(server, tmpdir, transcription_mode)
+            finally:
+                server.stop()
+            self.assertEqual(transcriptions, {f'benchmark_{i:06d}.wav': f'benchmark file number {i}' for i in range(3)})
+            self.assertEqual(len(server.session_times), 3)
+
+    def test_asyncio_shared_sessions(self):
+        #More waiting sessions than the default executor has threads must not starve the sessions holding permits
+        server = MockSTTServer(port=0).start()
+        results = {}
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                run = threading.Thread(target=lambda: results.update(self.transcribe_with(server, tmpdir, 'asyncio', num_files=100, sessions=threading.BoundedSemaphore(2))), daemon=True)
+                run.start()
+                run.join(60)
+                self.assertFalse(run.is_alive())
+        finally:
+            server.stop()
+        self.assertEqual(results, {f'benchmark_{i:06d}.wav': f'benchmark file number {i}' for i in range(100)})
+
+    def test_http_transport_reuses_connections(self):
+        server = MockSTTServer(port=0, http_port=0).start()
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                transcriptions = self.transcribe_with(server, tmpdir, 'threads', 'http', num_files=10)
+        finally:
+            server.stop()
+        self.assertEqual(transcriptions, {f'benchmark_{i:06d}.wav': f'benchmark file number {i}' for i in range(10)})
+        self.assertEqual(len(server.session_times), 10)
+        self.assertLessEqual(server.http_connections, 2)
+
+    def test_http_transport_records_throughput(self):
+        server = MockSTTServer(port=0, http_port=0).start()
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                audio_dir, reference_file = os.path.join(tmpdir, 'audio'), os.path.join(tmpdir, 'ref.csv')
+                write_audio_files(audio_dir, reference_file, 2, 0.1)
+                server.transcripts = load_transcripts(reference_file, audio_dir)
+                config = Config('config.ini.sample')
+                config.setValue('SpeechToText', 'service_url', server.http_url)
+                config.setValue('SpeechToText', 'transport', 'http')
+                config.setValue('SpeechToText', 'bearer_token', 'test')
+                transcriber = transcribe.Transcriber(config)
+                for filename in transcribe.list_audio_files(audio_dir):
+                    self.assertIsNone(transcriber.transcribe(filename))
+                summary = transcriber.metrics.summary()
+        finally:
+            server.stop()
+        #No connect time is recorded for HTTP, the connection is opened inside the request
+        self.assertNotIn('connect_seconds', summary)
+        self.assertEqual(summary['audio_bytes_per_second']['count'], 2)
+
+    def test_batch_jobs_resume(self):
+        server = MockSTTServer(port=0, http_port=0, latency=0.2).start()
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                settings = {'batch_poll_interval': '0.1', 'batch_max_outstanding_jobs': '4', 'batch_wait': 'False'}
+                #Submits the first 4 files and exits before they finish
+                transcriptions = self.transcribe_with(server, tmpdir, 'batch', 'http', 6, settings)
+                self.assertEqual(len(server.jobs), 4)
+                self.assertEqual(set(transcriptions.values()), {''})
+
+                settings['batch_wait'] = 'True'
+                transcriptions = self.transcribe_with(server, tmpdir, 'batch', 'http', 6, settings)
+                with open(os.path.join(tmpdir, 'stt.csv' + batch_jobs.JOBS_SUFFIX)) as f:
+                    statuses = [row['Status'] for row in csv.DictReader(f)]
+        finally:
+            server.stop()
+        self.assertEqual(transcriptions, {f'benchmark_{i:06d}.wav': f'benchmark file number {i}' for i in range(6)})
+        self.assertEqual(statuses.count(batch_jobs.SUBMITTED), 6)
+        self.assertEqual(statuses.count(batch_jobs.COLLECTED), 6)
+        self.assertEqual(len(server.jobs), 0)
+
+    def test_custom_transaction_ids(self):
+        settings = {'custom_transaction_id': 'True', 'batch_poll_interval': '0.1'}
+        for transcription_mode, transport in [('threads', 'websocket'), ('asyncio', 'websocket'), ('threads', 'http'), ('batch', 'http')]:
+            server = MockSTTServer(port=0, http_port=0).start()
+            try:
+                with tempfile.TemporaryDirectory() as tmpdir:
+                    self.transcribe_with(server, tmpdir, transcription_mode, transport, 8, settings)
+            finally:
+                server.stop()
+            #Every file arrives with its own transaction ID
+            self.assertEqual(len(server.transaction_ids), 8)
+            self.assertEqual(len(set(server.transaction_ids.values())), 8)
+
+    def test_throttled_connections_fail(self):
+        server = MockSTTServer(port=0, throttle_rate=1.0).start()
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                transcriptions = self.transcribe_with(server, tmpdir, 'asyncio')
+                self.assertTrue(os.path.exists(os.path.join(tmpdir, 'stt.csv' + transcribe.FAILURES_SUFFIX)))
+        finally:
+            server.stop()
+        #Rows come from the merge with the reference file
+        self.assertEqual(set(transcriptions.values()), {''})
+        self.assertEqual(server.rejected, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
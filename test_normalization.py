@@ -0,0 +1,48 @@
+import unittest
+from nltk.stem.porter import PorterStemmer
+from config import Config
+from analyze import Analyzer
+
+TEXTS = ["Hello, World!  This is   a TEST.", "\tUh the cats' toys\nwere,  uhuh ... running %HESITATION ",
+         "umbrellas aren't um-brellas", "", "   ", "Dr. Smith's 3.5% raise -- it's \"great\"\r\n"]
+
+def getInstance(**transformations):
+    c = Config('config.ini.sample')
+    c.setValue('Transformations', 'remove_word_list', 'uh,um,%hesitation')
+    for key, value in transformations.items():
+        c.setValue('Transformations', key, value)
+    return Analyzer(c)
+
+def expected(analyzer, text):
+    cleaned = analyzer.transformation(text)
+    if analyzer.config.getBoolean('Transformations', 'stemming'):
+        stemmer = PorterStemmer()
+        cleaned = [stemmer.stem(word) for word in cleaned]
+    return cleaned
+
+
+class MyTest(unittest.TestCase):
+    def test_matches_jiwer_pipeline(self):
+        variants = [{}, {'stemming': 'True'}, {'lower_case': 'False'}, {'remove_white_space': 'False'},
+                    {'remove_multiple_spaces': 'False', 'strip': 'False'}, {'remove_empty_strings': 'False'},
+                    {'remove_punctuation': 'False', 'stemming': 'True'}, {'remove_word_list': ''}]
+        for variant in variants:
+            analyzer = getInstance(**variant)
+            self.assertTrue(analyzer.normalizer.compiled)
+            for text in TEXTS:
+                self.assertEqual(analyzer.normalizer(text), expected(analyzer, text), msg=f"{variant} {text!r}")
+
+    def test_uncompiled_pipeline(self):
+        analyzer = getInstance(sentences_to_words='False')
+        self.assertFalse(analyzer.normalizer.compiled)
+        self.assertEqual(analyzer.normalizer(TEXTS[0]), expected(analyzer, TEXTS[0]))
+
+    def test_words_are_interned(self):
+        normalizer = getInstance(stemming='True').normalizer
+        first, second = normalizer("Running, dogs"), normalizer("running dogs!")
+        self.assertEqual(first, ['run', 'dog'])
+        self.assertTrue(all(a is b for a, b in zip(first, second)))
+
+
+if __name__ == '__main__':
+    unittest.main()
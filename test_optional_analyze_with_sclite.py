@@ -0,0 +1,165 @@
+import unittest, os, sys, csv, json, stat, tempfile
+from config import Config
+import optional_analyze_with_sclite
+
+
+def write_csv(filename, header, rows):
+    with open(filename, 'w', newline='') as f:
+        csv.writer(f).writerows([header] + rows)
+
+
+#Stands in for the sclite executable: a file is correct up to the shorter of its reference and hypothesis,
+#the rest of a longer reference is deleted and the rest of a longer hypothesis inserted
+FAKE_SCLITE = """
+import sys
+from collections import Counter
+args = sys.argv[1:]
+ctm, stm, outputs = args[args.index('-h') + 1], args[args.index('-r') + 1], args[args.index('-o') + 1:]
+hyp = Counter(line.split()[0] for line in open(ctm))
+ref = {line.split()[0]: len(line.split()) - 5 for line in open(stm)}
+c = sum(min(ref[n], hyp[n]) for n in ref)
+d = sum(max(ref[n] - hyp[n], 0) for n in ref)
+i = sum(max(hyp[n] - ref[n], 0) for n in ref)
+se = sum(ref[n] != hyp[n] for n in ref)
+w = sum(ref.values())
+pct = lambda x, total: 100 * x / total
+open(ctm + '.sys', 'w').write(f"| Sum/Avg | {len(ref)} {w} | {pct(c, w):.1f} 0.0 {pct(d, w):.1f} {pct(i, w):.1f} {pct(d + i, w):.1f} {pct(se, len(ref)):.1f} |\\n")
+if 'rsum' in outputs:
+    open(ctm + '.raw', 'w').write(f"| Sum/Avg | {len(ref)} {w} | {c} 0 {d} {i} {d + i} {se} |\\n")
+"""
+
+
+class MyTest(unittest.TestCase):
+    def test_approximate_engine(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reference_file, transcriptions_file = os.path.join(tmpdir, 'ref.csv'), os.path.join(tmpdir, 'stt.csv')
+            write_csv(reference_file, ['Audio File Name', 'Reference'], [['1.wav', 'The cat sat'], ['2.wav', 'a b'], ['3.wav', 'hello world']])
+            write_csv(transcriptions_file, ['Audio File Name', 'Transcription'], [['1.wav', 'the bat sat'], ['2.wav', 'b c'], ['extra.wav', 'ignored']])
+            config = Config('config.ini.sample')
+            config.setValue('Transcriptions', 'reference_transcriptions_file', reference_file)
+            config.setValue('Transcriptions', 'stt_transcriptions_file', transcriptions_file)
+            config.setValue('ErrorRateOutput', 'summary_file', os.path.join(tmpdir, 'summary.json'))
+            config.setValue('ErrorRateOutput', 'sclite_alignments', 'True')
+            config.writeFile(os.path.join(tmpdir, 'config.ini'))
+            optional_analyze_with_sclite.run(os.path.join(tmpdir, 'config.ini'), 'ERROR')
+
+            with open(os.path.join(tmpdir, 'approximate_wer_summary.json')) as f:
+                summary = json.load(f)
+            #sclite's costs align "a b" / "b c" as a deletion and an insertion rather than two substitutions
+            self.assertEqual(summary, [{'task': os.path.basename(tmpdir), 'Substitutions': 14.3, 'Deletions': 42.9, 'Insertions': 14.3,
+                                        'Word Error Rate': 71.4, 'Sentence Error Rate': 100.0, 'Total Words': 7.0, 'Total Sentences': 3.0}])
+
+            analyzer = optional_analyze_with_sclite.Analyzer(config)
+            with open(os.path.join(tmpdir, 'stt.approximate.sys')) as f:
+                totals = [analyzer.get_wer(line) for line in f if 'Sum' in line]
+            self.assertEqual((totals[0]['words'], totals[0]['wer'], totals[0]['ser']), ('7', '71.4', '100.0'))
+
+            with open(os.path.join(tmpdir, 'stt.approximate.prf')) as f:
+                alignment = f.read().split('\n\n')[1].split('\n')
+            self.assertEqual(alignment, ['id: (2.wav)', 'Scores: (#C #S #D #I) 1 0 1 1', 'REF:  A   b ***', 'HYP:  *** b C', 'Eval: D     I'])
+
+    def test_ctm_and_stm_external_sort(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reference_file, transcriptions_file = os.path.join(tmpdir, 'ref.csv'), os.path.join(tmpdir, 'stt.csv')
+            names = [f'{i % 7}.wav' for i in range(20)] + ['my file.wav']
+            write_csv(reference_file, ['Audio File Name', 'Reference'], [[name, f'ref  {i}'] for i, name in enumerate(names)])
+            write_csv(transcriptions_file, ['Audio File Name', 'Transcription'], [[name, f'hyp {i}' if i % 5 else ''] for i, name in enumerate(names)])
+
+            #Chunks of 3 rows are merged into the same order as one sort in memory, ties in file order
+            columns = ['Audio File Name', 'Reference']
+            merged = list(optional_analyze_with_sclite.iter_sorted(reference_file, columns, 3))
+            self.assertEqual(merged, list(optional_analyze_with_sclite.iter_sorted(reference_file, columns)))
+            self.assertEqual(merged, sorted([(name, f'ref  {i}') for i, name in enumerate(names)], key=lambda row: row[0]))
+            self.assertEqual(len(list(optional_analyze_with_sclite.iter_sorted(reference_file, columns, len(names)))), len(names))
+
+            config = Config('config.ini.sample')
+            config.setValue('ErrorRateOutput', 'sclite_sort_chunk_rows', '4')
+            analyzer = optional_analyze_with_sclite.Analyzer(config)
+            analyzer.create_ctm(transcriptions_file)
+            analyzer.create_stm(transcriptions_file, reference_file)
+            with open(os.path.join(tmpdir, 'stt.ctm')) as f:
+                ctm = f.read().splitlines()
+            with open(os.path.join(tmpdir, 'stt.stm')) as f:
+                stm = f.read().splitlines()
+        #Empty transcriptions have no words
+        self.assertEqual(ctm[:4], ['0.wav 1 0 -1 hyp', '0.wav 1 0 -1 7', '0.wav 1 0 -1 hyp', '0.wav 1 0 -1 14'])
+        self.assertEqual(len(ctm), 2 * 16)
+        self.assertEqual(stm[0], '0.wav 1 0 0 1000 ref 0')
+        self.assertEqual(stm[-1], 'my_file.wav 1 0 0 1000 ref 20')
+
+    def test_sharded_sclite(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            sclite = os.path.join(tmpdir, 'sclite')
+            with open(sclite, 'w') as f:
+                f.write(f'#!{sys.executable}\n' + FAKE_SCLITE)
+            os.chmod(sclite, os.stat(sclite).st_mode | stat.S_IEXEC)
+
+            reference_file, transcriptions_file = os.path.join(tmpdir, 'ref.csv'), os.path.join(tmpdir, 'stt.csv')
+            write_csv(reference_file, ['Audio File Name', 'Reference'], [[f'{i}.wav', ' '.join(['word'] * (i % 4 + 1))] for i in range(10)])
+            write_csv(transcriptions_file, ['Audio File Name', 'Transcription'], [[f'{i}.wav', ' '.join(['word'] * (i % 3))] for i in range(10)] + [['extra.wav', 'not scored']])
+            config = Config('config.ini.sample')
+            config.setValue('Transcriptions', 'reference_transcriptions_file', reference_file)
+            config.setValue('Transcriptions', 'stt_transcriptions_file', transcriptions_file)
+            config.setValue('ErrorRateOutput', 'summary_file', os.path.join(tmpdir, 'summary.json'))
+            config.setValue('ErrorRateOutput', 'sclite_engine', 'sclite')
+            config.setValue('ErrorRateOutput', 'sclite_directory', tmpdir)
+
+            summaries = []
+            for shards in ['1', '3']:
+                config.setValue('ErrorRateOutput', 'sclite_shards', shards)
+                config.writeFile(os.path.join(tmpdir, 'config.ini'))
+                with self.assertLogs(level='DEBUG') as logs:
+                    optional_analyze_with_sclite.run(os.path.join(tmpdir, 'config.ini'), 'ERROR')
+                with open(os.path.join(tmpdir, 'sclite_wer_summary.json')) as f:
+                    summaries.append(json.load(f))
+            shard_files = sorted(os.listdir(os.path.join(tmpdir, 'sclite_shards')))
+            with open(os.path.join(tmpdir, 'sclite_shards', 'stt_0.stm')) as f:
+                first_shard = [line.split()[0] for line in f]
+
+        #The merged counts give the same summary as one run over all files
+        self.assertEqual(summaries[0], summaries[1])
+        self.assertEqual([line for line in logs.output if 'extra.wav' in line], ['WARNING:root:extra.wav - No reference transcription found, not scored'])
+        self.assertEqual((summaries[1][0]['Total Words'], summaries[1][0]['Total Sentences']), (23.0, 10.0))
+        self.assertEqual([name for name in shard_files if name.endswith('.raw')], ['stt_0.ctm.raw', 'stt_1.ctm.raw', 'stt_2.ctm.raw'])
+        self.assertEqual(first_shard, ['0.wav', '1.wav', '2.wav', '3.wav'])
+
+    def test_engine_defaults_to_sclite_with_directory(self):
+        config = Config('config.ini.sample')
+        self.assertEqual(optional_analyze_with_sclite.engine_from_config(config), 'approximate')
+        self.assertEqual(optional_analyze_with_sclite.summary_filename(config), 'approximate_wer_summary.json')
+        config.setValue('ErrorRateOutput', 'sclite_directory', '/opt/sctk/bin')
+        self.assertEqual(optional_analyze_with_sclite.engine_from_config(config), 'sclite')
+        self.assertEqual(optional_analyze_with_sclite.summary_filename(config), 'sclite_wer_summary.json')
+        config.setValue('ErrorRateOutput', 'sclite_engine', 'approximate')
+        self.assertEqual(optional_analyze_with_sclite.engine_from_config(config), 'approximate')
+
+    def test_config_without_analysis_section(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            reference_file, transcriptions_file = os.path.join(tmpdir, 'ref.csv'), os.path.join(tmpdir, 'stt.csv')
+            write_csv(reference_file, ['Audio File Name', 'Reference'], [['1.wav', 'hello world']])
+            write_csv(transcriptions_file, ['Audio File Name', 'Transcription'], [['1.wav', 'hello']])
+            config = Config('config.ini.sample')
+            config.config.remove_section('Analysis')
+            config.setValue('Transcriptions', 'reference_transcriptions_file', reference_file)
+            config.setValue('Transcriptions', 'stt_transcriptions_file', transcriptions_file)
+            config.setValue('ErrorRateOutput', 'summary_file', os.path.join(tmpdir, 'summary.json'))
+            summary = optional_analyze_with_sclite.Analyzer(config).score(transcriptions_file, reference_file)
+            self.assertEqual((summary['words'], summary['del']), ([2.0], [50.0]))
+
+            #The sclite engine without the sclite executable's directory is reported, not a crash
+            config.setValue('ErrorRateOutput', 'sclite_engine', 'sclite')
+            config.writeFile(os.path.join(tmpdir, 'config.ini'))
+            with self.assertLogs(level='ERROR') as logs:
+                optional_analyze_with_sclite.run(os.path.join(tmpdir, 'config.ini'), 'ERROR')
+            self.assertIn('sclite_directory', logs.output[0])
+            self.assertFalse(os.path.exists(os.path.join(tmpdir, 'sclite_wer_summary.json')))
+
+    def test_get_wer_does_not_exit(self):
+        analyzer = optional_analyze_with_sclite.Analyzer(Config('config.ini.sample'))
+        self.assertEqual(analyzer.get_wer("| Sum/Avg|  187    764 | 84.9   11.0    4.1    8.4   23.4   49.2 |")['wer'], '23.4')
+        with self.assertRaises(ValueError):
+            analyzer.get_wer("| Sum/Avg | garbage |")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest, os, csv, tempfile
+from unittest import mock
+from config import Config
+from analyze import Analyzer
+from reference_index import ReferenceIndex
+
+REFERENCES = [['1.wav', 'The cats sat.'], ['2.wav', 'Uh, hello   world'], ['3.wav', ''], ['1.wav', 'The cats ran.']]
+HYPOTHESES = [['1.wav', 'the cat ran'], ['2.wav', 'hello word'], ['3.wav', 'noise']]
+
+def write_csv(filename, header, rows):
+    with open(filename, 'w', newline='') as f:
+        csv.writer(f).writerows([header] + rows)
+
+def getInstance(tmpdir, **transformations):
+    c = Config('config.ini.sample')
+    c.setValue('Transcriptions', 'reference_transcriptions_file', os.path.join(tmpdir, 'ref.csv'))
+    c.setValue('Transcriptions', 'stt_transcriptions_file', os.path.join(tmpdir, 'hyp.csv'))
+    c.setValue('Analysis', 'reference_index_directory', os.path.join(tmpdir, 'index'))
+    for key, value in transformations.items():
+        c.setValue('Transformations', key, value)
+    return Analyzer(c)
+
+
+class MyTest(unittest.TestCase):
+    def test_index_matches_normalizing(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_csv(os.path.join(tmpdir, 'ref.csv'), ['Audio File Name', 'Reference'], REFERENCES)
+            write_csv(os.path.join(tmpdir, 'hyp.csv'), ['Audio File Name', 'Transcription'], HYPOTHESES)
+            without_index = getInstance(tmpdir)
+            without_index.config.setValue('Analysis', 'reference_index_directory', '')
+            expected = without_index.analyze()
+
+            built = getInstance(tmpdir).analyze()
+            with mock.patch.object(ReferenceIndex, 'build') as build:
+                loaded = getInstance(tmpdir).analyze()
+                build.assert_not_called()
+            for results in (built, loaded):
+                self.assertEqual(results.get_summary(), expected.get_summary())
+                self.assertEqual([r.data for r in results.results], [r.data for r in expected.results])
+            self.assertEqual(len(os.listdir(os.path.join(tmpdir, 'index'))), 1)
+
+    def test_index_is_invalidated(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            write_csv(os.path.join(tmpdir, 'ref.csv'), ['Audio File Name', 'Reference'], REFERENCES)
+            write_csv(os.path.join(tmpdir, 'hyp.csv'), ['Audio File Name', 'Transcription'], HYPOTHESES)
+            getInstance(tmpdir).analyze()
+            stemmed = getInstance(tmpdir, stemming='True').analyze()
+            self.assertEqual(stemmed.results[0].data['Reference (clean)'], 'the cat ran')
+
+            write_csv(os.path.join(tmpdir, 'ref.csv'), ['Audio File Name', 'Reference'], REFERENCES[:1])
+            changed = getInstance(tmpdir).analyze()
+            self.assertEqual(changed.results[0].data['Reference (clean)'], 'the cats sat')
+            self.assertEqual(len(os.listdir(os.path.join(tmpdir, 'index'))), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
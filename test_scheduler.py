@@ -0,0 +1,97 @@
+import unittest, threading, time
+from scheduler import AdaptiveLimiter, RetryPolicy, TokenBucket, TranscriptionScheduler, classify_error
+
+
+class StatusError(Exception):
+    def __init__(self, status_code):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+class MyTest(unittest.TestCase):
+    def test_classify_throttled(self):
+        self.assertEqual(classify_error(StatusError(429)), (True, True))
+        self.assertEqual(classify_error("Handshake status 503 Service Unavailable"), (True, True))
+
+    def test_classify_transient(self):
+        self.assertEqual(classify_error(StatusError(502)), (True, False))
+        self.assertEqual(classify_error(ConnectionResetError()), (True, False))
+
+    def test_classify_permanent(self):
+        self.assertEqual(classify_error(StatusError(400)), (False, False))
+        self.assertEqual(classify_error("No speech detected for 30s."), (False, False))
+
+    def test_retry_delay_is_bounded(self):
+        policy = RetryPolicy(max_retries=5, base_delay=1.0, max_delay=4.0)
+        for attempt in range(10):
+            self.assertTrue(0 <= policy.delay(attempt) <= 4.0)
+
+    def test_token_bucket_burst_then_wait(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertGreater(bucket.reserve(), 0.0)
+
+    def test_adaptive_limiter_aimd(self):
+        limiter = AdaptiveLimiter(8, minimum=1, maximum=16)
+        limiter.acquire()
+        limiter.release(False, 0.1, throttled=True)
+        self.assertEqual(int(limiter.limit), 4)
+        for _ in range(20):
+            limiter.acquire()
+            limiter.release(True, 0.1)
+        self.assertGreater(limiter.limit, 4)
+
+    def test_scheduler_retries_then_records_failure(self):
+        attempts = {}
+        def task(filename):
+            attempts[filename] = attempts.get(filename, 0) + 1
+            if filename == 'bad.wav':
+                return StatusError(503)
+            if attempts[filename] < 2:
+                return ConnectionResetError()
+            return None
+
+        scheduler = TranscriptionScheduler(task, 2, RetryPolicy(max_retries=2, base_delay=0.0))
+        self.assertEqual(scheduler.run(['good.wav', 'bad.wav']), 2)
+        self.assertEqual(attempts['good.wav'], 2)
+        self.assertEqual(attempts['bad.wav'], 3)
+        self.assertEqual(list(scheduler.failures.keys()), ['bad.wav'])
+        self.assertEqual(scheduler.failures['bad.wav'][0], 3)
+
+    def test_task_that_raises_releases_its_slots(self):
+        def task(filename):
+            raise FileNotFoundError(filename)
+
+        sessions = threading.Semaphore(1)
+        scheduler = TranscriptionScheduler(task, 1, RetryPolicy(max_retries=0), concurrency=AdaptiveLimiter(1), sessions=sessions)
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(scheduler.run(['missing1.wav', 'missing2.wav']), 2)
+        self.assertEqual(sorted(scheduler.failures.keys()), ['missing1.wav', 'missing2.wav'])
+        self.assertIsInstance(scheduler.failures['missing1.wav'][1], FileNotFoundError)
+        self.assertEqual(scheduler.concurrency.in_flight, 0)
+        self.assertTrue(sessions.acquire(blocking=False))
+
+    def test_shared_session_budget(self):
+        lock = threading.Lock()
+        state = {'in_flight': 0, 'peak': 0}
+        def task(filename):
+            with lock:
+                state['in_flight'] += 1
+                state['peak'] = max(state['peak'], state['in_flight'])
+            time.sleep(0.01)
+            with lock:
+                state['in_flight'] -= 1
+            return None
+
+        sessions = threading.Semaphore(3)
+        schedulers = [TranscriptionScheduler(task, 4, RetryPolicy(), sessions=sessions) for _ in range(2)]
+        threads = [threading.Thread(target=s.run, args=([f'{i}.wav' for i in range(12)],)) for s in schedulers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(state['peak'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest, os, tempfile
+from config import Config
+from transcribe import Transcriptions, Transcriber, JOURNAL_SUFFIX
+from word_details import load_word_details
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+
+def result(transcript, final=True):
+    return {'results': [{'final': final, 'alternatives': [{'transcript': transcript}]}]}
+
+
+class MyTest(unittest.TestCase):
+    def test_journal_keeps_last_row(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            transcriptions = Transcriptions(os.path.join(tmpdir, 'stt.csv' + JOURNAL_SUFFIX))
+            in_memory = Transcriptions()
+            for t in (transcriptions, in_memory):
+                t.add('a.wav', 'partial')
+                t.add('b.wav', 'other')
+                t.add('a.wav', 'final full text')
+            transcriptions.close()
+            self.assertEqual(transcriptions.getData(), {'a.wav': 'final full text', 'b.wav': 'other'})
+            self.assertEqual(transcriptions.getData(), in_memory.getData())
+
+    def test_only_successful_final_results_are_stored(self):
+        config = Config('config.ini.sample')
+        config.setValue('SpeechToText', 'bearer_token', 'test')
+        transcriber = Transcriber(config)
+
+        callback = transcriber.make_callback('a.wav')
+        callback.on_data(result('hello wor', final=False))
+        callback.on_data(result('hello world'))
+        self.assertIsNone(transcriber.get_outcome(callback))
+
+        #A retry after a result and then an error stores nothing, so the file is not skipped on resume
+        callback = transcriber.make_callback('b.wav')
+        callback.on_data(result('partial'))
+        callback.on_error('connection reset')
+        self.assertEqual(transcriber.get_outcome(callback), 'connection reset')
+
+        self.assertEqual(transcriber.transcriptions.getData(), {'a.wav': 'hello world'})
+        self.assertEqual(transcriber.transcriptions.completed(), {'a.wav'})
+
+    @unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+    def test_word_details_of_final_results_only(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            config = Config('config.ini.sample')
+            config.setValue('SpeechToText', 'bearer_token', 'test')
+            config.setValue('Transcriptions', 'word_details_file', os.path.join(tmpdir, 'words.parquet'))
+            transcriber = Transcriber(config)
+            for name, error in (('a.wav', None), ('b.wav', 'connection reset')):
+                callback = transcriber.make_callback(name)
+                callback.on_data(result('hello wor', final=False))
+                callback.on_data(result('hello world'))
+                if error is not None:
+                    callback.on_error(error)
+                transcriber.get_outcome(callback)
+            transcriber.word_details.close()
+            rows = load_word_details(os.path.join(tmpdir, 'words.parquet'), ['Audio File Name', 'Word']).to_pylist()
+        self.assertEqual([(row['Audio File Name'], row['Word']) for row in rows], [('a.wav', 'hello'), ('a.wav', 'world')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest, os, shutil, tempfile, time
+from transcription_cache import TranscriptionCache
+
+
+class MyTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.dir, 'cache')
+        self.audio = os.path.join(self.dir, 'audio.wav')
+        with open(self.audio, 'wb') as f:
+            f.write(b'RIFF-not-really-audio')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_miss_then_hit(self):
+        c = TranscriptionCache(self.cache_dir, 1024 * 1024)
+        key = c.make_key(self.audio, {'model': 'en-US_Telephony'})
+        self.assertEqual(c.get(key), None)
+        c.put(key, 'hello world')
+        self.assertEqual(c.get(key), 'hello world')
+
+    def test_key_ignores_file_name(self):
+        copy = os.path.join(self.dir, 'copy.wav')
+        shutil.copyfile(self.audio, copy)
+        c = TranscriptionCache(self.cache_dir, 1024 * 1024)
+        self.assertEqual(c.make_key(self.audio, {}), c.make_key(copy, {}))
+
+    def test_key_normalizes_params(self):
+        c = TranscriptionCache(self.cache_dir, 1024 * 1024)
+        a = c.make_key(self.audio, {'speech_detector_sensitivity': 0.5, 'customization_weight': None, 'inactivity_timeout': -1})
+        b = c.make_key(self.audio, {'inactivity_timeout': -1.0, 'speech_detector_sensitivity': 0.5})
+        self.assertEqual(a, b)
+
+    def test_key_changes_with_params(self):
+        c = TranscriptionCache(self.cache_dir, 1024 * 1024)
+        self.assertNotEqual(c.make_key(self.audio, {'speech_detector_sensitivity': 0.5}),
+                            c.make_key(self.audio, {'speech_detector_sensitivity': 0.6}))
+
+    def test_evicts_least_recently_used(self):
+        c = TranscriptionCache(self.cache_dir, 1024 * 1024)
+        c.put('aa1', 'x' * 100)
+        entry_size = c.size_bytes
+        c.max_size_bytes = entry_size * 2
+        c.put('bb2', 'x' * 100)
+        past = time.time() - 60
+        os.utime(c.get_path('aa1'), (past, past))
+        os.utime(c.get_path('bb2'), (past + 1, past + 1))
+        c.get('aa1')
+        c.put('cc3', 'x' * 100)
+        self.assertEqual(c.get('bb2'), None)
+        self.assertEqual(c.get('aa1'), 'x' * 100)
+        self.assertEqual(c.get('cc3'), 'x' * 100)
+
+    def test_eviction_does_not_scan_directory(self):
+        c = TranscriptionCache(self.cache_dir, 1024 * 1024)
+        c.put('aa1', 'x' * 100)
+        c.max_size_bytes = c.size_bytes * 2
+        c.entries = lambda: self.fail("scanned the cache directory")
+        for key in ('bb2', 'cc3', 'dd4'):
+            c.put(key, 'x' * 100)
+        self.assertEqual([c.get(key) for key in ('aa1', 'bb2')], [None, None])
+        self.assertEqual(len(c.index), 2)
+
+        #A reopened cache finds the remaining entries
+        self.assertEqual(TranscriptionCache(self.cache_dir, c.max_size_bytes).size_bytes, c.size_bytes)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest, random
+import jiwer
+import numpy as np
+import wer_engine
+
+
+class MyTest(unittest.TestCase):
+    def test_to_words(self):
+        self.assertEqual(wer_engine.to_words(['a', ' b  c ', '', ' ']), ['a', 'b', 'c'])
+        self.assertEqual(wer_engine.to_words('the  quick fox '), ['the', 'quick', 'fox'])
+
+    def test_matches_jiwer(self):
+        pairs = [(['i', 'will', 'prescribe', 'you', 'some', 'vicodin'], ['i', 'will', 'prescribe', 'you', 'some', 'vicating']),
+                 (['ibuprofen', 'is', 'good', 'for', 'your', 'muscle', 'aches'], ['i', 'be', 'profine', 'is', 'good', 'for', 'your', 'muscle', 'lakes']),
+                 (['take', 'two', 'tylenol'], ['take', 'two', 'tylenol']),
+                 (['take', 'two', 'tylenol'], []),
+                 (['a', 'b', 'c', 'd'], ['a', 'c'])]
+        for (ref, hyp), measures in zip(pairs, wer_engine.batch_measures(pairs)):
+            expected = jiwer.compute_measures(ref, hyp)
+            for key in expected:
+                self.assertAlmostEqual(measures[key], expected[key], msg=f"{key} for {ref} / {hyp}")
+
+    def test_all_measures_match_jiwer(self):
+        #A small vocabulary makes many ambiguous alignments, which must be split as jiwer splits them
+        rng = random.Random(0)
+        vocabulary = ['w%d' % i for i in range(8)]
+        pairs = [([rng.choice(vocabulary) for _ in range(rng.randint(1, 15))],
+                  [rng.choice(vocabulary) for _ in range(rng.randint(0, 15))]) for _ in range(2000)]
+        for (ref, hyp), measures in zip(pairs, wer_engine.batch_measures(pairs, batch_size=64)):
+            expected = jiwer.compute_measures(ref, hyp)
+            for key in expected:
+                self.assertAlmostEqual(measures[key], expected[key], msg=f"{key} for {ref} / {hyp}")
+
+    def test_word_ids_beyond_unicode(self):
+        #IDs of a vocabulary larger than Unicode, or in the surrogate range, are renumbered per pair
+        ref = np.array([0xD800, 0x110005, 7, 0x110005], dtype=np.int64)
+        hyp = np.array([0xD800, 8, 7], dtype=np.int64)
+        self.assertEqual(wer_engine.editops_counts([ref], [hyp]).tolist(), [[2, 1, 1, 0]])
+        long_ref = np.arange(0xD900, dtype=np.int64)
+        long_hyp = long_ref.copy()
+        long_hyp[-1] = -1
+        self.assertEqual(wer_engine.editops_counts([long_ref], [long_hyp]).tolist(), [[0xD8FF, 1, 0, 0]])
+
+    def test_weighted_counts_match_alignment(self):
+        rng = random.Random(1)
+        vocabulary = wer_engine.Vocabulary()
+        pairs = [([rng.choice('abcde') for _ in range(rng.randint(0, 12))], [rng.choice('abcde') for _ in range(rng.randint(0, 12))]) for _ in range(300)]
+        counts = wer_engine.batch_edit_counts([vocabulary.encode(ref) for ref, _ in pairs], [vocabulary.encode(hyp) for _, hyp in pairs], 32, (4, 3, 3))
+        for (ref, hyp), count in zip(pairs, counts):
+            ops = [op for op, _, _ in wer_engine.weighted_align(ref, hyp, (4, 3, 3))]
+            self.assertEqual([ops.count(op) for op in 'CSDI'], count.tolist())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import unittest, os, math, tempfile
+from word_details import WordDetailsWriter, load_word_details, PARTS_SUFFIX
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+RESULTS = [{"final": True, "alternatives": [
+               {"transcript": "hello world ", "confidence": 0.9,
+                "timestamps": [["hello", 0.1, 0.5], ["world", 0.6, 1.0]],
+                "word_confidence": [["hello", 0.95], ["world", 0.8]]},
+               {"transcript": "hollow world "}]},
+           {"final": True, "alternatives": [{"transcript": "again ", "confidence": 0.7, "timestamps": [["again", 1.5, 2.0]]}]}]
+
+
+@unittest.skipIf(pyarrow is None, "pyarrow is not installed")
+class MyTest(unittest.TestCase):
+    def test_parquet(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'words.parquet')
+            writer = WordDetailsWriter(filename, row_group_size=2)
+            writer.add('a.wav', RESULTS)
+            writer.aliases['segment.wav'] = ('b.wav', 60.0)
+            writer.add('segment.wav', RESULTS[1:])
+            writer.close()
+
+            rows = load_word_details(filename).to_pylist()
+            self.assertEqual([row['Word'] for row in rows], ['hello', 'world', 'hollow', 'world', 'again', 'again'])
+            self.assertAlmostEqual(rows[1]['Word Confidence'], 0.8, places=6)
+            self.assertEqual([row['Alternative'] for row in rows[:4]], [0, 0, 1, 1])
+            self.assertTrue(math.isnan(rows[2]['Start']))
+            self.assertEqual((rows[5]['Audio File Name'], rows[5]['Start'], rows[5]['Result']), ('b.wav', 61.5, 0))
+
+            table = load_word_details(filename, ['Audio File Name', 'Word Confidence'])
+            self.assertEqual(table.column_names, ['Audio File Name', 'Word Confidence'])
+
+            #A checkpointed run keeps the words of the earlier run
+            writer = WordDetailsWriter(filename, keep_existing=True)
+            writer.add('c.wav', RESULTS[1:])
+            writer.close()
+            self.assertEqual(load_word_details(filename).num_rows, 7)
+
+    def test_resume_after_crash(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'words.parquet')
+            writer = WordDetailsWriter(filename, keep_existing=True)
+            writer.add('a.wav', RESULTS)
+            writer.add('b.wav', RESULTS[1:])
+            #The run crashes without closing the writer
+            writer.sink.close()
+
+            writer = WordDetailsWriter(filename, keep_existing=True)
+            writer.add('b.wav', RESULTS[:1])
+            writer.add('c.wav', RESULTS[1:])
+            writer.close()
+
+            rows = load_word_details(filename, ['Audio File Name', 'Word']).to_pylist()
+            self.assertFalse(os.path.exists(filename + PARTS_SUFFIX))
+        #b.wav has the rows of the later run only
+        self.assertEqual([(row['Audio File Name'], row['Word']) for row in rows],
+                         [('a.wav', w) for w in ['hello', 'world', 'hollow', 'world', 'again']] +
+                         [('b.wav', w) for w in ['hello', 'world', 'hollow', 'world']] + [('c.wav', 'again')])
+
+    def test_arrow_ipc(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'words.arrow')
+            writer = WordDetailsWriter(filename)
+            writer.add('a.wav', RESULTS)
+            writer.close()
+            self.assertEqual(load_word_details(filename, ['Word'])['Word'].to_pylist(), ['hello', 'world', 'hollow', 'world', 'again'])
+
+            #Row groups streamed from the existing file and several parts share one dictionary of file names
+            writer = WordDetailsWriter(filename, keep_existing=True, row_group_size=2)
+            writer.add('b.wav', RESULTS[1:])
+            writer.add('c.wav', RESULTS[:1])
+            writer.close()
+            with pyarrow.OSFile(filename) as f:
+                reader = pyarrow.ipc.open_file(f)
+                sizes = [reader.get_batch(i).num_rows for i in range(reader.num_record_batches)]
+            names = load_word_details(filename, ['Audio File Name'])['Audio File Name']
+        self.assertEqual(sizes, [2, 2, 2, 2, 2])
+        self.assertEqual(names.to_pylist(), ['a.wav'] * 5 + ['b.wav'] + ['c.wav'] * 4)
+        self.assertEqual(names.chunk(0).dictionary.to_pylist(), ['a.wav', 'b.wav', 'c.wav'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,15 +5,21 @@ import os
 import sys
 import re
 import csv
-import concurrent.futures
 import threading
-from typing import Dict, List, Optional, Any
+import time
+from typing import Dict, List, Optional, Any, Set
 from config import Config
 import logging
 
 from ibm_watson import SpeechToTextV1
 from ibm_watson.websocket import RecognizeCallback, AudioSource
+from ibm_cloud_sdk_core.http_adapter import SSLHTTPAdapter
 from auth import create_stt_service
+from transcription_cache import TranscriptionCache
+from scheduler import TranscriptionScheduler
+from metrics import MetricsRecorder
+from audio_segments import AudioSegmenter
+from word_details import WordDetailsWriter
 
 import os.path
 from os import path
@@ -27,12 +33,25 @@ DEFAULT_LOGLEVEL='DEBUG'
 
 FILE_EXTENSIONS = ("mp3", "mpeg", "ogg", "wav", "webm", "opus")
 
+#Recognize parameters the HTTP recognize interface does not accept
+WEBSOCKET_ONLY_PARAMS = ("interim_results", "skip_zero_len_words")
+
+JOURNAL_COLUMNS = ['Audio File Name','Transcription']
+JOURNAL_SUFFIX = ".journal.csv"
+FAILURES_SUFFIX = ".failed.csv"
+
 class Transcriptions:
     """
     Class to store and manage transcription results.
+
+    When a journal file is given, each result is appended to the journal as soon as it is added
+    instead of being held in memory, so an interrupted run can be resumed.
     """
-    def __init__(self):
+    def __init__(self, journal_file: Optional[str] = None):
         self.data: Dict[str, str] = {}
+        self.journal_file: Optional[str] = journal_file
+        self.journal = None
+        self.lock = threading.Lock()
 
     def add(self, transcriptionKey: str, transcriptionValue: str) -> None:
         """
@@ -42,7 +61,53 @@ class Transcriptions:
             transcriptionKey: Audio file name
             transcriptionValue: Transcription text
         """
-        self.data[transcriptionKey] = transcriptionValue
+        if self.journal_file is None:
+            self.data[transcriptionKey] = transcriptionValue
+            return
+
+        with self.lock:
+            if self.journal is None:
+                write_header = not path.exists(self.journal_file) or os.path.getsize(self.journal_file) == 0
+                self.journal = open(self.journal_file, 'a', newline='', encoding='utf-8')
+                if write_header:
+                    csv.writer(self.journal).writerow(JOURNAL_COLUMNS)
+            csv.writer(self.journal).writerow([transcriptionKey, transcriptionValue])
+            self.journal.flush()
+
+    def close(self) -> None:
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    def items(self):
+        """
+        Iterate over (audio file name, transcription) pairs.  A file journaled more than once (e.g. by a
+        later run) has its last transcription, as it would in memory.
+        """
+        if self.journal_file is None:
+            yield from self.data.items()
+            return
+
+        if not path.exists(self.journal_file):
+            return
+        latest: Dict[str, str] = {}
+        with open(self.journal_file, newline='', encoding='utf-8') as journal:
+            reader = csv.reader(journal)
+            next(reader, None)
+            for row in reader:
+                if len(row) == 2:
+                    latest[row[0]] = row[1]
+        yield from latest.items()
+
+    def completed(self) -> Set[str]:
+        """
+        Get the names of audio files that already have a transcription.
+
+        Returns:
+            Set of audio file names
+        """
+        return {key for key, _ in self.items()}
 
     def getData(self) -> Dict[str, str]:
         """
@@ -51,37 +116,72 @@ class Transcriptions:
         Returns:
             Dict mapping audio file names to transcriptions
         """
-        return self.data
+        if self.journal_file is None:
+            return self.data
+        return dict(self.items())
 
 class MyRecognizeCallback(RecognizeCallback):
     """
     Callback handler for Watson STT websocket recognition.
     """
 
-    def __init__(self, audio_file_name: str, transcriptions: Transcriptions):
+    def __init__(self, audio_file_name: str, transcriptions: Transcriptions, word_details: Optional[WordDetailsWriter] = None):
         RecognizeCallback.__init__(self)
         self.audio_file_name: str = audio_file_name
         self.transcriptions: Transcriptions = transcriptions
+        self.word_details: Optional[WordDetailsWriter] = word_details
+        self.transcription: Optional[str] = None
+        #Full results, kept when word details are saved
+        self.results: Optional[List[Any]] = None
+        self.error: Optional[Any] = None
+        #Timestamps for metrics
+        self.started: float = time.monotonic()
+        self.connected: Optional[float] = None
+        #When audio starts to be sent: on connecting for websockets, with the request for HTTP
+        self.audio_started: Optional[float] = None
+        self.finished: Optional[float] = None
         logging.debug(f"Initialized callback for {audio_file_name}")
 
+    def on_connected(self):
+        self.connected = time.monotonic()
+        self.audio_started = self.connected
+
     def on_data(self, data):
         #print(json.dumps(data, indent=2))
         try:
+            #Interim results are superseded by the final ones
+            if not all(result.get("final", True) for result in data['results']):
+                return
             transcription = ""
             for result in data['results']:
                 transcription += result["alternatives"][0]["transcript"]
             #print(transcription)
-            self.transcriptions.add(self.audio_file_name, transcription)
+            self.finished = time.monotonic()
+            self.transcription = transcription
+            if self.word_details is not None:
+                self.results = data['results']
         except KeyError as e:
             logging.exception(f"{self.audio_file_name} - Missing key(s) in transcription data: {e}")
         except Exception as e:
             logging.exception(f"{self.audio_file_name} - Error processing transcription: {e}")
 
+    def commit(self) -> None:
+        """
+        Store the transcription and word details of a successful recognize session.  Sessions that end with
+        an error store nothing, so their files are transcribed again when a run is resumed.
+        """
+        #Word rows are written first, so a journaled file always has its word details
+        if self.word_details is not None:
+            self.word_details.add(self.audio_file_name, self.results)
+        self.transcriptions.add(self.audio_file_name, self.transcription)
+
     def on_error(self, error):
+        self.error = error
         logging.error(f'{self.audio_file_name} - Recognize Error received: {error}')
         logging.exception(f"Error transcribing {self.audio_file_name}:",exc_info=error)
 
     def on_inactivity_timeout(self, error):
+        self.error = error
         logging.error(f'{self.audio_file_name} - Inactivity timeout: {error}')
 
 class Transcriber:
@@ -89,7 +189,23 @@ class Transcriber:
     def __init__(self, config):
         self.config = config
         self.STT = create_stt_service(config)
-        self.transcriptions = Transcriptions()
+        journal_file = None
+        #Batch jobs outlive the process, so their results are always journaled
+        if config.getBoolean("Transcriptions", "checkpoint") or config.getValue("SpeechToText", "transcription_mode") == "batch":
+            journal_file = config.getValue("Transcriptions", "stt_transcriptions_file") + JOURNAL_SUFFIX
+        self.transcriptions = Transcriptions(journal_file)
+        self.cache = TranscriptionCache.from_config(config)
+        self.metrics = MetricsRecorder.from_config(config)
+        self.word_details = WordDetailsWriter.from_config(config)
+        self.transport = config.getValue("SpeechToText", "transport", "websocket") or "websocket"
+        if self.transport == "http":
+            self.configure_http_pool(int(config.getValue("SpeechToText", "max_threads", 1) or 1))
+        self.failures: Dict[str, Any] = {}
+        self.custom_transaction_id = config.getBoolean("SpeechToText", "custom_transaction_id")
+        #Last transaction ID sent for each audio file
+        self.transaction_ids: Dict[str, str] = {}
+        #Segments of long audio files, left out of the report in favour of the stitched transcription
+        self.segment_files: Set[str] = set()
         self.audio_types = {}
         self.audio_types["wav"]  = "audio/wav"
         self.audio_types["mp3"]  = "audio/mp3"
@@ -98,6 +214,30 @@ class Transcriber:
         self.audio_types["webm"]  = "audio/webm"
         self.audio_types["opus"]  = "audio/webm"
 
+    def configure_http_pool(self, pool_size: int) -> None:
+        """
+        Size the keep-alive connection pool of the service's HTTP session so every transcription thread
+        can reuse a connection (and its TLS session) instead of opening a new one per request.
+        """
+        adapter = SSLHTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size),
+                                 _disable_ssl_verification=self.STT.disable_ssl_verification)
+        http_client = self.STT.get_http_client()
+        http_client.mount('https://', adapter)
+        http_client.mount('http://', adapter)
+        logging.debug(f"Using HTTP recognize with a pool of up to {pool_size} connections")
+
+    def request_headers(self, filename: str) -> Dict[str, str]:
+        """
+        Headers for one recognize request for `filename`.  The transaction ID is passed with the request
+        rather than set in the service's default headers, which all threads share.
+        """
+        if not self.custom_transaction_id:
+            return {}
+        transaction_id = str("{}".format(datetime.now().strftime('%Y%m-%d%H-%M%S-') + str(uuid4())))
+        self.transaction_ids[filename] = transaction_id
+        logging.debug(f"{filename} --> Transaction ID: {transaction_id}")
+        return {'X-Global-Transaction-Id': transaction_id}
+
     def getAudioType(self, file: str) -> Optional[str]:
         try:
             filetype = file.lower().split(".")[-1]
@@ -106,9 +246,13 @@ class Transcriber:
             logging.debug(f"Error determining audio type for {file}: {e}")
             return None
 
-    def transcribe(self, filename):
-        logging.debug(f"Transcribing file: {filename}")
+    def get_recognize_params(self) -> Dict[str, Any]:
+        """
+        Build the recognize parameters from the [SpeechToText] configuration.
 
+        Returns:
+            Dict of keyword arguments shared by every recognize request
+        """
         #Model connection configs
         base_model                = self.config.getValue("SpeechToText", "base_model_name")
         language_customization_id = self.config.getValue("SpeechToText", "language_model_id")
@@ -126,6 +270,11 @@ class Transcriber:
             customization_weight         = float(self.config.getValue("SpeechToText", "customization_weight"))
         else:
             customization_weight = None
+        if self.word_details is not None:
+            word_details = dict(timestamps=True, word_confidence=True,
+                                max_alternatives=int(self.config.getValue("SpeechToText", "max_alternatives", 1) or 1))
+        else:
+            word_details = {}
 
         #Boolean configs
         interim_results              = self.config.getBoolean("SpeechToText", "interim_results")
@@ -133,56 +282,169 @@ class Transcriber:
         smart_formatting             = self.config.getBoolean("SpeechToText", "smart_formatting")
         low_latency                  = self.config.getBoolean("SpeechToText", "low_latency")
         skip_zero_len_words          = self.config.getBoolean("SpeechToText", "skip_zero_len_words")
-        custom_transaction_id        = self.config.getBoolean("SpeechToText", "custom_transaction_id")
 
-        callback = MyRecognizeCallback(filename, self.transcriptions)
+        return dict(
+            model=base_model,
+            language_customization_id=language_customization_id,
+            acoustic_customization_id=acoustic_customization_id,
+            grammar_name=grammar_name,
+            end_of_phrase_silence_time=end_of_phrase_silence_time,
+            inactivity_timeout=inactivity_timeout,
+            speech_detector_sensitivity=speech_detector_sensitivity,
+            background_audio_suppression=background_audio_suppression,
+            smart_formatting=smart_formatting,
+            smart_formatting_version=smart_formatting_version,
+            low_latency=low_latency,
+            skip_zero_len_words=skip_zero_len_words,
+            character_insertion_bias=character_insertion_bias,
+            customization_weight=customization_weight,
+            #At most one of interim_results and audio_metrics can be True
+            interim_results=interim_results,
+            audio_metrics=audio_metrics,
+            **word_details
+        )
+
+    def get_cached(self, filename: str, recognize_params: Dict[str, Any]):
+        """
+        Look up a previous transcription of this audio with identical recognize parameters.
+
+        Returns:
+            Tuple of (cache key, cached transcription); both None when caching is disabled,
+            and the transcription is None on a cache miss
+        """
+        if self.cache is None:
+            return None, None
+        try:
+            cache_key = self.cache.make_key(filename, dict(recognize_params, content_type=self.getAudioType(filename)))
+        except OSError as e:
+            logging.warning(f"{filename} - Unable to compute transcription cache key: {e}")
+            return None, None
+        entry = self.cache.get_entry(cache_key)
+        if entry is None or (self.word_details is not None and "results" not in entry):
+            return cache_key, None
+        transcription = entry["transcription"]
+        logging.debug(f"{filename} - Using cached transcription")
+        if self.word_details is not None:
+            self.word_details.add(filename, entry["results"])
+        self.transcriptions.add(filename, transcription)
+        return cache_key, transcription
+
+    def store_cached(self, cache_key: Optional[str], callback: MyRecognizeCallback) -> None:
+        if cache_key is not None and callback.transcription is not None and callback.error is None:
+            self.cache.put(cache_key, callback.transcription, callback.results)
+
+    def make_callback(self, filename: str) -> MyRecognizeCallback:
+        return MyRecognizeCallback(filename, self.transcriptions, self.word_details)
+
+    def record_metrics(self, filename: str, callback: MyRecognizeCallback) -> None:
+        """
+        Record connect time, time to the final result and audio throughput of a recognize session.
+        """
+        if callback.connected is not None:
+            self.metrics.observe("connect_seconds", callback.connected - callback.started, filename)
+        if callback.finished is not None:
+            self.metrics.observe("time_to_final_result_seconds", callback.finished - callback.started, filename)
+            if callback.audio_started is not None and callback.finished > callback.audio_started:
+                try:
+                    audio_bytes = os.path.getsize(filename)
+                except OSError:
+                    return
+                self.metrics.observe("audio_bytes_per_second", audio_bytes / (callback.finished - callback.audio_started), filename)
+
+    def get_outcome(self, callback: MyRecognizeCallback) -> Optional[Any]:
+        """
+        Store the transcription of a recognize session that ended without an error.
+
+        Returns:
+            None if the recognize session produced a transcription, otherwise the error that occurred
+        """
+        if callback.error is not None:
+            return callback.error
+        if callback.transcription is None:
+            return ConnectionError("Connection closed before a transcription was received")
+        callback.commit()
+        return None
+
+    def transcribe(self, filename) -> Optional[Any]:
+        """
+        Transcribe one audio file into `self.transcriptions`.
+
+        Returns:
+            None on success, otherwise the error that occurred
+        """
+        logging.debug(f"Transcribing file: {filename}")
+
+        recognize_params = self.get_recognize_params()
+
+        cache_key, cached = self.get_cached(filename, recognize_params)
+        if cached is not None:
+            self.metrics.increment("cache_hits")
+            return None
 
-        if custom_transaction_id:
-            transaction_id = str("{}".format(datetime.now().strftime('%Y%m-%d%H-%M%S-') + str(uuid4())))
-            new_headers = self.STT.default_headers.copy() if self.STT.default_headers else {}
-            new_headers['X-Global-Transaction-Id'] = transaction_id
-            self.STT.set_default_headers(new_headers)
-            logging.debug(f"--> Transaction ID: {transaction_id}")
+        callback = self.make_callback(filename)
+
+        headers = self.request_headers(filename)
 
         #print(f"Requesting transcription of {filename}")
-        with open(filename, "rb") as audio_file:
-            try:
-                self.STT.recognize_using_websocket(audio=AudioSource(audio_file),
-                    content_type=self.getAudioType(filename),
-                    recognize_callback=callback,
-                    model=base_model,
-                    language_customization_id=language_customization_id,
-                    acoustic_customization_id=acoustic_customization_id,
-                    grammar_name=grammar_name,
-                    end_of_phrase_silence_time=end_of_phrase_silence_time,
-                    inactivity_timeout=inactivity_timeout,
-                    speech_detector_sensitivity=speech_detector_sensitivity,
-                    background_audio_suppression=background_audio_suppression,
-                    smart_formatting=smart_formatting,
-                    smart_formatting_version=smart_formatting_version,
-                    low_latency=low_latency,
-                    skip_zero_len_words=skip_zero_len_words,
-                    character_insertion_bias=character_insertion_bias,
-                    customization_weight=customization_weight,
-                    #At most one of interim_results and audio_metrics can be True
-                    interim_results=interim_results,
-                    audio_metrics=audio_metrics
-                )
-                #print(f"Requested transcription of {filename}")
-            except Exception as e:
-                logging.exception(f"Error transcribing {filename}: {str(e)}")
+        try:
+            with open(filename, "rb") as audio_file:
+                if self.transport == "http":
+                    #The connection is opened (or reused from the pool) inside the request, so there is no
+                    #separate connect time: it counts towards the time to the final result and the throughput
+                    callback.audio_started = time.monotonic()
+                    response = self.STT.recognize(audio=audio_file,
+                        content_type=self.getAudioType(filename),
+                        headers=headers,
+                        **{k: v for k, v in recognize_params.items() if k not in WEBSOCKET_ONLY_PARAMS}
+                    )
+                    callback.on_data(response.get_result())
+                else:
+                    self.STT.recognize_using_websocket(audio=AudioSource(audio_file),
+                        content_type=self.getAudioType(filename),
+                        recognize_callback=callback,
+                        headers=headers,
+                        **recognize_params
+                    )
+            #print(f"Requested transcription of {filename}")
+            self.record_metrics(filename, callback)
+            self.store_cached(cache_key, callback)
+        except Exception as e:
+            logging.exception(f"Error transcribing {filename}: {str(e)}")
+            return e
+        return self.get_outcome(callback)
+
+    def write_failures(self, filename: str) -> None:
+        """
+        Write the files that could not be transcribed, with their attempt count and last error.
+        """
+        with open(filename, 'w', newline='', encoding='utf-8') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['Audio File Name', 'Attempts', 'Error', 'Transaction ID'])
+            for audio_file_name, (attempts, error) in sorted(self.failures.items()):
+                writer.writerow([audio_file_name, attempts, str(error), self.transaction_ids.get(audio_file_name, '')])
+        logging.warning(f"Wrote {len(self.failures)} failed audio files to {filename}")
 
     def report(self):
         report_file_name = self.config.getValue("Transcriptions", "stt_transcriptions_file")
         csv_columns = ['Audio File Name','Transcription']
         #print(self.transcriptions.getData())
-        data = self.transcriptions.getData()
+        self.transcriptions.close()
+        if self.word_details is not None:
+            self.word_details.close()
 
         with open(report_file_name, 'w', encoding='utf-8-sig') as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(csv_columns)
-            writer.writerows(data.items())
-            logging.info(f"Wrote transcriptions for {len(data)} audio files to {report_file_name}")
+            count = 0
+            for item in self.transcriptions.items():
+                if item[0] in self.segment_files:
+                    continue
+                writer.writerow(item)
+                count += 1
+            logging.info(f"Wrote transcriptions for {count} audio files to {report_file_name}")
+
+        if len(self.failures) > 0:
+            self.write_failures(report_file_name + FAILURES_SUFFIX)
 
         reference_file_name = self.config.getValue("Transcriptions", "reference_transcriptions_file")
         if reference_file_name is not None:
@@ -216,7 +478,25 @@ class Transcriber:
             except Exception as e:
                 logging.warning(f"Failed to merge reference transcriptions into {report_file_name}: {str(e)}")
                 
-def run(config_file:str, logging_level:str=DEFAULT_LOGLEVEL):
+def list_audio_files(audio_file_dir:str):
+    files = []
+    skipped = []
+    for f in os.listdir(audio_file_dir):
+        if f.endswith(FILE_EXTENSIONS):
+            files.append(os.path.join(audio_file_dir, f))
+        else:
+            skipped.append(os.path.join(audio_file_dir, f))
+
+    if len(files) < len(os.listdir(audio_file_dir)):
+        logging.warning("Skipping files in the audio file directory due to invalid file extensions: " + str(skipped))
+    return files
+
+def run(config_file:str, logging_level:str=DEFAULT_LOGLEVEL, sessions=None, files=None):
+    """
+    Args:
+        sessions: Optional semaphore shared by concurrent runs to cap the total number of recognize sessions
+        files: Audio files to transcribe instead of every audio file in `audio_file_folder`
+    """
     config      = Config(config_file)
     transcriber = Transcriber(config)
 
@@ -226,44 +506,78 @@ def run(config_file:str, logging_level:str=DEFAULT_LOGLEVEL):
 
     audio_file_dir = config.getValue("Transcriptions","audio_file_folder") or ""
     max_threads = int(config.getValue("SpeechToText","max_threads", 1) or 1)
+    transcription_mode = config.getValue("SpeechToText", "transcription_mode", "threads") or "threads"
 
     summary_file = config.getValue("ErrorRateOutput", "summary_file") or ""
     output_dir = os.path.dirname(summary_file) if summary_file else ""
     if output_dir and len(output_dir) > 0:
         os.makedirs(output_dir, exist_ok=True)
 
-    files = []
-    skipped = []
-    for f in os.listdir(audio_file_dir):
-        if f.endswith(FILE_EXTENSIONS):
-            files.append(os.path.join(audio_file_dir, f))
-        else:
-            skipped.append(os.path.join(audio_file_dir, f))
+    transcriber.metrics.serve()
 
-    if len(files) < len(os.listdir(audio_file_dir)):
-        logging.warning("Skipping files in the audio file directory due to invalid file extensions: " + str(skipped))
+    if files is None:
+        files = list_audio_files(audio_file_dir)
+
+    if len(files) == 0:
+        logging.error("There were no valid audio files found. Exiting.")
+        sys.exit(1)
+
+    completed = set()
+    if transcriber.transcriptions.journal_file is not None:
+        completed = transcriber.transcriptions.completed()
+        if len(completed) > 0:
+            remaining = [file for file in files if file not in completed]
+            logging.info(f"Resuming from {transcriber.transcriptions.journal_file}: skipping {len(files) - len(remaining)} already transcribed files")
+            files = remaining
+
+    segmenter = AudioSegmenter.from_config(config)
+    if segmenter is not None:
+        with transcriber.metrics.timer("segmentation_seconds"):
+            files = [file for file in segmenter.split_all(files) if file not in completed]
+        if transcriber.word_details is not None:
+            transcriber.word_details.aliases.update(segmenter.origins)
 
     total_files=len(files)
+    start = time.monotonic()
+
+    if transcription_mode == "asyncio" and transcriber.transport == "http":
+        logging.warning("transport=http is not supported with transcription_mode=asyncio, using threads")
+        transcription_mode = "threads"
+    if transcription_mode == "asyncio" and config.getBoolean("SpeechToText", "adaptive_concurrency"):
+        logging.warning("adaptive_concurrency is not supported with transcription_mode=asyncio, using up to max_concurrent_sessions sessions")
 
     if total_files>0:
-        complete_files=0
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_threads) as executor:
-            #executor.map(transcriber.transcribe,files)
-            futures = [executor.submit(transcriber.transcribe, file) for file in files]
-            for future in concurrent.futures.as_completed(futures):
-                complete_files+=1
-                if complete_files%100==0:
-                    logging.info(f"Completed transcribing {complete_files} files out of {total_files}")
-    
-        if complete_files != total_files:
+        if transcription_mode == "asyncio":
+            import transcribe_async
+            max_sessions = int(config.getValue("SpeechToText", "max_concurrent_sessions", 100) or 100)
+            complete_files = transcribe_async.transcribe_files(transcriber, files, max_sessions, sessions)
+        elif transcription_mode == "batch":
+            import batch_jobs
+            complete_files = batch_jobs.transcribe_files(transcriber, files, max_threads, sessions)
+        else:
+            scheduler = TranscriptionScheduler.from_config(config, transcriber.transcribe, max_threads, sessions, transcriber.metrics)
+            complete_files = scheduler.run(files)
+            transcriber.failures.update(scheduler.failures)
+
+        if len(transcriber.failures) > 0:
+            logging.error(f"{len(transcriber.failures)} out of {total_files} files failed to transcribe.")
+        elif complete_files != total_files:
             logging.error(f"Only {complete_files} out of {total_files} were transcribed.")
         else:
             logging.info(f"Completed transcribing {complete_files} files out of {total_files}")
-    else:
-        logging.error("There were no valid audio files found. Exiting.")
-        sys.exit(1)
 
-    transcriber.report()
+    if segmenter is not None:
+        stitched = segmenter.stitch(transcriber.transcriptions, transcriber.failures)
+        logging.info(f"Stitched the segment transcriptions of {stitched} out of {len(segmenter.segments)} long audio files")
+        #Also leave out segments journaled by earlier runs of files stitched since
+        transcriber.segment_files = segmenter.segment_files() | {file for file in completed if segmenter.is_segment(file)}
+        segmenter.close()
+
+    transcriber.metrics.observe("transcription_run_seconds", time.monotonic() - start)
+    with transcriber.metrics.timer("report_seconds"):
+        transcriber.report()
+    transcriber.metrics.write()
+    transcriber.metrics.close()
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
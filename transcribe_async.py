@@ -0,0 +1,210 @@
+"""
+Asyncio transcription engine for IBM Watson Speech to Text.
+
+Runs many concurrent recognize sessions on a single event loop instead of blocking one
+thread per audio file.  Speaks the same websocket protocol as `recognize_using_websocket`
+and fills the same `Transcriptions` object, so `Transcriber.report()` is unchanged.
+"""
+
+import asyncio
+import concurrent.futures
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional
+from urllib.parse import urlencode
+
+from websockets.asyncio.client import connect
+
+from transcribe import MyRecognizeCallback
+from scheduler import classify_error, rate_limiter_from_config, retry_policy_from_config
+
+#Recognize parameters sent on the websocket URL rather than in the "start" message
+QUERY_PARAMS = ("model", "language_customization_id", "acoustic_customization_id", "base_model_version")
+#Parameters the SDK websocket interface does not forward to the service
+UNSUPPORTED_OPTIONS = ("skip_zero_len_words",)
+
+TIMEOUT_PREFIX = "No speech detected for"
+AUDIO_CHUNK_SIZE = 64 * 1024
+
+class AsyncTranscriber:
+    """
+    Transcribes audio files over websockets with up to `max_sessions` concurrent recognize sessions.
+    If `sessions` is given, each session also holds that (thread) semaphore, shared with other runs.
+    """
+
+    def __init__(self, transcriber, max_sessions: int, sessions: Optional[threading.Semaphore] = None):
+        self.transcriber = transcriber
+        self.STT = transcriber.STT
+        self.max_sessions = max_sessions
+        self.sessions = sessions
+        #Threads blocked on `sessions`, one per session that can wait for a permit
+        self.session_waiters: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+        self.recognize_params = transcriber.get_recognize_params()
+        query = {k: v for k, v in self.recognize_params.items() if k in QUERY_PARAMS and v is not None}
+        self.url = self.STT.service_url.replace('https:', 'wss:') + '/v1/recognize?' + urlencode(query)
+        self.options = {k: v for k, v in self.recognize_params.items()
+                        if k not in QUERY_PARAMS and k not in UNSUPPORTED_OPTIONS and v is not None}
+        self.retry_policy = retry_policy_from_config(transcriber.config)
+        self.rate_limiter = rate_limiter_from_config(transcriber.config)
+
+    def get_headers(self, filename: str) -> Dict[str, str]:
+        """
+        Build the websocket handshake headers for `filename`, including authentication.
+        May block while the authenticator refreshes its token, so call it off the event loop.
+        """
+        headers = self.STT.default_headers.copy() if self.STT.default_headers else {}
+        headers.update(self.transcriber.request_headers(filename))
+
+        request = {'headers': headers}
+        if self.STT.authenticator:
+            self.STT.authenticator.authenticate(request)
+        return request['headers']
+
+    async def receive(self, ws, callback: MyRecognizeCallback) -> bool:
+        """
+        Dispatch service messages to the callback until the service reports it is listening.
+
+        Returns:
+            True if a "state" message was received, False if the session ended with an error
+        """
+        async for message in ws:
+            data = json.loads(message)
+            if 'error' in data:
+                if data['error'].startswith(TIMEOUT_PREFIX):
+                    callback.on_inactivity_timeout(data['error'])
+                else:
+                    callback.on_error(data['error'])
+                return False
+            elif 'state' in data:
+                return True
+            elif 'results' in data or 'speaker_labels' in data:
+                callback.on_data(data)
+        return False
+
+    async def send_audio(self, ws, filename: str) -> None:
+        with open(filename, "rb") as audio_file:
+            while True:
+                chunk = audio_file.read(AUDIO_CHUNK_SIZE)
+                if not chunk:
+                    break
+                await ws.send(chunk)
+
+    async def recognize(self, filename: str) -> Optional[Any]:
+        """
+        Run one recognize session for `filename`.
+
+        Returns:
+            None on success, otherwise the error that occurred
+        """
+        cache_key, cached = await asyncio.to_thread(self.transcriber.get_cached, filename, self.recognize_params)
+        if cached is not None:
+            self.transcriber.metrics.increment("cache_hits")
+            return None
+        callback = self.transcriber.make_callback(filename)
+        start = dict(self.options)
+        start['action'] = 'start'
+        start['content_type'] = self.transcriber.getAudioType(filename)
+        try:
+            headers = await asyncio.to_thread(self.get_headers, filename)
+            async with connect(self.url, additional_headers=headers, max_size=None) as ws:
+                callback.on_connected()
+                await ws.send(json.dumps(start))
+                if await self.receive(ws, callback):
+                    await self.send_audio(ws, filename)
+                    await ws.send(json.dumps({'action': 'stop'}))
+                    await self.receive(ws, callback)
+            self.transcriber.record_metrics(filename, callback)
+            await asyncio.to_thread(self.transcriber.store_cached, cache_key, callback)
+        except Exception as e:
+            logging.exception(f"Error transcribing {filename}: {str(e)}")
+            return e
+        return self.transcriber.get_outcome(callback)
+
+    async def acquire_session(self) -> None:
+        """
+        Take a permit of the `sessions` semaphore shared with other runs.  Blocks on the `session_waiters`
+        threads rather than in `asyncio.to_thread`: waiting sessions would otherwise use up the default
+        executor's threads, and the sessions holding permits could not run their own `to_thread` calls to
+        finish and release them.
+        """
+        future = self.session_waiters.submit(self.sessions.acquire)
+        try:
+            await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            #The thread may still take the permit after the session is cancelled, give it back
+            future.add_done_callback(lambda f: f.cancelled() or self.sessions.release())
+            raise
+
+    async def transcribe(self, filename: str, semaphore: asyncio.Semaphore) -> None:
+        metrics = self.transcriber.metrics
+        submitted = time.monotonic()
+        attempt = 0
+        while True:
+            async with semaphore:
+                if self.sessions is not None:
+                    await self.acquire_session()
+                try:
+                    if self.rate_limiter is not None:
+                        await asyncio.sleep(self.rate_limiter.reserve())
+                    logging.debug(f"Transcribing file: {filename}")
+                    start = time.monotonic()
+                    if attempt == 0:
+                        metrics.observe("queue_wait_seconds", start - submitted, filename)
+                    error = await self.recognize(filename)
+                    metrics.observe("recognize_seconds", time.monotonic() - start, filename)
+                finally:
+                    if self.sessions is not None:
+                        self.sessions.release()
+
+            if error is None:
+                return
+            retryable, throttled = classify_error(error)
+            if not retryable or attempt >= self.retry_policy.max_retries:
+                self.transcriber.failures[filename] = (attempt + 1, error)
+                metrics.increment("failures")
+                logging.error(f"{filename} - Failed after {attempt + 1} attempt(s): {error}")
+                return
+
+            delay = self.retry_policy.delay(attempt)
+            attempt += 1
+            metrics.increment("throttled_retries" if throttled else "retries")
+            logging.warning(f"{filename} - Retrying in {delay:.1f}s (attempt {attempt} of {self.retry_policy.max_retries}) after error: {error}")
+            await asyncio.sleep(delay)
+
+    async def transcribe_all(self, files: List[str]) -> int:
+        semaphore = asyncio.Semaphore(self.max_sessions)
+        if self.sessions is not None:
+            #Only sessions holding `semaphore` wait for a permit
+            self.session_waiters = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_sessions, thread_name_prefix="session_waiter")
+        try:
+            tasks = [asyncio.create_task(self.transcribe(file, semaphore)) for file in files]
+            complete_files = 0
+            for task in asyncio.as_completed(tasks):
+                await task
+                complete_files += 1
+                if complete_files % 100 == 0:
+                    logging.info(f"Completed transcribing {complete_files} files out of {len(files)}")
+                    self.transcriber.metrics.write_prometheus_file()
+            return complete_files
+        finally:
+            if self.session_waiters is not None:
+                self.session_waiters.shutdown(wait=False)
+
+def transcribe_files(transcriber, files: List[str], max_sessions: int, sessions: Optional[threading.Semaphore] = None) -> int:
+    """
+    Transcribe `files` on one event loop, storing results in `transcriber.transcriptions`.
+
+    Args:
+        transcriber: Configured `transcribe.Transcriber`
+        files: Audio file paths
+        max_sessions: Maximum number of concurrent recognize sessions
+        sessions: Optional semaphore limiting recognize sessions across concurrent runs
+
+    Returns:
+        Number of files processed
+    """
+    logging.info(f"Transcribing {len(files)} files with up to {max_sessions} concurrent asyncio sessions")
+    return asyncio.run(AsyncTranscriber(transcriber, max_sessions, sessions).transcribe_all(files))
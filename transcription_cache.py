@@ -0,0 +1,175 @@
+"""
+On-disk cache of Speech to Text transcriptions.
+
+Entries are keyed by a content hash of the audio bytes plus the normalized recognize parameters,
+so re-running a batch (or an experiment grid point) with identical settings skips the network call.
+The cache is bounded in size; the least recently used entries are evicted first.  Recency and sizes
+are tracked in memory, from a scan of the cache directory when the cache is opened, so storing an
+entry never walks the directory.  Entries written by other processes sharing the directory are counted
+when the cache is next opened.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+DEFAULT_CACHE_MAX_SIZE_MB = 1024
+CACHE_FILE_SUFFIX = ".json"
+HASH_BLOCK_SIZE = 1024 * 1024
+
+class TranscriptionCache:
+    """
+    Size-bounded LRU cache of transcriptions stored as one small JSON file per entry.
+    Safe to share between transcription threads.
+    """
+
+    def __init__(self, cache_dir: str, max_size_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        #Size of each entry by path, least recently used first
+        self.index: "OrderedDict[str, int]" = OrderedDict((path, size) for _, path, size in sorted(self.entries()))
+        self.size_bytes = sum(self.index.values())
+
+    @classmethod
+    def from_config(cls, config) -> Optional["TranscriptionCache"]:
+        """
+        Create the cache configured by `cache_directory` and `cache_max_size_mb` under [Transcriptions].
+
+        Returns:
+            TranscriptionCache, or None if caching is not configured
+        """
+        cache_dir = config.getValue("Transcriptions", "cache_directory")
+        if not cache_dir:
+            return None
+        max_size_mb = float(config.getValue("Transcriptions", "cache_max_size_mb", DEFAULT_CACHE_MAX_SIZE_MB))
+        logging.debug(f"Using transcription cache {cache_dir} (max {max_size_mb} MB)")
+        return cls(cache_dir, int(max_size_mb * 1024 * 1024))
+
+    @staticmethod
+    def normalize_params(params: Dict[str, Any]) -> str:
+        """
+        Serialize recognize parameters so that equivalent settings produce the same string.
+        Unset (None) parameters are dropped and numbers are compared by value.
+        """
+        normalized = {}
+        for key, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                value = float(value)
+            normalized[key] = value
+        return json.dumps(normalized, sort_keys=True)
+
+    def make_key(self, filename: str, params: Dict[str, Any]) -> str:
+        """
+        Compute the cache key for an audio file and its recognize parameters.
+
+        Args:
+            filename: Path of the audio file; only its contents are hashed, not its name
+            params: Recognize keyword arguments, including content type
+
+        Returns:
+            Hex digest identifying the (audio, parameters) pair
+        """
+        digest = hashlib.sha256()
+        with open(filename, "rb") as audio_file:
+            for block in iter(lambda: audio_file.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+        digest.update(b"\0")
+        digest.update(self.normalize_params(params).encode("utf-8"))
+        return digest.hexdigest()
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + CACHE_FILE_SUFFIX)
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        Look up a transcription, marking it as recently used.
+
+        Returns:
+            Cached transcription text, or None on a miss
+        """
+        entry = self.get_entry(key)
+        return entry["transcription"] if entry is not None else None
+
+    def get_entry(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Look up a cache entry, marking it as recently used.
+
+        Returns:
+            Dict with the "transcription" and, if it was stored, the service's "results"; None on a miss
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, encoding="utf-8") as f:
+                entry = json.load(f)
+            if not isinstance(entry, dict) or "transcription" not in entry:
+                return None
+            os.utime(path)
+            with self.lock:
+                if path in self.index:
+                    self.index.move_to_end(path)
+            return entry
+        except (FileNotFoundError, ValueError):
+            return None
+        except OSError as e:
+            logging.warning(f"Failed to read transcription cache entry {path}: {e}")
+            return None
+
+    def put(self, key: str, transcription: str, results: Optional[List[Any]] = None) -> None:
+        """
+        Store a transcription, and optionally the full recognize results it came from, and evict the least
+        recently used entries if the cache is over its size limit.
+        """
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        entry = {"transcription": transcription}
+        if results is not None:
+            entry["results"] = results
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, path)
+            size = os.path.getsize(path)
+            with self.lock:
+                self.size_bytes += size - self.index.pop(path, 0)
+                self.index[path] = size
+                if self.size_bytes > self.max_size_bytes:
+                    self.evict()
+        except OSError as e:
+            logging.warning(f"Failed to write transcription cache entry {path}: {e}")
+
+    def entries(self):
+        """
+        Yield (mtime, path, size) for every cache entry.
+        """
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(CACHE_FILE_SUFFIX):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield (stat.st_mtime, path, stat.st_size)
+
+    def evict(self) -> None:
+        """
+        Remove least recently used entries until the cache is within its size limit.
+        Caller must hold `self.lock`.
+        """
+        while self.size_bytes > self.max_size_bytes and len(self.index) > 0:
+            path, size = self.index.popitem(last=False)
+            self.size_bytes -= size
+            try:
+                os.remove(path)
+                logging.debug(f"Evicted transcription cache entry {path}")
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,259 @@
+"""
+Batch word error rate engine.
+
+Scores many reference/hypothesis pairs at once.  Words are mapped to integer IDs over the whole
+corpus, and with unit costs every pair is aligned by `Levenshtein.editops`, the alignment
+`jiwer.compute_measures` uses, so hits, substitutions, deletions and insertions are the same as jiwer's.
+Weighted costs (e.g. sclite's) are computed for a batch of pairs together with NumPy, sweeping the
+dynamic programming table one anti-diagonal at a time.
+"""
+
+import re
+from typing import Dict, Hashable, Iterable, List, Sequence, Tuple, Union
+
+import numpy as np
+import Levenshtein
+
+DEFAULT_BATCH_SIZE = 1024
+
+#Costs of a substitution, deletion and insertion
+UNIT_WEIGHTS = (1, 1, 1)
+
+#Padding IDs never match each other or a real word
+REF_PAD = -1
+HYP_PAD = -2
+
+def to_words(cleaned: Union[str, Iterable[str]]) -> List[str]:
+    """
+    Split transformed text into the word list `jiwer.compute_measures` scores, applying its default
+    transform (collapse spaces, strip, split on spaces, drop empty words).
+    """
+    if isinstance(cleaned, str):
+        cleaned = [cleaned]
+    words = []
+    for s in cleaned:
+        s = re.sub(r"\s\s+", " ", s).strip()
+        words.extend(w for w in s.split(" ") if w.strip() != "")
+    return words
+
+class Vocabulary:
+    """
+    Maps words to dense integer IDs.
+    """
+
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+
+    def encode(self, words: List[str]) -> np.ndarray:
+        ids = self.ids
+        return np.array([ids.setdefault(w, len(ids)) for w in words], dtype=np.int32)
+
+def to_strings(ref: Sequence[Hashable], hyp: Sequence[Hashable]) -> Tuple[str, str]:
+    """
+    One character per distinct word of a reference and hypothesis pair, as jiwer passes words to Levenshtein.
+    Words are numbered within the pair, skipping the surrogate range, so every pair gets valid characters
+    however large the corpus vocabulary is.
+    """
+    chars: Dict[Hashable, str] = {}
+    def char(word: Hashable) -> str:
+        if word not in chars:
+            n = len(chars)
+            chars[word] = chr(n + 0x800 if n >= 0xD800 else n)
+        return chars[word]
+    return "".join(map(char, ref)), "".join(map(char, hyp))
+
+def editops_counts(refs: List[np.ndarray], hyps: List[np.ndarray]) -> np.ndarray:
+    """
+    Count the edit operations of `Levenshtein.editops` for each pair of encoded reference and hypothesis.
+
+    Returns:
+        int64 array of shape (len(refs), 4) holding hits, substitutions, deletions and insertions
+    """
+    counts = np.zeros((len(refs), 4), dtype=np.int64)
+    for n, (ref, hyp) in enumerate(zip(refs, hyps)):
+        subs = dels = ins = 0
+        for op, _, _ in Levenshtein.editops(*to_strings(ref.tolist(), hyp.tolist())):
+            if op == 'replace':
+                subs += 1
+            elif op == 'delete':
+                dels += 1
+            else:
+                ins += 1
+        counts[n] = (len(ref) - subs - dels, subs, dels, ins)
+    return counts
+
+def align(ref_words: List[str], hyp_words: List[str]) -> List[Tuple[str, int, int]]:
+    """
+    Compute the edit operations turning the reference into the hypothesis, using the same
+    Levenshtein alignment as `jiwer.compute_measures`.
+
+    Returns:
+        List of (operation, reference position, hypothesis position) with operation one of
+        'replace', 'delete' or 'insert'
+    """
+    return Levenshtein.editops(*to_strings(ref_words, hyp_words))
+
+def weighted_align(ref_words: List[str], hyp_words: List[str], weights: Tuple[int, int, int] = UNIT_WEIGHTS) -> List[Tuple[str, int, int]]:
+    """
+    Align one reference and hypothesis with the given (substitution, deletion, insertion) `weights`,
+    breaking ties as `edit_counts` does, so the operations add up to its counts.
+
+    Returns:
+        List of (operation, reference position, hypothesis position) in order, with operation one of
+        'C' (correct), 'S', 'D' or 'I'; the position not consumed by a deletion or insertion is -1
+    """
+    sub_cost, del_cost, ins_cost = weights
+    R, H = len(ref_words), len(hyp_words)
+    cost = [[0] * (H + 1) for _ in range(R + 1)]
+    move = [[""] * (H + 1) for _ in range(R + 1)]
+    for j in range(1, H + 1):
+        cost[0][j], move[0][j] = j * ins_cost, "I"
+    for i in range(1, R + 1):
+        cost[i][0], move[i][0] = i * del_cost, "D"
+        ref_word, row, prev = ref_words[i - 1], cost[i], cost[i - 1]
+        for j in range(1, H + 1):
+            mismatch = ref_word != hyp_words[j - 1]
+            best, op = prev[j] + del_cost, "D"
+            diag = prev[j - 1] + mismatch * sub_cost
+            if diag < best:
+                best, op = diag, "S" if mismatch else "C"
+            if row[j - 1] + ins_cost < best:
+                best, op = row[j - 1] + ins_cost, "I"
+            row[j], move[i][j] = best, op
+
+    operations = []
+    i, j = R, H
+    while i > 0 or j > 0:
+        op = move[i][j]
+        if op == "D":
+            i -= 1
+            operations.append((op, i, -1))
+        elif op == "I":
+            j -= 1
+            operations.append((op, -1, j))
+        else:
+            i, j = i - 1, j - 1
+            operations.append((op, i, j))
+    operations.reverse()
+    return operations
+
+def edit_counts(refs: List[np.ndarray], hyps: List[np.ndarray], weights: Tuple[int, int, int] = UNIT_WEIGHTS) -> np.ndarray:
+    """
+    Compute minimum cost edit operation counts for equally sized lists of encoded references and hypotheses,
+    with the given (substitution, deletion, insertion) `weights`.
+
+    Ties between equal-cost alignments are broken towards deletions, then substitutions, then insertions.
+    With unit weights the total number of errors equals the Levenshtein distance, but ambiguous alignments
+    can be split differently from `Levenshtein.editops`; `batch_edit_counts` uses `editops_counts` then.
+
+    Returns:
+        int64 array of shape (len(refs), 4) holding hits, substitutions, deletions and insertions
+    """
+    n = len(refs)
+    ref_len = np.fromiter((len(r) for r in refs), dtype=np.int64, count=n)
+    hyp_len = np.fromiter((len(h) for h in hyps), dtype=np.int64, count=n)
+    R = int(ref_len.max(initial=0))
+    H = int(hyp_len.max(initial=0))
+
+    ref = np.full((n, R), REF_PAD, dtype=np.int32)
+    hyp = np.full((n, H), HYP_PAD, dtype=np.int32)
+    if R > 0:
+        ref[np.arange(R) < ref_len[:, None]] = np.concatenate(refs)
+    if H > 0:
+        hyp[np.arange(H) < hyp_len[:, None]] = np.concatenate(hyps)
+
+    #Each anti-diagonal k holds the cells (i, k - i) indexed by i, and only cells between the diagonal's
+    #bounds are read, so three buffers are reused for diagonals k - 2, k - 1 and k.
+    #Planes are cost, substitutions and deletions; insertions follow from the lengths and deletions.
+    sub_cost, del_cost, ins_cost = weights
+    prev2, prev1, cur = (np.zeros((3, n, R + 1), dtype=np.int32) for _ in range(3))
+    counts = np.zeros((n, 3), dtype=np.int64)
+    target = ref_len + hyp_len
+    batch = np.arange(n)
+
+    for k in range(R + H + 1):
+        lo, hi = max(0, k - H), min(k, R)
+
+        #Boundaries: first row is all insertions, first column all deletions
+        if lo == 0:
+            cur[:, :, 0] = np.array([k * ins_cost, 0, 0], dtype=np.int32)[:, None]
+        if hi == k:
+            cur[:, :, k] = np.array([k * del_cost, 0, k], dtype=np.int32)[:, None]
+
+        #Cells a..b, read from diagonal k - 2 at a - 1..b - 1 and from diagonal k - 1 at a - 1..b
+        a, b = max(lo, 1), min(hi, k - 1)
+        if a <= b:
+            mismatch = ref[:, a - 1:b] != hyp[:, k - b - 1:k - a][:, ::-1]
+            diag_cost = prev2[0, :, a - 1:b] + mismatch * sub_cost
+            up_cost = prev1[0, :, a - 1:b] + del_cost
+            left_cost = prev1[0, :, a:b + 1] + ins_cost
+
+            take_up = up_cost <= diag_cost
+            best_cost = np.where(take_up, up_cost, diag_cost)
+            take_left = left_cost < best_cost
+            cur[0, :, a:b + 1] = np.where(take_left, left_cost, best_cost)
+            subs = np.where(take_up, prev1[1, :, a - 1:b], prev2[1, :, a - 1:b] + mismatch)
+            cur[1, :, a:b + 1] = np.where(take_left, prev1[1, :, a:b + 1], subs)
+            dels = np.where(take_up, prev1[2, :, a - 1:b] + 1, prev2[2, :, a - 1:b])
+            cur[2, :, a:b + 1] = np.where(take_left, prev1[2, :, a:b + 1], dels)
+
+        done = target == k
+        if done.any():
+            counts[done] = cur[:, batch[done], ref_len[done]].T
+        prev2, prev1, cur = prev1, cur, prev2
+
+    subs, dels = counts[:, 1], counts[:, 2]
+    hits = ref_len - subs - dels
+    return np.stack([hits, subs, dels, hyp_len - hits - subs], axis=1)
+
+def batch_edit_counts(refs: List[np.ndarray], hyps: List[np.ndarray], batch_size: int = DEFAULT_BATCH_SIZE,
+                      weights: Tuple[int, int, int] = UNIT_WEIGHTS) -> np.ndarray:
+    """
+    Compute edit operation counts for any number of pairs.  With unit `weights` each pair is aligned by
+    `Levenshtein.editops`, as jiwer does; otherwise pairs of similar length are grouped into batches for
+    `edit_counts`.
+
+    Returns:
+        int64 array of shape (len(refs), 4) holding hits, substitutions, deletions and insertions
+    """
+    if tuple(weights) == UNIT_WEIGHTS:
+        return editops_counts(refs, hyps)
+    n = len(refs)
+    result = np.zeros((n, 4), dtype=np.int64)
+    lengths = np.fromiter((len(r) + len(h) for r, h in zip(refs, hyps)), dtype=np.int64, count=n)
+    order = np.argsort(lengths, kind='stable')
+    for start in range(0, n, batch_size):
+        index = order[start:start + batch_size]
+        result[index] = edit_counts([refs[b] for b in index], [hyps[b] for b in index], weights)
+    return result
+
+def measures_from_counts(counts: np.ndarray, hyp_lengths: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Derive WER, MER, WIL and WIP arrays from edit operation counts, as `jiwer.compute_measures` does.
+    """
+    hits, subs, dels, ins = (counts[:, c].astype(np.float64) for c in range(4))
+    errors = subs + dels + ins
+    ref_lengths = hits + subs + dels
+    with np.errstate(divide='ignore', invalid='ignore'):
+        wer = errors / ref_lengths
+        mer = errors / (hits + errors)
+        wip = np.where(hyp_lengths > 0, (hits / ref_lengths) * (hits / np.maximum(hyp_lengths, 1)), 0.0)
+    return {"wer": wer, "mer": mer, "wil": 1 - wip, "wip": wip,
+            "hits": counts[:, 0], "substitutions": counts[:, 1], "deletions": counts[:, 2], "insertions": counts[:, 3]}
+
+def batch_measures(pairs: List[Tuple[List[str], List[str]]], batch_size: int = DEFAULT_BATCH_SIZE) -> List[Dict[str, float]]:
+    """
+    Score (reference words, hypothesis words) pairs.
+
+    Returns:
+        One dict per pair with the same keys and values as `jiwer.compute_measures`
+    """
+    vocabulary = Vocabulary()
+    refs = [vocabulary.encode(ref) for ref, _ in pairs]
+    hyps = [vocabulary.encode(hyp) for _, hyp in pairs]
+    counts = batch_edit_counts(refs, hyps, batch_size)
+    hyp_lengths = np.fromiter((len(h) for h in hyps), dtype=np.int64, count=len(hyps))
+    measures = measures_from_counts(counts, hyp_lengths)
+
+    columns = {key: values.tolist() for key, values in measures.items()}
+    return [dict(zip(columns.keys(), row)) for row in zip(*columns.values())]
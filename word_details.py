@@ -0,0 +1,264 @@
+"""
+Columnar store of word timings, word confidences and alternatives from Speech to Text results.
+
+With `word_details_file` set under [Transcriptions], recognize requests ask for timestamps, word
+confidences and `max_alternatives` alternatives, and every word of every alternative becomes one row of
+a Parquet (`.parquet`) or Arrow IPC (`.arrow`, `.feather`) file next to the transcription CSV.  Only the
+final result of a successful recognize session is written.  Requires `pyarrow`.
+
+While transcribing, rows are appended to an Arrow IPC stream in a `<word_details_file>.parts` directory,
+and when the run ends the parts are combined into `word_details_file` in row groups.  With `checkpoint`
+on, every file's rows are written to the stream before its transcription is journaled, so a crashed run
+loses no word rows of files it will skip when resumed; the resumed run combines the parts of both runs.
+
+Read it back with `load_word_details`, selecting only the columns needed, e.g.
+`load_word_details("output/stt_words.parquet", ["Audio File Name", "Word", "Word Confidence"])`.
+"""
+
+import logging
+import math
+import os
+import shutil
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+DEFAULT_ROW_GROUP_SIZE = 100000
+IPC_EXTENSIONS = (".arrow", ".feather", ".ipc")
+PARTS_SUFFIX = ".parts"
+PART_EXTENSION = ".arrows"
+#Column of the parts only: the audio file (or segment) the rows were transcribed from
+TRANSCRIBED_FILE = "Transcribed File"
+
+COLUMNS = ["Audio File Name", "Result", "Alternative", "Word", "Start", "End", "Word Confidence", "Alternative Confidence"]
+
+def schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("Audio File Name", pa.dictionary(pa.int32(), pa.string())),
+        ("Result", pa.int32()),
+        ("Alternative", pa.int16()),
+        ("Word", pa.string()),
+        ("Start", pa.float32()),
+        ("End", pa.float32()),
+        ("Word Confidence", pa.float32()),
+        ("Alternative Confidence", pa.float32()),
+    ])
+
+def part_schema():
+    import pyarrow as pa
+    return schema().append(pa.field(TRANSCRIBED_FILE, pa.string()))
+
+def read_part(filename: str):
+    """
+    Yield the record batches of a part, up to where an interrupted run stopped writing it.
+    """
+    import pyarrow as pa
+    try:
+        with pa.OSFile(filename) as f:
+            for batch in pa.ipc.open_stream(f):
+                yield batch
+    except (pa.ArrowInvalid, OSError) as e:
+        logging.warning(f"Word details part {filename} ends early, keeping the rows before: {str(e)}")
+
+class WordDetailsWriter:
+    """
+    Thread-safe writer of word rows, buffered into batches of `row_group_size` rows.
+
+    Rows go to a new part in `filename + PARTS_SUFFIX`, which `close` combines into `filename`.  If
+    `keep_existing` is True (checkpointed runs), every `add` is written to the part at once, and the rows of
+    an existing file and of parts left by an interrupted run are kept.  A file transcribed in more than one
+    part keeps the rows of the latest one.
+    """
+
+    def __init__(self, filename: str, keep_existing: bool = False, row_group_size: int = DEFAULT_ROW_GROUP_SIZE):
+        import pyarrow as pa
+        self.pa = pa
+        self.filename = filename
+        self.keep_existing = keep_existing
+        self.row_group_size = row_group_size
+        self.schema = schema()
+        self.part_schema = part_schema()
+        self.columns: Dict[str, List[Any]] = {column: [] for column in self.part_schema.names}
+        self.rows = 0
+        #Segments of long audio files are recorded as (original file, offset in seconds)
+        self.aliases: Dict[str, Tuple[str, float]] = {}
+        self.lock = threading.Lock()
+
+        self.parts_dir = filename + PARTS_SUFFIX
+        if not keep_existing:
+            shutil.rmtree(self.parts_dir, ignore_errors=True)
+        os.makedirs(self.parts_dir, exist_ok=True)
+        part = len(self.parts())
+        if part > 0:
+            logging.info(f"Keeping the word details of {part} interrupted run(s) in {self.parts_dir}")
+        self.part_file = os.path.join(self.parts_dir, f"part-{part:05d}{PART_EXTENSION}")
+        self.sink = pa.OSFile(self.part_file, 'wb')
+        self.writer = pa.ipc.new_stream(self.sink, self.part_schema)
+
+    @classmethod
+    def from_config(cls, config) -> Optional["WordDetailsWriter"]:
+        """
+        Create the writer configured by `word_details_file` under [Transcriptions].
+
+        Returns:
+            WordDetailsWriter, or None if word details are not configured
+        """
+        filename = config.getValue("Transcriptions", "word_details_file")
+        if not filename:
+            return None
+        try:
+            return cls(filename, config.getBoolean("Transcriptions", "checkpoint"))
+        except ImportError:
+            logging.error("word_details_file requires pyarrow (pip install pyarrow); word details will not be saved")
+            return None
+
+    def parts(self) -> List[str]:
+        return sorted(os.path.join(self.parts_dir, name) for name in os.listdir(self.parts_dir) if name.endswith(PART_EXTENSION))
+
+    def add(self, audio_file_name: str, results: List[Dict[str, Any]]) -> None:
+        """
+        Add the words of recognize `results` (the service's `results` list) for one audio file.
+        """
+        transcribed_file = audio_file_name
+        audio_file_name, offset = self.aliases.get(audio_file_name, (audio_file_name, 0.0))
+        rows = []
+        for result_index, result in enumerate(results):
+            for rank, alternative in enumerate(result.get("alternatives", [])):
+                alternative_confidence = alternative.get("confidence", math.nan)
+                timestamps = alternative.get("timestamps")
+                confidences = {i: c[1] for i, c in enumerate(alternative.get("word_confidence", []))}
+                if timestamps:
+                    for i, (word, start, end) in enumerate(timestamps):
+                        rows.append((audio_file_name, result_index, rank, word, start + offset, end + offset, confidences.get(i, math.nan), alternative_confidence, transcribed_file))
+                else:
+                    for i, word in enumerate(alternative.get("transcript", "").split()):
+                        rows.append((audio_file_name, result_index, rank, word, math.nan, math.nan, confidences.get(i, math.nan), alternative_confidence, transcribed_file))
+
+        with self.lock:
+            for row in rows:
+                for column, value in zip(self.part_schema.names, row):
+                    self.columns[column].append(value)
+            self.rows += len(rows)
+            if self.keep_existing or len(self.columns["Word"]) >= self.row_group_size:
+                self.flush()
+
+    def flush(self) -> None:
+        """
+        Write the buffered rows to the part.  Caller must hold `self.lock`.
+        """
+        if len(self.columns["Word"]) == 0:
+            return
+        self.writer.write_table(self.pa.Table.from_pydict(self.columns, schema=self.part_schema))
+        self.sink.flush()
+        self.columns = {column: [] for column in self.part_schema.names}
+
+    def close(self) -> None:
+        with self.lock:
+            if self.writer is None:
+                return
+            self.flush()
+            self.writer.close()
+            self.sink.close()
+            self.writer = None
+            self.combine()
+        logging.info(f"Wrote {self.rows} word details to {self.filename}")
+
+    def existing_batches(self, columns: Optional[List[str]] = None):
+        """
+        Yield the record batches of the existing `filename`, one row group (or IPC batch) at a time.
+        """
+        if self.filename.lower().endswith(IPC_EXTENSIONS):
+            with self.pa.OSFile(self.filename) as f:
+                reader = self.pa.ipc.open_file(f)
+                for i in range(reader.num_record_batches):
+                    batch = reader.get_batch(i)
+                    yield batch.select(columns) if columns is not None else batch
+        else:
+            import pyarrow.parquet as pq
+            yield from pq.ParquetFile(self.filename).iter_batches(batch_size=self.row_group_size, columns=columns)
+
+    def encode(self, batch, names):
+        """
+        `batch` in the output schema, with the audio file names encoded against the `names` dictionary
+        shared by every batch, as an Arrow IPC file needs.
+        """
+        import pyarrow.compute as pc
+        column = batch.column("Audio File Name")
+        if self.pa.types.is_dictionary(column.type):
+            indices = pc.take(pc.index_in(column.dictionary, value_set=names), column.indices)
+        else:
+            indices = pc.index_in(column, value_set=names)
+        arrays = [self.pa.DictionaryArray.from_arrays(indices.cast(self.pa.int32()), names) if field.name == "Audio File Name"
+                  else batch.column(field.name).cast(field.type) for field in self.schema]
+        return self.pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def combine(self) -> None:
+        """
+        Write the rows of the existing file (if kept) and of every part to `filename`, dropping rows of a
+        transcribed file that a later part has again, and remove the parts.  Rows are streamed one row group
+        at a time, so only the distinct audio file names are held in memory.
+        """
+        keep_file = self.keep_existing and os.path.exists(self.filename)
+        parts = self.parts()
+        transcribed = [set() for _ in parts]
+        names = {}
+        if keep_file:
+            for batch in self.existing_batches(["Audio File Name"]):
+                names.update(dict.fromkeys(batch.column(0).unique().to_pylist()))
+        for position, part in enumerate(parts):
+            for batch in read_part(part):
+                transcribed[position].update(batch.column(TRANSCRIBED_FILE).to_pylist())
+                names.update(dict.fromkeys(batch.column("Audio File Name").unique().to_pylist()))
+        #Files transcribed again by a later part
+        superseded = [set().union(*transcribed[position + 1:]) for position in range(len(parts))]
+        dictionary = self.pa.array(list(names), self.pa.string())
+
+        def batches():
+            if keep_file:
+                logging.info(f"Keeping the word rows of {self.filename}")
+                yield from self.existing_batches()
+            for part, later in zip(parts, superseded):
+                for batch in read_part(part):
+                    if len(later) > 0:
+                        keep = [name not in later for name in batch.column(TRANSCRIBED_FILE).to_pylist()]
+                        batch = batch.filter(self.pa.array(keep))
+                    yield batch
+
+        def row_groups():
+            buffered, rows = [], 0
+            for batch in batches():
+                buffered.append(self.encode(batch, dictionary))
+                rows += batch.num_rows
+                while rows >= self.row_group_size:
+                    table = self.pa.Table.from_batches(buffered, schema=self.schema)
+                    yield table.slice(0, self.row_group_size)
+                    rest = table.slice(self.row_group_size)
+                    buffered, rows = rest.to_batches(), rest.num_rows
+            if rows > 0:
+                yield self.pa.Table.from_batches(buffered, schema=self.schema)
+
+        tmp_file = self.filename + ".tmp"
+        if self.filename.lower().endswith(IPC_EXTENSIONS):
+            with self.pa.ipc.new_file(tmp_file, self.schema, options=self.pa.ipc.IpcWriteOptions(compression="zstd")) as writer:
+                for table in row_groups():
+                    writer.write_table(table.combine_chunks())
+        else:
+            import pyarrow.parquet as pq
+            with pq.ParquetWriter(tmp_file, self.schema, compression="zstd") as writer:
+                for table in row_groups():
+                    writer.write_table(table, row_group_size=self.row_group_size)
+        os.replace(tmp_file, self.filename)
+        shutil.rmtree(self.parts_dir, ignore_errors=True)
+
+def load_word_details(filename: str, columns: Optional[List[str]] = None):
+    """
+    Read a word details file as a `pyarrow.Table`, only reading `columns` if given.
+    Use `.to_pandas()` on the result for a DataFrame.
+    """
+    import pyarrow as pa
+    if filename.lower().endswith(IPC_EXTENSIONS):
+        #The table may reference the memory map, so it is left to be closed with the table
+        table = pa.ipc.open_file(pa.memory_map(filename)).read_all()
+        return table.select(columns) if columns is not None else table
+    import pyarrow.parquet as pq
+    return pq.read_table(filename, columns=columns)